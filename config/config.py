@@ -35,6 +35,27 @@ SECRET_KEY = c.SECRET_KEY
 # Pagination settings
 ROWS_PER_PAGE = 20
 SEARCH_RESULTS_PER_PAGE = 20
+# Default and maximum number of rows per page of the /api/records/ and /api/players/ endpoints
+API_ROWS_PER_PAGE = 1000
+API_MAX_ROWS_PER_PAGE = 100000
+# Highest page number served by OFFSET, deeper pages are only reachable through next/previous page cursors
+MAX_OFFSET_PAGE = 10
+# Seconds before a cached total row count of a listing gets refreshed in the background, and number of listings counts
+# are kept for
+COUNT_CACHE_TIMEOUT = 300
+COUNT_CACHE_SIZE = 10000
+
+# Maximum number of rendered pages kept in the response cache of each process
+RESPONSE_CACHE_SIZE = 1000
+# Maximum number of html fragments rendered by the server browser filters kept in each process
+FRAGMENT_CACHE_SIZE = 500
+# Seconds between writes of the cache statistics of a process serving requests to the database, and seconds after
+# which the statistics of a process that stopped writing them are dropped, see qldf.stats
+STATS_PUBLISH_SECONDS = 60
+STATS_MAX_AGE_SECONDS = 3600
+
+# Requests taking longer than this many milliseconds are logged as a warning with the SQL statements they ran
+SLOW_REQUEST_THRESHOLD_MS = 500
 
 # Number of rows to show on the index page recent tables
 NUM_RECENT_RECORDS = 25
@@ -59,8 +80,53 @@ RECORD_MODES = ['PQL Weapons',
 
 # syncore api urls
 SYNCORE_SERVERS_URL = 'https://ql.syncore.org/api/servers'
+# update_servers: servers upserted per statement
+SERVER_UPSERT_BATCH_SIZE = 1000
+
+# qlrace.com api urls, the map name is appended to QLRACE_MAP_URL
+QLRACE_MAPS_URL = 'https://qlrace.com/api/maps'
+QLRACE_MAP_URL = 'https://qlrace.com/api/map/'
+# ingest_records: seconds between runs and number of map pages fetched at the same time
+INGEST_RECORDS_INTERVAL = 15 * 60
+INGEST_RECORDS_CONCURRENCY = 4
+
+# update_players: number of steam profiles fetched at the same time and players written per commit
+UPDATE_PLAYERS_CONCURRENCY = 8
+UPDATE_PLAYERS_BATCH_SIZE = 100
+# update_players and update_workshop_items: maximum number of rows refreshed per run, see qldf.refresh
+UPDATE_PLAYERS_LIMIT = 2000
+UPDATE_WORKSHOPITEMS_LIMIT = 200
+# Bounds in seconds of the time between refreshes of a row, it halves when the data changed and doubles when it did not
+REFRESH_MIN_INTERVAL = 6 * 3600
+REFRESH_MAX_INTERVAL = 30 * 24 * 3600
+# Longest time between refreshes of rows with a record in the last REFRESH_ACTIVE_DAYS or seen on a server
+REFRESH_ACTIVE_INTERVAL = 24 * 3600
+REFRESH_ACTIVE_DAYS = 30
+# Maximum average number of requests per second the tasks send to each steam host
+STEAM_REQUESTS_PER_SECOND = 10
+# Retries of requests that failed with a connection error, timeout, 429 or 5xx, the backoff before the first retry
+# doubles for every next one up to the maximum
+OUTBOUND_RETRIES = 3
+OUTBOUND_BACKOFF_SECONDS = 1
+OUTBOUND_BACKOFF_MAX_SECONDS = 30
+# Consecutive failed requests after which requests to a host are skipped, and seconds until it is tried again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 300
+# Seconds after which a task skips its remaining requests, the skipped work is handled first next run
+TASK_TIME_LIMIT = 1800
+# Seconds a task's lease lasts without being renewed, after a process running the task died others wait this long
+TASK_LEASE_SECONDS = 300
+
+# Folder the tasks publish snapshots of precomputed data to
+SNAPSHOT_FOLDER = os.path.join(basedir, '..', 'snapshots')
+
+# Folder the bulk record exports are written to and number of daily delta exports kept
+EXPORT_FOLDER = os.path.join(basedir, '..', 'exports')
+EXPORT_DELTA_DAYS = 30
 
-# APScheduler tasks
+# APScheduler tasks, with SCHEDULER_ENABLED off only worker.py runs them. RUN_TASKS_ON_STARTUP runs them once in the
+# background right after starting, see qldf.warmup
+SCHEDULER_ENABLED = True
 RUN_TASKS_ON_STARTUP = c.RUN_TASKS_ON_STARTUP
 SCHEDULER_API_ENABLED = True
 JOBS = [
@@ -81,9 +147,26 @@ JOBS = [
         'func': 'qldf.tasks:update_workshop_items',
         'trigger': 'interval',
         'seconds': c.UPDATE_WORKSHOPITEMS_INTERVAL
+    },
+    {
+        'id': 'ingest_records',
+        'func': 'qldf.tasks:ingest_records',
+        'trigger': 'interval',
+        'seconds': INGEST_RECORDS_INTERVAL
+    },
+    {
+        'id': 'export_records',
+        'func': 'qldf.tasks:export_records',
+        'trigger': 'cron',
+        'hour': 4
     }
 ]
 
+# Warm-up after starting: compile the templates and request these pages to prime the caches, see qldf.warmup
+WARMUP_ENABLED = True
+WARMUP_PAGES = ['/', '/records/', '/players/', '/maps/', '/servers/', '/api/maps/']
+
 # Logging
 LOG_INFO_FILENAME = 'qldf_info.log'
 LOG_DEBUG_FILENAME = 'qldf_debug.log'
+LOG_REQUESTS_FILENAME = 'qldf_requests.log'
@@ -29,6 +29,20 @@ SECRET_KEY = os.environ.get('SECRET_KEY')
 # Pagination settings
 ROWS_PER_PAGE = 20
 SEARCH_RESULTS_PER_PAGE = c.SEARCH_RESULTS_PER_PAGE
+API_ROWS_PER_PAGE = c.API_ROWS_PER_PAGE
+API_MAX_ROWS_PER_PAGE = c.API_MAX_ROWS_PER_PAGE
+MAX_OFFSET_PAGE = c.MAX_OFFSET_PAGE
+COUNT_CACHE_TIMEOUT = c.COUNT_CACHE_TIMEOUT
+COUNT_CACHE_SIZE = c.COUNT_CACHE_SIZE
+
+# Maximum number of rendered pages kept in the response cache of each process
+RESPONSE_CACHE_SIZE = c.RESPONSE_CACHE_SIZE
+FRAGMENT_CACHE_SIZE = c.FRAGMENT_CACHE_SIZE
+STATS_PUBLISH_SECONDS = c.STATS_PUBLISH_SECONDS
+STATS_MAX_AGE_SECONDS = c.STATS_MAX_AGE_SECONDS
+
+# Requests taking longer than this many milliseconds are logged as a warning with the SQL statements they ran
+SLOW_REQUEST_THRESHOLD_MS = c.SLOW_REQUEST_THRESHOLD_MS
 
 # Number of rows to show on the index page recent tables
 NUM_RECENT_RECORDS = c.NUM_RECENT_RECORDS
@@ -51,12 +65,52 @@ RECORD_MODES = c.RECORD_MODES
 
 # syncore api urls
 SYNCORE_SERVERS_URL = c.SYNCORE_SERVERS_URL
+# update_servers: servers upserted per statement
+SERVER_UPSERT_BATCH_SIZE = c.SERVER_UPSERT_BATCH_SIZE
+
+# qlrace.com api urls, the map name is appended to QLRACE_MAP_URL
+QLRACE_MAPS_URL = c.QLRACE_MAPS_URL
+QLRACE_MAP_URL = c.QLRACE_MAP_URL
+INGEST_RECORDS_CONCURRENCY = c.INGEST_RECORDS_CONCURRENCY
+
+# update_players: number of steam profiles fetched at the same time and players written per commit
+UPDATE_PLAYERS_CONCURRENCY = c.UPDATE_PLAYERS_CONCURRENCY
+UPDATE_PLAYERS_BATCH_SIZE = c.UPDATE_PLAYERS_BATCH_SIZE
+# update_players and update_workshop_items: rows refreshed per run and the time between refreshes of a row
+UPDATE_PLAYERS_LIMIT = c.UPDATE_PLAYERS_LIMIT
+UPDATE_WORKSHOPITEMS_LIMIT = c.UPDATE_WORKSHOPITEMS_LIMIT
+REFRESH_MIN_INTERVAL = c.REFRESH_MIN_INTERVAL
+REFRESH_MAX_INTERVAL = c.REFRESH_MAX_INTERVAL
+REFRESH_ACTIVE_INTERVAL = c.REFRESH_ACTIVE_INTERVAL
+REFRESH_ACTIVE_DAYS = c.REFRESH_ACTIVE_DAYS
+# Maximum average number of requests per second the tasks send to each steam host
+STEAM_REQUESTS_PER_SECOND = c.STEAM_REQUESTS_PER_SECOND
+OUTBOUND_RETRIES = c.OUTBOUND_RETRIES
+OUTBOUND_BACKOFF_SECONDS = c.OUTBOUND_BACKOFF_SECONDS
+OUTBOUND_BACKOFF_MAX_SECONDS = c.OUTBOUND_BACKOFF_MAX_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = c.CIRCUIT_FAILURE_THRESHOLD
+CIRCUIT_RESET_SECONDS = c.CIRCUIT_RESET_SECONDS
+TASK_TIME_LIMIT = c.TASK_TIME_LIMIT
+TASK_LEASE_SECONDS = c.TASK_LEASE_SECONDS
 
-# APScheduler tasks
+# Folder the tasks publish snapshots of precomputed data to
+SNAPSHOT_FOLDER = c.SNAPSHOT_FOLDER
+
+# Folder the bulk record exports are written to and number of daily delta exports kept
+EXPORT_FOLDER = c.EXPORT_FOLDER
+EXPORT_DELTA_DAYS = c.EXPORT_DELTA_DAYS
+
+# APScheduler tasks, run by the worker dyno only, see worker.py
+SCHEDULER_ENABLED = False
 RUN_TASKS_ON_STARTUP = False
 SCHEDULER_API_ENABLED = c.SCHEDULER_API_ENABLED
 JOBS = c.JOBS
 
+# Warm-up after starting
+WARMUP_ENABLED = c.WARMUP_ENABLED
+WARMUP_PAGES = c.WARMUP_PAGES
+
 # Logging
 LOG_INFO_FILENAME = c.LOG_INFO_FILENAME
 LOG_DEBUG_FILENAME = c.LOG_DEBUG_FILENAME
+LOG_REQUESTS_FILENAME = c.LOG_REQUESTS_FILENAME
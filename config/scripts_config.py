@@ -1,6 +1,8 @@
 """Stripped down config to be used by scripts that don't intend to run the app."""
 import os
 import config.config as c
+SCHEDULER_ENABLED = False
+WARMUP_ENABLED = False
 RUN_TASKS_ON_STARTUP = False
 SCHEDULER_API_ENABLED = False
 DEBUG = False
@@ -11,7 +13,15 @@ try:
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 except KeyError:
     SQLALCHEMY_DATABASE_URI = c.SQLALCHEMY_DATABASE_URI
-STEAMWOKSHOP_ITEM_URL = c.STEAMWORKSHOP_ITEM_URL
+STEAMWORKSHOP_ITEM_URL = c.STEAMWORKSHOP_ITEM_URL
 STEAMPLAYER_PROFILE_URL = c.STEAMPLAYER_PROFILE_URL
+RECORD_MODES = c.RECORD_MODES
+SNAPSHOT_FOLDER = c.SNAPSHOT_FOLDER
+EXPORT_FOLDER = c.EXPORT_FOLDER
+EXPORT_DELTA_DAYS = c.EXPORT_DELTA_DAYS
 LOG_INFO_FILENAME = c.LOG_INFO_FILENAME
 LOG_DEBUG_FILENAME = c.LOG_DEBUG_FILENAME
+LOG_REQUESTS_FILENAME = c.LOG_REQUESTS_FILENAME
+SLOW_REQUEST_THRESHOLD_MS = c.SLOW_REQUEST_THRESHOLD_MS
+FRAGMENT_CACHE_SIZE = c.FRAGMENT_CACHE_SIZE
+SERVER_UPSERT_BATCH_SIZE = c.SERVER_UPSERT_BATCH_SIZE
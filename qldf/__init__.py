@@ -4,49 +4,63 @@ from flask_apscheduler import APScheduler
 from flask_navigation import Navigation
 from flask_sqlalchemy import SQLAlchemy
 
-from importlib import import_module
-
-from qldf.root.filters import setup_custom_jinja_filters
-
 db = SQLAlchemy()
 nav = Navigation()
 
 
-def create_app(config):
-    """Create and initialise the object"""
+def create_app(config, **settings):
+    """Create and initialise the object. settings override the values in config. The scheduled tasks only run in the
+    app if SCHEDULER_ENABLED is set, web processes leave them to worker.py. Warm-up runs in the background, see
+    qldf.warmup, and the time each phase of starting took is logged."""
+    from .timing import PhaseTimings
+    startup = PhaseTimings()
     # Flask
     from flask import Flask
-    app = Flask(__name__)
-    app.config.from_object(config)
+    with startup.phase('config'):
+        app = Flask(__name__)
+        app.config.from_object(config)
+        app.config.update(settings)
     # Setup logging
-    setup_logging(app)
+    with startup.phase('logging'):
+        setup_logging(app)
     # SQLAlchemy
-    db.init_app(app)
-    db.app = app
+    with startup.phase('database'):
+        db.init_app(app)
+        db.app = app
     # Setup navigation
-    setup_navigation(app)
-    # Run tasks on startup if needed
-    if app.config['RUN_TASKS_ON_STARTUP']:
-        for task in app.config['JOBS']:
-            task_import_name = task['func'].split(':')[0]
-            task_func_name = task['func'].split(':')[1]
-            task_import = import_module(task_import_name)
-            task_function = getattr(task_import, task_func_name)
-            task_function()
+    with startup.phase('navigation'):
+        setup_navigation(app)
     # Setup and start apscheduler
+    with startup.phase('scheduler'):
+        if app.config['SCHEDULER_ENABLED']:
+            setup_scheduler(app)
+    with startup.phase('blueprints'):
+        # Measure every request, before the blueprints register their own request hooks
+        from .timing import setup_request_timing
+        setup_request_timing(app)
+        # Register blueprints
+        from .root.views import root, setup_error_routing
+        from .api.views import api
+        app.register_blueprint(api)
+        app.register_blueprint(root)
+        # Setup routing for html error pages
+        setup_error_routing(app)
+        # Setup custom jinja filters
+        from .root.filters import setup_custom_jinja_filters
+        setup_custom_jinja_filters(app)
+    # Run the startup tasks and prime the caches in the background
+    with startup.phase('warmup'):
+        from .warmup import setup_warmup
+        setup_warmup(app)
+    app.startup_timings = startup
+    app.logger.info(f'Startup took {startup.total_ms():.0f} ms: {startup.summary()}')
+    return app
+
+
+def setup_scheduler(app):
     scheduler = APScheduler()
     scheduler.init_app(app)
     scheduler.start()
-    # Register blueprints
-    from .root.views import root, setup_error_routing
-    from .api.views import api
-    app.register_blueprint(api)
-    app.register_blueprint(root)
-    # Setup routing for html error pages
-    setup_error_routing(app)
-    # Setup custom jinja filters
-    setup_custom_jinja_filters(app)
-    return app
 
 
 def setup_navigation(app):
@@ -74,3 +88,11 @@ def setup_logging(app):
     app.logger.setLevel(logging.INFO)
     file_handler.setLevel(logging.INFO)
     app.logger.addHandler(file_handler)
+    # Request timings as one json object per line
+    request_handler = RotatingFileHandler(os.path.join(logfolder, app.config['LOG_REQUESTS_FILENAME']), 'a', 1 * 1024 * 1024, 10)
+    request_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    request_logger = logging.getLogger('qldf.requests')
+    request_logger.setLevel(logging.INFO)
+    request_logger.propagate = False
+    if not request_logger.handlers:
+        request_logger.addHandler(request_handler)
@@ -0,0 +1,202 @@
+"""Derived record data that is stored in the database and maintained incrementally,
+so views can read it directly instead of computing it per request.
+
+None of these functions commit, the caller decides when the transaction ends."""
+from sqlalchemy import func, or_, insert, tuple_
+
+from qldf import db
+from qldf.models import Record, WorldRecord, Player, Map, DataVersion
+
+
+def update_partitions(partitions, player_ids=()):
+    """Update all derived data after records were inserted into or deleted from the given partitions.
+    Args:
+        partitions (iterable): (map_id, mode) tuples of the changed partitions
+        player_ids (iterable): ids of players whose records were deleted, other players are found from the partitions
+    """
+    partitions = set(partitions)
+    update_ranks(partitions)
+    update_world_records(partitions)
+    # Rank changes can affect the statistics of every player in a partition
+    player_ids = set(player_ids)
+    if partitions:
+        player_ids.update(row.player_id for row in db.session.query(Record.player_id).
+                          filter(tuple_(Record.map_id, Record.mode).in_(partitions)).
+                          distinct())
+    update_player_stats(player_ids)
+    update_map_stats(set(map_id for map_id, _ in partitions))
+    DataVersion.bump(Record.__tablename__)
+
+
+def rebuild_all():
+    """Recalculate all derived data from scratch, for use after bulk loads or to repair it."""
+    rebuild_ranks()
+    rebuild_world_records()
+    update_player_stats()
+    update_map_stats()
+    DataVersion.bump(Record.__tablename__)
+
+
+def update_ranks(partitions):
+    """Recalculate the rank of every record in the given (map_id, mode) partitions.
+    Only rows whose rank actually changed are written."""
+    for map_id, mode in partitions:
+        sq = db.session.query(Record.id.label('id'),
+                              func.rank().over(order_by=Record.time).label('rank')).\
+            filter(Record.map_id == map_id,
+                   Record.mode == mode).\
+            subquery()
+        _write_ranks(sq)
+
+
+def rebuild_ranks():
+    """Recalculate the rank of every record in the database from scratch."""
+    sq = db.session.query(Record.id.label('id'),
+                          func.rank().over(
+                              order_by=Record.time,
+                              partition_by=(Record.map_id, Record.mode)
+                          ).label('rank')).\
+        subquery()
+    _write_ranks(sq)
+
+
+def _write_ranks(sq):
+    """Copy the rank column of subquery sq with columns (id, rank) to the record table.
+    date_modified is left alone, a rank changes because of other records and not the record itself."""
+    db.session.query(Record).\
+        filter(Record.id == sq.c.id,
+               or_(Record.rank.is_(None), Record.rank != sq.c.rank)).\
+        update({Record.rank: sq.c.rank,
+                Record.date_modified: Record.date_modified}, synchronize_session=False)
+
+
+def update_world_records(partitions):
+    """Point the world record of each (map_id, mode) partition at its current rank 1 record,
+    or remove it if the partition no longer has any records."""
+    for map_id, mode in partitions:
+        holder = db.session.query(Record.id).\
+            filter(Record.map_id == map_id,
+                   Record.mode == mode,
+                   Record.rank == 1).\
+            order_by(Record.date, Record.id).\
+            first()
+        world_record = db.session.query(WorldRecord).\
+            filter(WorldRecord.map_id == map_id,
+                   WorldRecord.mode == mode).\
+            first()
+        if holder is None:
+            if world_record:
+                db.session.delete(world_record)
+        elif world_record is None:
+            db.session.add(WorldRecord(map_id=map_id, mode=mode, record_id=holder.id))
+        elif world_record.record_id != holder.id:
+            world_record.record_id = holder.id
+    db.session.flush()
+
+
+def rebuild_world_records():
+    """Recreate the world record table from the stored record ranks."""
+    db.session.query(WorldRecord).delete(synchronize_session=False)
+    holders = db.session.query(Record.map_id,
+                               Record.mode,
+                               Record.id).\
+        filter(Record.rank == 1).\
+        distinct(Record.map_id, Record.mode).\
+        order_by(Record.map_id, Record.mode, Record.date, Record.id)
+    db.session.execute(insert(WorldRecord).from_select(['map_id', 'mode', 'record_id'], holders))
+
+
+def update_player_stats(player_ids=None):
+    """Recalculate the record count, world record count, best rank and last record date of players.
+    Only rows whose statistics actually changed are written, their date_modified is left alone as it is the last time
+    the name or avatar of the player changed.
+    Args:
+        player_ids (iterable): ids of the players to update, or None to update every player
+    """
+    if player_ids is not None:
+        player_ids = list(player_ids)
+        if not player_ids:
+            return
+    sq = _player_stats_query(player_ids).subquery()
+    db.session.query(Player).\
+        filter(Player.id == sq.c.id,
+               _player_stats_differ(sq)).\
+        update({Player.record_count: sq.c.record_count,
+                Player.wr_count: sq.c.wr_count,
+                Player.best_rank: sq.c.best_rank,
+                Player.last_record_date: sq.c.last_record_date,
+                Player.date_modified: Player.date_modified}, synchronize_session=False)
+
+
+def check_player_stats():
+    """Get the ids of players whose stored statistics differ from their records."""
+    sq = _player_stats_query().subquery()
+    return [row.id for row in db.session.query(Player.id).
+            filter(Player.id == sq.c.id,
+                   _player_stats_differ(sq)).
+            order_by(Player.id)]
+
+
+def _player_stats_query(player_ids=None):
+    """Query calculating the statistics (id, record_count, wr_count, best_rank, last_record_date) of players"""
+    records = db.session.query(Record.player_id.label('player_id'),
+                               func.count(Record.id).label('record_count'),
+                               func.min(Record.rank).label('best_rank'),
+                               func.max(Record.date).label('last_record_date')).\
+        group_by(Record.player_id)
+    world_records = db.session.query(Record.player_id.label('player_id'),
+                                     func.count(WorldRecord.id).label('wr_count')).\
+        join(WorldRecord, WorldRecord.record_id == Record.id).\
+        group_by(Record.player_id)
+    if player_ids is not None:
+        records = records.filter(Record.player_id.in_(player_ids))
+        world_records = world_records.filter(Record.player_id.in_(player_ids))
+    records = records.subquery()
+    world_records = world_records.subquery()
+    query = db.session.query(Player.id.label('id'),
+                             func.coalesce(records.c.record_count, 0).label('record_count'),
+                             func.coalesce(world_records.c.wr_count, 0).label('wr_count'),
+                             records.c.best_rank.label('best_rank'),
+                             records.c.last_record_date.label('last_record_date')).\
+        outerjoin(records, records.c.player_id == Player.id).\
+        outerjoin(world_records, world_records.c.player_id == Player.id)
+    if player_ids is not None:
+        query = query.filter(Player.id.in_(player_ids))
+    return query
+
+
+def _player_stats_differ(sq):
+    """Condition that is true when the stored statistics of a player differ from those in subquery sq"""
+    return or_(Player.record_count.is_distinct_from(sq.c.record_count),
+               Player.wr_count.is_distinct_from(sq.c.wr_count),
+               Player.best_rank.is_distinct_from(sq.c.best_rank),
+               Player.last_record_date.is_distinct_from(sq.c.last_record_date))
+
+
+def update_map_stats(map_ids=None):
+    """Recalculate the record count of maps. Only rows whose count actually changed are written, with their
+    date_modified left alone.
+    Args:
+        map_ids (iterable): ids of the maps to update, or None to update every map
+    """
+    if map_ids is not None:
+        map_ids = list(map_ids)
+        if not map_ids:
+            return
+    records = db.session.query(Record.map_id.label('map_id'),
+                               func.count(Record.id).label('record_count')).\
+        group_by(Record.map_id)
+    if map_ids is not None:
+        records = records.filter(Record.map_id.in_(map_ids))
+    records = records.subquery()
+    sq = db.session.query(Map.id.label('id'),
+                          func.coalesce(records.c.record_count, 0).label('record_count')).\
+        outerjoin(records, records.c.map_id == Map.id)
+    if map_ids is not None:
+        sq = sq.filter(Map.id.in_(map_ids))
+    sq = sq.subquery()
+    db.session.query(Map).\
+        filter(Map.id == sq.c.id,
+               Map.record_count != sq.c.record_count).\
+        update({Map.record_count: sq.c.record_count,
+                Map.date_modified: Map.date_modified}, synchronize_session=False)
@@ -1,15 +1,25 @@
-from flask import jsonify, Blueprint, render_template
-from sqlalchemy import inspect
+import json
+import threading
+from datetime import datetime
+
+from flask import jsonify, Blueprint, render_template, current_app, request, abort, make_response, stream_with_context, \
+    send_file
 
 from qldf import db
-from qldf.models import Map, WorkshopItem
+from qldf.cache import table_state
+from qldf.exports import manifest, export_file_path
+from qldf.models import Map, Record, Player
+from qldf.pagination import encode_cursor, decode_cursor
+from qldf.snapshots import read_snapshot, precompressed_snapshot
+from qldf.stats import published_stats
+from qldf.tasks import write_maps_snapshot, MAPS_SNAPSHOT, MAPS_VERSIONS_SNAPSHOT, MAPS_TABLES
 
 api = Blueprint('api', __name__, url_prefix='/api/', template_folder='templates')
 
+# Rows fetched from the database cursor and sent to the client at a time by the streaming endpoints
+STREAM_BATCH_SIZE = 500
 
-def object_as_dict(obj):
-    return {c.key: getattr(obj, c.key)
-            for c in inspect(obj).mapper.column_attrs}
+_maps_snapshot_lock = threading.Lock()
 
 
 @api.route('docs/')
@@ -19,19 +29,186 @@ def docs():
 
 @api.route('maps/')
 def get_maps():
-    rows = db.session.query(Map,
-                            WorkshopItem).\
-        outerjoin(WorkshopItem).\
-        all()
-    maps_dict = {row.Map.id: (object_as_dict(row.Map), object_as_dict(row.WorkshopItem) if row.WorkshopItem else None) for row in rows}
-    return jsonify(maps_dict)
+    """Map catalogue, sent from the precompressed snapshot published by update_workshop_items in the best
+    encoding the client accepts. The snapshot is rebuilt first if the maps changed since, for example by a script."""
+    versions, _ = table_state(MAPS_TABLES)
+    if read_snapshot(MAPS_VERSIONS_SNAPSHOT) != list(versions):
+        with _maps_snapshot_lock:
+            if read_snapshot(MAPS_VERSIONS_SNAPSHOT) != list(versions):
+                write_maps_snapshot()
+    path, encoding, etag = precompressed_snapshot(MAPS_SNAPSHOT, request.accept_encodings)
+    response = send_file(path, mimetype='application/json', etag=etag, conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+
+@api.route('exports/')
+def get_exports():
+    """Manifest of the bulk record exports, see qldf.exports"""
+    return jsonify(manifest())
+
+
+@api.route('exports/<filename>')
+def get_export(filename):
+    """Download a bulk record export file, resumable through range requests"""
+    local_file = export_file_path(filename)
+    if local_file is None:
+        abort(404)
+    path, sha256 = local_file
+    return send_file(path, mimetype='application/gzip', as_attachment=True, etag=sha256, conditional=True)
+
+
+@api.route('cache/')
+def get_cache_stats():
+    """Response and fragment cache statistics of every process serving pages, as last published by each of them,
+    see qldf.stats and root.views.cache_stats"""
+    return jsonify(published_stats('cache'))
+
+
+@api.route('http/')
+def get_http_stats():
+    """Outbound request statistics per host of every process running tasks, usually the worker, as published after
+    its last task run, see qldf.stats"""
+    return jsonify(published_stats('http'))
+
+
+@api.route('ready/')
+def get_readiness():
+    """Warm-up progress of this process, with status 503 until it is done, and the time each phase of starting took"""
+    status = current_app.warmup.status()
+    status['startup_ms'] = {name: round(ms, 1) for name, ms in current_app.startup_timings.ms.items()}
+    return jsonify(status), 200 if status['ready'] else 503
 
 
 @api.route('players/')
 def get_players():
-    pass
+    """Players ordered by id, streamed as json or ndjson. See stream_rows for pagination and format.
+    Query arguments:
+    player -- steam id of the player
+    map, mode, date_from, date_to -- only players with a record matching these, see filter_records"""
+    query = db.session.query(Player.id,
+                             Player.steam_id,
+                             Player.name,
+                             Player.record_count,
+                             Player.wr_count,
+                             Player.best_rank,
+                             Player.last_record_date)
+    if 'player' in request.args:
+        query = query.filter(Player.steam_id == request.args['player'])
+    if any(arg in request.args for arg in ('map', 'mode', 'date_from', 'date_to')):
+        records = db.session.query(Record.id).filter(Record.player_id == Player.id)
+        query = query.filter(filter_records(records).exists())
+    return stream_rows(query, Player.id, 'players')
 
 
 @api.route('records/')
 def get_records():
-    pass
+    """Records ordered by id, streamed as json or ndjson. See stream_rows for pagination and format
+    and filter_records for the filter arguments."""
+    query = db.session.query(Record.id,
+                             Map.name.label('map'),
+                             Record.mode,
+                             Player.steam_id.label('player_steam_id'),
+                             Player.name.label('player_name'),
+                             Record.time,
+                             Record.date,
+                             Record.rank,
+                             Record.match_guid).\
+        join(Map, Record.map_id == Map.id).\
+        join(Player, Record.player_id == Player.id)
+    if 'player' in request.args:
+        query = query.filter(Player.steam_id == request.args['player'])
+    return stream_rows(filter_records(query), Record.id, 'records')
+
+
+def filter_records(query):
+    """Filter a query on Record by the request arguments
+    map -- map name
+    mode -- record mode number, an index of RECORD_MODES
+    date_from, date_to -- iso formatted dates, records set on or after date_from and before date_to"""
+    args = request.args
+    if 'map' in args:
+        map_id = db.session.query(Map.id).filter(Map.name == args['map']).as_scalar()
+        query = query.filter(Record.map_id == map_id)
+    if 'mode' in args:
+        try:
+            mode = int(args['mode'])
+        except ValueError:
+            mode = -1
+        if not 0 <= mode < len(current_app.config['RECORD_MODES']):
+            bad_request(f"Unknown mode {args['mode']}")
+        query = query.filter(Record.mode == mode)
+    for arg, operator in (('date_from', '__ge__'), ('date_to', '__lt__')):
+        if arg in args:
+            try:
+                date = datetime.fromisoformat(args[arg])
+            except ValueError:
+                bad_request(f'{arg} is not an iso formatted date')
+            query = query.filter(getattr(Record.date, operator)(date))
+    return query
+
+
+def stream_rows(query, id_column, name):
+    """Stream a page of query results ordered by id_column from a server side cursor, so memory use does not
+    depend on the page size.
+    Query arguments:
+    after -- cursor from the previous page
+    limit -- rows per page, defaults to API_ROWS_PER_PAGE, at most API_MAX_ROWS_PER_PAGE
+    format -- json (default) or ndjson, ndjson is also selected by an Accept: application/x-ndjson header
+    The json response is an object {name: [rows], next_cursor: cursor or null}. The ndjson response has one row per
+    line, followed by a line {"next_cursor": cursor} if there are more rows."""
+    after = request.args.get('after')
+    if after:
+        try:
+            key = decode_cursor(after)
+        except ValueError:
+            bad_request(f'Malformed cursor {after}')
+        if len(key) != 1 or not isinstance(key[0], int):
+            bad_request(f'Malformed cursor {after}')
+        query = query.filter(id_column > key[0])
+    try:
+        limit = int(request.args.get('limit', current_app.config['API_ROWS_PER_PAGE']))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= current_app.config['API_MAX_ROWS_PER_PAGE']:
+        bad_request(f"limit has to be between 1 and {current_app.config['API_MAX_ROWS_PER_PAGE']}")
+    ndjson = request.args.get('format') == 'ndjson' or \
+        (not request.args.get('format') and request.accept_mimetypes.best == 'application/x-ndjson')
+    # One row past the page tells if there is a next page
+    rows = query.order_by(id_column).limit(limit + 1).yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        chunk = [] if ndjson else [f'{{"{name}":[']
+        next_cursor = None
+        for i, row in enumerate(rows):
+            if i == limit:
+                next_cursor = encode_cursor((last_id,))
+                break
+            line = json.dumps(row._asdict(), default=_json_default, separators=(',', ':'))
+            chunk.append(f'{line}\n' if ndjson else f',{line}' if i else line)
+            last_id = row.id
+            if len(chunk) >= STREAM_BATCH_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        if ndjson:
+            if next_cursor:
+                chunk.append(json.dumps({'next_cursor': next_cursor}) + '\n')
+        else:
+            chunk.append(f'],"next_cursor":{json.dumps(next_cursor)}}}')
+        yield ''.join(chunk)
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def bad_request(message):
+    abort(make_response(jsonify(error=message), 400))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value)} is not json serializable')
@@ -0,0 +1,98 @@
+"""Bulk loading of rows for scripts that fill the database in one go, like db_populate.
+
+Rows are streamed to the database BATCH_SIZE at a time with COPY on PostgreSQL or executemany on other backends.
+The caller assigns the ids, so nothing has to be read back, and resets the id sequences afterwards.
+The indexes of the loaded tables can be dropped during the load and created once at the end, which is much faster
+than maintaining them row by row. None of these functions commit."""
+import io
+import resource
+from contextlib import contextmanager
+
+from sqlalchemy import func
+
+from qldf import db
+
+BATCH_SIZE = 50000
+# Characters escaped in the COPY text format
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def load_rows(table, columns, rows, batch_size=BATCH_SIZE):
+    """Insert rows into table
+    Args:
+        table (sqlalchemy.Table): Table to insert into
+        columns (tuple): Names of the columns the values of each row are for
+        rows (iterable): Tuples of values, in the order of columns. Columns that are left out get their server default,
+            not the default of the model, so pass date_created and the like explicitly.
+        batch_size (int): Rows sent to the database at a time
+    Returns:
+        int: Number of rows inserted
+    """
+    insert_batch = _copy_batch if db.engine.dialect.name == 'postgresql' else _executemany_batch
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            insert_batch(table, columns, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        insert_batch(table, columns, batch)
+        count += len(batch)
+    return count
+
+
+def _copy_batch(table, columns, batch):
+    buffer = io.StringIO()
+    for row in batch:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN', buffer)
+    cursor.close()
+
+
+def _copy_value(value):
+    """Format value as a field of the COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.translate(COPY_ESCAPES)
+    return str(value)
+
+
+def _executemany_batch(table, columns, batch):
+    db.session.execute(table.insert(), [dict(zip(columns, row)) for row in batch])
+
+
+@contextmanager
+def deferred_indexes(*tables):
+    """Drop the indexes of tables and create them again when the block exits without error. Primary keys and unique
+    constraints are kept, unique indexes are dropped as well and so only checked at the end."""
+    connection = db.session.connection()
+    indexes = [index for table in tables for index in table.indexes]
+    for index in indexes:
+        connection.execute(f'DROP INDEX IF EXISTS {index.name}')
+    yield
+    for index in indexes:
+        index.create(bind=connection)
+
+
+def next_id(table):
+    """First id after the highest one in table"""
+    return (db.session.query(func.max(table.c.id)).scalar() or 0) + 1
+
+
+def reset_sequence(table):
+    """Make the id sequence of table continue after its highest id, needed after inserting rows with given ids"""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                           f"coalesce(max(id), 0) + 1, false) FROM {table.name}")
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MiB"""
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
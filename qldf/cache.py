@@ -0,0 +1,171 @@
+"""In-process cache of rendered pages and conditional GET support.
+
+Entries are keyed by endpoint, view arguments and query arguments and store the versions of the tables the page
+was rendered from. A table version is bumped through DataVersion.bump whenever a task or script writes to it,
+so an entry is only served while none of the tables it depends on changed.
+The same versions and the time they were last bumped are sent as ETag and Last-Modified, so clients can revalidate
+a page with a 304 response without it being rendered. Pages embed a csrf token that expires after
+WTF_CSRF_TIME_LIMIT, so the validators also change every half of that time and a revalidated page never holds a token
+that is about to expire."""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from time import time
+
+from flask import current_app, request, session, g, make_response
+from flask_wtf.csrf import generate_csrf
+from werkzeug.http import is_resource_modified
+
+from qldf.models import DataVersion
+
+# Stands in for the per-session csrf token of the search form in cached pages
+CSRF_TOKEN_PLACEHOLDER = '__CSRF_TOKEN__'
+
+
+class RenderCache:
+    """Size bounded LRU cache of rendered pages or page fragments, each stored with the versions of the data it was
+    rendered from. Safe to use from multiple threads."""
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, versions):
+        """Get the entry stored under key if it was rendered from the given versions, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != versions:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, versions, page, max_size):
+        with self._lock:
+            self._entries[key] = (versions, page)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+response_cache = RenderCache()
+
+
+def conditional(*table_names):
+    """Add ETag and Last-Modified headers derived from the versions of the given tables to GET responses
+    of the decorated view, and answer requests whose validators still match with 304 Not Modified.
+    The ETag is weak because the page body differs in its render time. Pages with pending flash messages get no
+    validators, a 304 would drop the messages and a later 304 would serve the page that showed them."""
+    def decorator(wrapped_function):
+        @wraps(wrapped_function)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return wrapped_function(*args, **kwargs)
+            versions, last_modified = table_state(table_names)
+            token_period = _csrf_token_period()
+            if token_period:
+                last_modified = max(last_modified, token_period) if last_modified else token_period
+            etag = _etag(versions, token_period)
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response(wrapped_function(*args, **kwargs))
+            else:
+                response = current_app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # Revalidate on every use, pages contain a per session csrf token
+            response.cache_control.no_cache = True
+            response.cache_control.private = True
+            return response
+        return wrapper
+    return decorator
+
+
+def cached(*table_names):
+    """Serve GET requests of the decorated view from the response cache while the given tables are unchanged.
+    Implies conditional. Use below search_form, the view has to return the rendered page as a string."""
+    def decorator(wrapped_function):
+        @conditional(*table_names)
+        @wraps(wrapped_function)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return wrapped_function(*args, **kwargs)
+            key = (request.endpoint,
+                   tuple(sorted(request.view_args.items())),
+                   tuple(sorted(request.args.items(multi=True))))
+            versions, _ = table_state(table_names)
+            page = response_cache.get(key, versions)
+            if page is None:
+                page = wrapped_function(*args, **kwargs)
+                if current_app.config.get('WTF_CSRF_ENABLED', True):
+                    page = page.replace(generate_csrf(), CSRF_TOKEN_PLACEHOLDER)
+                response_cache.set(key, versions, page, current_app.config['RESPONSE_CACHE_SIZE'])
+            if current_app.config.get('WTF_CSRF_ENABLED', True):
+                page = page.replace(CSRF_TOKEN_PLACEHOLDER, generate_csrf())
+            return page
+        return wrapper
+    return decorator
+
+
+def table_state(table_names):
+    """Get the versions of the given tables and the last time any of them changed.
+    The data versions are read from the database once per request.
+    Returns:
+        tuple: (tuple of versions, datetime or None)
+    """
+    if 'data_versions' not in g:
+        g.data_versions = DataVersion.current()
+    states = [g.data_versions.get(table_name, (0, None)) for table_name in table_names]
+    versions = tuple(version for version, _ in states)
+    dates = [date_modified for _, date_modified in states if date_modified]
+    return versions, max(dates) if dates else None
+
+
+def _etag(versions, token_period=None):
+    """ETag for a request to the current endpoint given the versions of the tables it shows and the start of the
+    current csrf token period"""
+    key = f'{request.endpoint}:{_templates_digest()}:{versions}:{token_period}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _csrf_token_period():
+    """Start of the current period of half the csrf token lifetime as a naive UTC datetime, or None if pages hold no
+    expiring token"""
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not current_app.config.get('WTF_CSRF_ENABLED', True) or not time_limit:
+        return None
+    period = max(time_limit // 2, 1)
+    return datetime.utcfromtimestamp(time() // period * period)
+
+
+_templates_digest_value = None
+
+
+def _templates_digest():
+    """Digest of the application templates, so ETags change when a deploy changes the page layout"""
+    global _templates_digest_value
+    if _templates_digest_value is None:
+        digest = hashlib.sha1()
+        package_folder = os.path.dirname(__file__)
+        for folder, _, filenames in sorted(os.walk(package_folder)):
+            for filename in sorted(filenames):
+                if filename.endswith('.j2'):
+                    with open(os.path.join(folder, filename), 'rb') as f:
+                        digest.update(f.read())
+        _templates_digest_value = digest.hexdigest()
+    return _templates_digest_value
@@ -0,0 +1,83 @@
+"""Resumable fetching for the scripts that download everything at once, like db_populate.
+
+fetch_with_checkpoints fetches a list of keys on a bounded thread pool and saves the result of every key to its own
+checkpoint file as soon as it arrives. A run that crashes or is interrupted only loses the fetches in flight, the next
+run fetches just the keys without a checkpoint. Results are read back in the order of the keys, so the output does not
+depend on the order the fetches completed in and is the same as that of a serial run."""
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter
+from urllib.parse import quote
+
+# Fetches running at the same time
+CONCURRENCY = 8
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+
+def fetch_with_checkpoints(keys, fetch, folder, concurrency=CONCURRENCY, label='items'):
+    """Call fetch(key) for every key without a checkpoint in folder and save the results as checkpoints.
+    Progress and throughput are printed every PROGRESS_INTERVAL seconds.
+    Args:
+        keys (list): Keys to fetch, str or int
+        fetch (callable): Gets the json serializable result of a key
+        folder (str): Checkpoint folder, created if needed
+        concurrency (int): Number of fetches running at the same time
+        label (str): Name of what is fetched in the progress lines
+    Returns:
+        list: Keys whose fetch failed, run again to retry them
+    """
+    os.makedirs(folder, exist_ok=True)
+    todo = [key for key in keys if not os.path.exists(checkpoint_path(folder, key))]
+    if len(todo) < len(keys):
+        print(f'{label}: resuming, {len(keys) - len(todo)} of {len(keys)} fetched already')
+    failed = []
+    done = 0
+    start = last_progress = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_fetch_checkpoint, fetch, folder, key): key for key in todo}
+        try:
+            for future in as_completed(futures):
+                done += 1
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    print(f'{label}: failed to fetch {futures[future]}: {e!r}', file=sys.stderr)
+                now = perf_counter()
+                if now - last_progress >= PROGRESS_INTERVAL or done == len(todo):
+                    last_progress = now
+                    rate = done / (now - start)
+                    print(f'{label}: {done}/{len(todo)} fetched, {rate:.1f}/s, {(len(todo) - done) / rate:.0f} s left')
+        except BaseException:
+            # Don't start the queued fetches when interrupted, the checkpoints so far are kept
+            for future in futures:
+                future.cancel()
+            raise
+    return failed
+
+
+def _fetch_checkpoint(fetch, folder, key):
+    result = fetch(key)
+    path = checkpoint_path(folder, key)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+
+def checkpoint_path(folder, key):
+    return os.path.join(folder, quote(str(key), safe='') + '.json')
+
+
+def read_checkpoint(folder, key):
+    """Get the saved result of key"""
+    with open(checkpoint_path(folder, key), 'r') as f:
+        return json.load(f)
+
+
+def remove_checkpoints(folder):
+    """Remove folder and its checkpoints, once their results are combined"""
+    shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,311 @@
+"""Bulk exports of every record for people mirroring the data, so they don't have to page through the site or api.
+
+write_record_exports writes the following files to EXPORT_FOLDER:
+records.ndjson.gz, records.csv.gz -- every record with its map and player names and rank
+records.columns.gz -- every record as typed little endian arrays, see write_columns
+records-<yyyy-mm-dd>.ndjson.gz, records-<yyyy-mm-dd>.csv.gz -- records created on that day (by date_created),
+    for the last EXPORT_DELTA_DAYS complete days
+and publishes them in the database, as ExportFile and ExportChunk rows, in a single transaction. The manifest lists
+every published file with its size, sha256 and number of records. A process that serves a file it did not write, such
+as a web process while the tasks run in a worker, copies it from the database to its own EXPORT_FOLDER first, so every
+process serves the same files.
+Every file is written under a temporary name and renamed into place, so downloads never see a partial file."""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from qldf import db
+from qldf.models import Record, Map, Player, ExportFile, ExportChunk, DataVersion
+
+FULL_PREFIX = 'records'
+DELTA_PREFIX = 'records-'
+# Rows fetched from the database cursor at a time
+BATCH_SIZE = 5000
+# Bytes of a file stored per ExportChunk row
+CHUNK_SIZE = 1024 * 1024
+FIELDS = ('id', 'map', 'mode', 'player_steam_id', 'player_name', 'time', 'date', 'rank', 'match_guid', 'date_created')
+# (name, array typecode, type name in the header) of the columns in records.columns.gz
+COLUMNS = (('id', 'i', 'int32'),
+           ('map_id', 'i', 'int32'),
+           ('player_id', 'i', 'int32'),
+           ('mode', 'b', 'int8'),
+           ('time', 'i', 'int32'),
+           ('rank', 'i', 'int32'),
+           ('date', 'q', 'int64'))
+
+# {path: (file identity, sha256 hex digest)} of the files in EXPORT_FOLDER
+_digests = {}
+_copy_lock = threading.Lock()
+
+
+def export_folder():
+    return current_app.config['EXPORT_FOLDER']
+
+
+def write_record_exports():
+    """Write the full dumps and the missing daily deltas, publish them together with the removal of expired deltas and
+    commit"""
+    folder = export_folder()
+    os.makedirs(folder, exist_ok=True)
+    published = {entry['name']: entry for entry in read_manifest()}
+    entries = write_full_exports()
+    today = datetime.utcnow().date()
+    delta_days = [today - timedelta(days=days_ago) for days_ago in range(1, current_app.config['EXPORT_DELTA_DAYS'] + 1)]
+    for day in delta_days:
+        if f'{DELTA_PREFIX}{day.isoformat()}.ndjson.gz' not in published:
+            entries.extend(write_delta_exports(day))
+    for entry in entries:
+        if published.get(entry['name'], {}).get('sha256') != entry['sha256']:
+            store_export_file(entry)
+    db.session.query(ExportFile).\
+        filter(ExportFile.day.isnot(None)).\
+        filter(ExportFile.day.notin_(delta_days)).\
+        delete(synchronize_session=False)
+    DataVersion.bump(ExportFile.__tablename__)
+    db.session.commit()
+    keep_days = set(day.isoformat() for day in delta_days)
+    for filename in os.listdir(folder):
+        day = delta_day(filename)
+        if day and day not in keep_days:
+            os.remove(os.path.join(folder, filename))
+
+
+def write_full_exports():
+    """Write every record as ndjson, csv and columns in a single pass over a server side cursor
+    Returns:
+        list: Manifest entries of the written files
+    """
+    folder = export_folder()
+    columns = {name: array(typecode) for name, typecode, _ in COLUMNS}
+    maps = {}
+    players = {}
+    ndjson_path = os.path.join(folder, f'{FULL_PREFIX}.ndjson.gz')
+    csv_path = os.path.join(folder, f'{FULL_PREFIX}.csv.gz')
+    with atomic_open(ndjson_path, 'wt', compress=True) as ndjson_file, \
+            atomic_open(csv_path, 'wt', compress=True) as csv_file:
+        csv_writer = write_rows_header(csv_file)
+        for row in records_query().yield_per(BATCH_SIZE):
+            write_row(row, ndjson_file, csv_writer)
+            maps[row.map_id] = row.map
+            players[row.player_id] = [row.player_steam_id, row.player_name]
+            columns['id'].append(row.id)
+            columns['map_id'].append(row.map_id)
+            columns['player_id'].append(row.player_id)
+            columns['mode'].append(row.mode)
+            columns['time'].append(row.time)
+            columns['rank'].append(row.rank or 0)
+            columns['date'].append(int((row.date - datetime(1970, 1, 1)).total_seconds()))
+    columns_path = os.path.join(folder, f'{FULL_PREFIX}.columns.gz')
+    write_columns(columns_path, columns, maps, players)
+    count = len(columns['id'])
+    return [manifest_entry(path, count) for path in (ndjson_path, csv_path, columns_path)]
+
+
+def write_delta_exports(day):
+    """Write the records created on day as ndjson and csv
+    Returns:
+        list: Manifest entries of the written files
+    """
+    folder = export_folder()
+    start = datetime(day.year, day.month, day.day)
+    query = records_query().\
+        filter(Record.date_created >= start).\
+        filter(Record.date_created < start + timedelta(days=1))
+    ndjson_path = os.path.join(folder, f'{DELTA_PREFIX}{day.isoformat()}.ndjson.gz')
+    csv_path = os.path.join(folder, f'{DELTA_PREFIX}{day.isoformat()}.csv.gz')
+    count = 0
+    with atomic_open(ndjson_path, 'wt', compress=True) as ndjson_file, \
+            atomic_open(csv_path, 'wt', compress=True) as csv_file:
+        csv_writer = write_rows_header(csv_file)
+        for row in query.yield_per(BATCH_SIZE):
+            write_row(row, ndjson_file, csv_writer)
+            count += 1
+    return [dict(manifest_entry(path, count), date=day.isoformat()) for path in (ndjson_path, csv_path)]
+
+
+def records_query():
+    return db.session.query(Record.id,
+                            Record.map_id,
+                            Map.name.label('map'),
+                            Record.player_id,
+                            Player.steam_id.label('player_steam_id'),
+                            Player.name.label('player_name'),
+                            Record.mode,
+                            Record.time,
+                            Record.date,
+                            Record.rank,
+                            Record.match_guid,
+                            Record.date_created).\
+        join(Map, Record.map_id == Map.id).\
+        join(Player, Record.player_id == Player.id).\
+        order_by(Record.id)
+
+
+def write_rows_header(csv_file):
+    csv_writer = csv.writer(csv_file)
+    csv_writer.writerow(FIELDS)
+    return csv_writer
+
+
+def write_row(row, ndjson_file, csv_writer):
+    values = [getattr(row, field) for field in FIELDS]
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    ndjson_file.write(json.dumps(dict(zip(FIELDS, values)), separators=(',', ':')))
+    ndjson_file.write('\n')
+    csv_writer.writerow(values)
+
+
+def write_columns(path, columns, maps, players):
+    """Write the columns as a gzip compressed file of a json header line followed by the raw column arrays.
+    The header holds the number of rows, the name and type of each column in the order they follow, and the names
+    of the maps and players by id. Integers are little endian, an unranked record has rank 0 and dates are seconds
+    since the unix epoch (UTC)."""
+    header = {'rows': len(columns['id']),
+              'columns': [{'name': name, 'type': type_name} for name, _, type_name in COLUMNS],
+              'maps': maps,
+              'players': players}
+    with atomic_open(path, 'wb', compress=True) as f:
+        f.write(json.dumps(header, separators=(',', ':')).encode())
+        f.write(b'\n')
+        for name, _, _ in COLUMNS:
+            column = columns[name]
+            if sys.byteorder == 'big':
+                column.byteswap()
+            f.write(column.tobytes())
+
+
+def read_manifest():
+    """Get the entries of the published files, ordered by name"""
+    rows = db.session.query(ExportFile.name,
+                            ExportFile.size,
+                            ExportFile.sha256,
+                            ExportFile.records,
+                            ExportFile.day).\
+        order_by(ExportFile.name)
+    entries = []
+    for row in rows:
+        entry = {'name': row.name, 'size': row.size, 'sha256': row.sha256, 'records': row.records}
+        if row.day:
+            entry['date'] = row.day.isoformat()
+        entries.append(entry)
+    return entries
+
+
+def manifest():
+    """The manifest served by the exports api: when the files were last published and their entries"""
+    _, date_published = DataVersion.current().get(ExportFile.__tablename__, (0, None))
+    return {'date_created': date_published.isoformat() if date_published else None,
+            'files': read_manifest()}
+
+
+def store_export_file(entry):
+    """Publish the file in EXPORT_FOLDER of manifest entry, replacing a published file of the same name. Does not
+    commit."""
+    db.session.query(ExportFile).filter(ExportFile.name == entry['name']).delete(synchronize_session=False)
+    statement = ExportFile.__table__.insert().\
+        values(name=entry['name'],
+               size=entry['size'],
+               sha256=entry['sha256'],
+               records=entry['records'],
+               day=entry.get('date')).\
+        returning(ExportFile.__table__.c.id)
+    export_file_id = db.session.execute(statement).scalar()
+    with open(os.path.join(export_folder(), entry['name']), 'rb') as f:
+        for seq, data in enumerate(iter(lambda: f.read(CHUNK_SIZE), b'')):
+            db.session.execute(ExportChunk.__table__.insert().values(export_file_id=export_file_id, seq=seq, data=data))
+
+
+def export_file_path(name):
+    """Get the local copy of the published file name, copied from the database first if this process has none or an
+    outdated one
+    Returns:
+        tuple: (path, sha256 hex digest) or None if no such file is published
+    """
+    row = db.session.query(ExportFile.id, ExportFile.sha256).filter(ExportFile.name == name).first()
+    if row is None:
+        return None
+    path = os.path.join(export_folder(), name)
+    if file_digest(path) != row.sha256:
+        with _copy_lock:
+            if file_digest(path) != row.sha256:
+                os.makedirs(export_folder(), exist_ok=True)
+                chunks = db.session.query(ExportChunk.data).\
+                    filter(ExportChunk.export_file_id == row.id).\
+                    order_by(ExportChunk.seq)
+                with atomic_open(path, 'wb') as f:
+                    for chunk in chunks.yield_per(1):
+                        f.write(chunk.data)
+        # The file was replaced by a newer one while it was being copied
+        if file_digest(path) != row.sha256:
+            return None
+    return path, row.sha256
+
+
+def file_digest(path):
+    """sha256 of the file at path, cached until the file is replaced, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _digests.get(path)
+    if cached and cached[0] == identity:
+        return cached[1]
+    digest = sha256_digest(path)
+    _digests[path] = (identity, digest)
+    return digest
+
+
+def sha256_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def manifest_entry(path, count):
+    return {'name': os.path.basename(path),
+            'size': os.path.getsize(path),
+            'sha256': file_digest(path),
+            'records': count}
+
+
+def delta_day(filename):
+    """Day of a delta export file name as iso formatted string, or None if filename is not a delta"""
+    if filename.startswith(DELTA_PREFIX) and filename.endswith('.gz'):
+        return filename[len(DELTA_PREFIX):].split('.')[0]
+    return None
+
+
+@contextmanager
+def atomic_open(path, mode, compress=False):
+    """Open a temporary file, gzip compressed if compress, that replaces path when the block exits without error.
+    Compressed files get no name or time in their gzip header, so the same contents always give the same file."""
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        if compress:
+            with open(temp_path, 'wb') as raw_file, \
+                    gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=raw_file, mtime=0) as gzip_file:
+                if 't' in mode:
+                    with io.TextIOWrapper(gzip_file, encoding='utf-8', newline='') as f:
+                        yield f
+                else:
+                    yield gzip_file
+        else:
+            with open(temp_path, mode, **({'encoding': 'utf-8', 'newline': ''} if 'b' not in mode else {})) as f:
+                yield f
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
@@ -0,0 +1,119 @@
+"""Shared HTTP client of the tasks and scripts.
+
+Connections are pooled and kept alive per host, responses are requested gzip compressed and every request has
+connect and read timeouts. Conditional GETs remember the ETag and Last-Modified validators per url, so a page that
+did not change since it was last fetched comes back as 304 Not Modified and can be skipped.
+Requests, bytes received and time spent are counted per host."""
+import threading
+from time import perf_counter
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = 'qldf.com worker'
+# Seconds to wait for a connection and between bytes of the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Connections kept open per host, at least the number of threads fetching from the same host
+POOL_SIZE = 16
+
+
+class HttpClient:
+    def __init__(self, user_agent=USER_AGENT, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': user_agent,
+                                     'Accept-Encoding': 'gzip, deflate'})
+        # {url: (etag, last modified)}
+        self._validators = {}
+        # {host: {requests, not_modified, errors, bytes, seconds}}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, conditional=False, headers=None):
+        """GET url, raises requests.RequestException on connection errors, timeouts and error statuses
+        Args:
+            url (str): Url to get
+            params (dict): Query arguments to add to url
+            conditional (bool): Send the validators of the previous response to url and remember the new ones
+            headers (dict): Extra request headers
+        Returns:
+            requests.Response, or None if conditional and the response is 304 Not Modified
+        """
+        headers = dict(headers or {})
+        key = requests.Request('GET', url, params=params).prepare().url
+        if conditional:
+            etag, last_modified = self._validators.get(key, (None, None))
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        host = urlparse(url).netloc
+        start = perf_counter()
+        try:
+            response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            content = response.content
+        except requests.RequestException:
+            self._count(host, perf_counter() - start, 0, error=True)
+            raise
+        received = response.raw.tell() if hasattr(response.raw, 'tell') else len(content)
+        self._count(host, perf_counter() - start, received,
+                    not_modified=response.status_code == 304, error=response.status_code >= 400)
+        if response.status_code == 304 and conditional:
+            return None
+        response.raise_for_status()
+        if conditional:
+            validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            with self._lock:
+                if any(validators):
+                    self._validators[key] = validators
+                else:
+                    self._validators.pop(key, None)
+        return response
+
+    def get_text(self, url, params=None, conditional=False):
+        """Get the decoded body of url, or None if conditional and it did not change"""
+        response = self.get(url, params, conditional)
+        return None if response is None else response.text
+
+    def get_json(self, url, params=None, conditional=False):
+        """Get the json decoded body of url, or None if conditional and it did not change"""
+        response = self.get(url, params, conditional, headers={'Accept': 'application/json'})
+        return None if response is None else response.json()
+
+    def forget(self, url, params=None):
+        """Drop the validators of url, so the next conditional GET fetches it in full"""
+        with self._lock:
+            self._validators.pop(requests.Request('GET', url, params=params).prepare().url, None)
+
+    def stats(self):
+        """Request statistics per host
+        Returns:
+            dict: {host: {requests, not_modified, errors, bytes, seconds, mean_ms}}
+        """
+        with self._lock:
+            return {host: dict(stats, mean_ms=round(stats['seconds'] * 1000 / stats['requests'], 1))
+                    for host, stats in self._stats.items()}
+
+    def summary(self):
+        """Request statistics as one line per host, for logs and script output"""
+        return '\n'.join(f"{host}: {stats['requests']} requests ({stats['not_modified']} not modified, "
+                         f"{stats['errors']} errors), {stats['bytes'] / 1024:.0f} KiB, {stats['mean_ms']} ms mean"
+                         for host, stats in sorted(self.stats().items()))
+
+    def _count(self, host, seconds, received, not_modified=False, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(host, {'requests': 0, 'not_modified': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['not_modified'] += not_modified
+            stats['errors'] += error
+            stats['bytes'] += received
+            stats['seconds'] += seconds
+
+
+# Client shared by everything in this process
+http_client = HttpClient()
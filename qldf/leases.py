@@ -0,0 +1,90 @@
+"""Leases in the database that let a single process in the whole deployment run a task at a time.
+
+A process that wants to run a task takes its lease, a task_lease row that is free when it expired. While the task runs a
+heartbeat thread renews the lease every third of TASK_LEASE_SECONDS, so a process that dies only blocks the task until
+its lease expires. Leases are taken and renewed on their own connections and committed at once, apart from the
+transactions of the task itself."""
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from uuid import uuid4
+
+from sqlalchemy.dialects.postgresql import insert
+
+from qldf import db
+from qldf.models import TaskLease, utcnow
+
+
+class Lease:
+    """Lease on running the task task_name for seconds at a time"""
+    def __init__(self, task_name, seconds):
+        self.task_name = task_name
+        self.seconds = seconds
+        # Unique per run, so a process can't mistake the lease of an earlier run of the task for its own
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex}'
+        self._released = threading.Event()
+
+    def acquire(self):
+        """Take the lease if it is free and start renewing it
+        Returns:
+            bool: Whether the lease was taken
+        """
+        statement = insert(TaskLease).values(task_name=self.task_name, owner=self.owner, expires_at=self._expires_at())
+        statement = statement.on_conflict_do_update(index_elements=[TaskLease.task_name],
+                                                    set_={'owner': statement.excluded.owner,
+                                                          'expires_at': statement.excluded.expires_at,
+                                                          'date_modified': utcnow()},
+                                                    where=TaskLease.expires_at <= utcnow()).\
+            returning(TaskLease.owner)
+        with db.engine.begin() as connection:
+            acquired = connection.execute(statement).first() is not None
+        if acquired:
+            threading.Thread(target=self._heartbeat, name=f'lease-{self.task_name}', daemon=True).start()
+        return acquired
+
+    def renew(self):
+        """Extend the lease by seconds from now
+        Returns:
+            bool: Whether the lease was still held
+        """
+        with db.engine.begin() as connection:
+            return self._update(connection, self._expires_at()) > 0
+
+    def release(self):
+        """Stop renewing the lease and free it for the next run"""
+        self._released.set()
+        with db.engine.begin() as connection:
+            self._update(connection, utcnow())
+
+    def _update(self, connection, expires_at):
+        statement = TaskLease.__table__.update().\
+            where(TaskLease.task_name == self.task_name).\
+            where(TaskLease.owner == self.owner).\
+            values(expires_at=expires_at, date_modified=utcnow())
+        return connection.execute(statement).rowcount
+
+    def _expires_at(self):
+        return utcnow() + timedelta(seconds=self.seconds)
+
+    def _heartbeat(self):
+        while not self._released.wait(self.seconds / 3):
+            if not self.renew():
+                return
+
+
+@contextmanager
+def task_lease(task_name, seconds):
+    """Hold the lease on running task_name for the duration of the with block
+    Yields:
+        bool: Whether the lease was taken, if not another process is running the task
+    """
+    lease = Lease(task_name, seconds)
+    if not lease.acquire():
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        lease.release()
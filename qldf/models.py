@@ -1,8 +1,12 @@
+import re
+
 from qldf import db
 from flask import flash
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm import validates
 from sqlalchemy.orm.exc import UnmappedInstanceError
 from sqlalchemy.sql import expression
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.types import DateTime
 
@@ -27,6 +31,7 @@ class BaseModel(db.Model):
         new_record = cls(**kwargs)
         try:
             db.session.add(new_record)
+            DataVersion.bump(cls.__tablename__)
             db.session.commit()
             if success_msg:
                 flash(success_msg)
@@ -40,6 +45,7 @@ class BaseModel(db.Model):
         existing_record = cls.query.filter_by(**kwargs).first()
         try:
             db.session.delete(existing_record)
+            DataVersion.bump(cls.__tablename__)
             db.session.commit()
             if success_msg:
                 flash(success_msg)
@@ -55,10 +61,39 @@ class BaseModel(db.Model):
 
 class Player(BaseModel):
     __tablename__ = 'player'
+    __table_args__ = (db.Index('ix_player_record_count_id', 'record_count', 'id'),
+                      db.Index('ix_player_wr_count_id', 'wr_count', 'id'),
+                      db.Index('ix_player_best_rank_id', 'best_rank', 'id'),
+                      db.Index('ix_player_last_record_date_id', 'last_record_date', 'id'),
+                      db.Index('ix_player_name_id', 'name', 'id'),
+                      db.Index('ix_player_search_name_trgm', 'search_name',
+                               postgresql_using='gin', postgresql_ops={'search_name': 'gin_trgm_ops'}))
     name = db.Column(db.Text, nullable=False)
+    # Lowercase name without quake color codes, set whenever name is set. Has a trigram index for substring search.
+    search_name = db.Column(db.Text)
     steam_id = db.Column(db.Text, unique=True, nullable=False, index=True)
     records = db.relationship('Record', backref='player', lazy=True)
     avatar_url = db.Column(db.Text)
+    # Record statistics, maintained by qldf.aggregates
+    record_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    wr_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    best_rank = db.Column(db.Integer)
+    last_record_date = db.Column(db.DateTime)
+    # Digest of the name and avatar last fetched from the steam profile, see tasks.update_players
+    profile_digest = db.Column(db.Text)
+    # When the profile is due to be fetched again and the seconds between fetches, see qldf.refresh
+    next_refresh_at = db.Column(db.DateTime, index=True)
+    refresh_interval = db.Column(db.Integer)
+
+    @validates('name')
+    def validate_name(self, key, name):
+        self.search_name = self.make_search_name(name)
+        return name
+
+    @staticmethod
+    def make_search_name(name):
+        """Convert a (player) name to the form stored in search_name"""
+        return re.sub(r'\^[0-9]', '', name).lower()
 
     def __repr__(self):
         return f'<Player {self.id}>'
@@ -66,22 +101,108 @@ class Player(BaseModel):
 
 class Record(BaseModel):
     __tablename__ = 'record'
+    __table_args__ = (db.Index('ix_record_map_id_mode_time', 'map_id', 'mode', 'time'),
+                      # Keyset pagination of the record listings, (sort column, id) and the same per map and player
+                      db.Index('ix_record_date_id', 'date', 'id'),
+                      db.Index('ix_record_time_id', 'time', 'id'),
+                      db.Index('ix_record_rank_id', 'rank', 'id'),
+                      db.Index('ix_record_mode_id', 'mode', 'id'),
+                      db.Index('ix_record_map_id_rank_id', 'map_id', 'rank', 'id'),
+                      db.Index('ix_record_player_id_date_id', 'player_id', 'date', 'id'),
+                      # Daily delta exports
+                      db.Index('ix_record_date_created', 'date_created'),
+                      # A player sets at most one record per match, ingest_records skips records it already has
+                      db.Index('ix_record_match_guid_player_id', 'match_guid', 'player_id', unique=True))
     mode = db.Column(db.Integer, nullable=False)
     map_id = db.Column(db.Integer, db.ForeignKey('map.id'), index=True, nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'), index=True, nullable=False)
     time = db.Column(db.Integer, nullable=False)
     match_guid = db.Column(db.Text, nullable=False)
     date = db.Column(db.DateTime, nullable=False)
+    # Rank of the record within its (map_id, mode) partition, maintained by qldf.aggregates
+    rank = db.Column(db.Integer)
+
+    @classmethod
+    def create(cls, success_msg=None, failure_msg=None, **kwargs):
+        """Insert a record and update the ranks, world record and player statistics in the same transaction"""
+        from qldf.aggregates import update_partitions
+        new_record = cls(**kwargs)
+        try:
+            db.session.add(new_record)
+            db.session.flush()
+            update_partitions([(new_record.map_id, new_record.mode)])
+            db.session.commit()
+            if success_msg:
+                flash(success_msg)
+        except (IntegrityError, InvalidRequestError):
+            db.session.rollback()
+            if failure_msg:
+                flash(failure_msg)
+
+    @classmethod
+    def delete(cls, success_msg=None, unmapped_msg=None, failure_msg=None, **kwargs):
+        """Delete a record and update the ranks, world record and player statistics in the same transaction"""
+        from qldf.aggregates import update_partitions
+        existing_record = cls.query.filter_by(**kwargs).first()
+        try:
+            partition = (existing_record.map_id, existing_record.mode) if existing_record else None
+            player_id = existing_record.player_id if existing_record else None
+            db.session.delete(existing_record)
+            db.session.flush()
+            update_partitions([partition], [player_id])
+            db.session.commit()
+            if success_msg:
+                flash(success_msg)
+        except UnmappedInstanceError:
+            db.session.rollback()
+            if unmapped_msg:
+                flash(unmapped_msg)
+        except IntegrityError:
+            db.session.rollback()
+            if failure_msg:
+                flash(failure_msg)
 
     def __repr__(self):
         return f'<Record {self.id}>'
 
 
+class WorldRecord(BaseModel):
+    """The record currently holding rank 1 on a map and mode, maintained by qldf.aggregates
+    When several records share the best time the oldest one holds the world record."""
+    __tablename__ = 'world_record'
+    __table_args__ = (db.UniqueConstraint('map_id', 'mode'),)
+    map_id = db.Column(db.Integer, db.ForeignKey('map.id'), nullable=False)
+    mode = db.Column(db.Integer, nullable=False)
+    record_id = db.Column(db.Integer, db.ForeignKey('record.id', ondelete='CASCADE'), index=True, nullable=False)
+    record = db.relationship('Record')
+
+    def __repr__(self):
+        return f'<WorldRecord {self.id}>'
+
+
+class RecordWatermark(BaseModel):
+    """Date of the newest record ingested from qlrace.com per map and mode, maintained by tasks.ingest_records"""
+    __tablename__ = 'record_watermark'
+    __table_args__ = (db.UniqueConstraint('map_id', 'mode'),)
+    map_id = db.Column(db.Integer, db.ForeignKey('map.id', ondelete='CASCADE'), nullable=False)
+    mode = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<RecordWatermark {self.id}>'
+
+
 class Map(BaseModel):
     __tablename__ = 'map'
+    __table_args__ = (db.Index('ix_map_record_count_id', 'record_count', 'id'),
+                      db.Index('ix_map_name_id', 'name', 'id'),
+                      db.Index('ix_map_name_trgm', 'name',
+                               postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}))
     name = db.Column(db.Text, nullable=False, unique=True)
     records = db.relationship('Record', backref='map', lazy=True)
     workshop_item_id = db.Column(db.Integer, db.ForeignKey('workshop_item.id'), index=True)
+    # Number of records on the map, maintained by qldf.aggregates
+    record_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f'<Map {self.id}>'
@@ -99,6 +220,11 @@ class WorkshopItem(BaseModel):
     score = db.Column(db.Integer)
     num_scores = db.Column(db.Integer)
     preview_url = db.Column(db.Text)
+    # Digest of the workshop page the item was last updated from, see tasks.update_workshop_items
+    page_digest = db.Column(db.Text)
+    # When the page is due to be fetched again and the seconds between fetches, see qldf.refresh
+    next_refresh_at = db.Column(db.DateTime, index=True)
+    refresh_interval = db.Column(db.Integer)
     maps = db.relationship('Map', backref='workshop_item', lazy=True)
 
     def __repr__(self):
@@ -123,3 +249,85 @@ class Server(BaseModel):
 
     def __repr__(self):
         return f'<Server {self.id}>'
+
+
+class ExportFile(BaseModel):
+    """A bulk record export file published by qldf.exports, with its manifest entry. The contents are stored in
+    ExportChunk rows, so every process serves the same files whichever process wrote them."""
+    __tablename__ = 'export_file'
+    name = db.Column(db.Text, unique=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.Text, nullable=False)
+    records = db.Column(db.Integer, nullable=False)
+    # Day of the records in a daily delta, None for the full dumps
+    day = db.Column(db.Date)
+
+    def __repr__(self):
+        return f'<ExportFile {self.id}>'
+
+
+class ExportChunk(BaseModel):
+    """A piece of the contents of an export file, the pieces in order of seq make up the file"""
+    __tablename__ = 'export_chunk'
+    __table_args__ = (db.UniqueConstraint('export_file_id', 'seq'),)
+    export_file_id = db.Column(db.Integer, db.ForeignKey('export_file.id', ondelete='CASCADE'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<ExportChunk {self.id}>'
+
+
+class DataVersion(BaseModel):
+    """Counter per table that is incremented whenever the data in it changes, used to invalidate cached pages.
+    date_modified is the last time the table changed."""
+    __tablename__ = 'data_version'
+    table_name = db.Column(db.Text, unique=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, *table_names):
+        """Increment the version of every table in table_names, does not commit"""
+        for table_name in table_names:
+            statement = insert(cls).\
+                values(table_name=table_name, version=1).\
+                on_conflict_do_update(index_elements=[cls.table_name],
+                                      set_={'version': cls.version + 1,
+                                            'date_modified': utcnow()})
+            db.session.execute(statement)
+
+    @classmethod
+    def current(cls):
+        """Get the current versions and modification times as a dict {table_name: (version, date_modified)}"""
+        return {row.table_name: (row.version, row.date_modified)
+                for row in db.session.query(cls.table_name, cls.version, cls.date_modified)}
+
+    def __repr__(self):
+        return f'<DataVersion {self.id}>'
+
+
+class TaskLease(BaseModel):
+    """Lease on running a task, held by a single process in the deployment at a time, see qldf.leases"""
+    __tablename__ = 'task_lease'
+    task_name = db.Column(db.Text, unique=True, nullable=False)
+    # Process and run holding the lease
+    owner = db.Column(db.Text, nullable=False)
+    # The lease is free once this has passed
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<TaskLease {self.id}>'
+
+
+class ProcessStats(BaseModel):
+    """Statistics of one kind published by a process in the deployment, see qldf.stats"""
+    __tablename__ = 'process_stats'
+    __table_args__ = (db.UniqueConstraint('process', 'kind'),)
+    # Host or dyno and pid of the process
+    process = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.Text, nullable=False)
+    # JSON blob with the statistics
+    stats = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'<ProcessStats {self.id}>'
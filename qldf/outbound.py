@@ -0,0 +1,161 @@
+"""Scheduling of the requests tasks send to external hosts.
+
+Requests to each host are rate limited by a token bucket shared by every task run in the process, transient failures
+(connection errors, timeouts, 429 and 5xx responses) are retried with jittered exponential backoff and a host that keeps
+failing gets its circuit opened: requests to it are skipped without being sent until CIRCUIT_RESET_SECONDS have passed,
+then a single trial request decides whether it is closed again. A task run also has a time limit after which its
+remaining requests are skipped.
+Work items that were skipped are re-queued, the next run of the task handles them first."""
+import random
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+import requests
+
+from qldf.ratelimit import RateLimiter
+
+
+class SkippedRequest(Exception):
+    """A request was not sent, the work that needed it should be re-queued"""
+
+
+class CircuitOpenError(SkippedRequest):
+    pass
+
+
+class TimeLimitExceeded(SkippedRequest):
+    pass
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures per host, shared by all task runs in this process"""
+    def __init__(self):
+        # {host: (consecutive failures, time the circuit opened or None)}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def check(self, host, reset_seconds):
+        """Raise CircuitOpenError if requests to host should not be sent"""
+        with self._lock:
+            failures, opened = self._hosts.get(host, (0, None))
+            if opened is None:
+                return
+            if monotonic() - opened < reset_seconds:
+                raise CircuitOpenError(f'Circuit for {host} is open')
+            # Half open, let this request through as a trial and keep the rest out until it is done
+            self._hosts[host] = (failures, monotonic())
+
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host, threshold):
+        with self._lock:
+            failures, opened = self._hosts.get(host, (0, None))
+            failures += 1
+            if failures >= threshold:
+                opened = monotonic()
+            self._hosts[host] = (failures, opened)
+
+    def open_hosts(self):
+        with self._lock:
+            return [host for host, (_, opened) in self._hosts.items() if opened is not None]
+
+
+circuit_breaker = CircuitBreaker()
+
+# {requests per second: RateLimiter}, the buckets of a host are shared by all task runs in this process
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(rate):
+    """Get the rate limiter of this process for rate requests per second per host"""
+    with _rate_limiters_lock:
+        return _rate_limiters.setdefault(rate, RateLimiter(rate))
+
+# {task name: [keys of skipped work items]}
+_requeued = {}
+_requeued_lock = threading.Lock()
+
+
+class OutboundScheduler:
+    """Sends the requests of one task run, rate limited by rate_limiter which concurrent runs share"""
+    def __init__(self, rate_limiter, retries, backoff_seconds, backoff_max_seconds, failure_threshold, reset_seconds,
+                 time_limit):
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.deadline = monotonic() + time_limit if time_limit else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(shared_rate_limiter(config['STEAM_REQUESTS_PER_SECOND']),
+                   config['OUTBOUND_RETRIES'],
+                   config['OUTBOUND_BACKOFF_SECONDS'],
+                   config['OUTBOUND_BACKOFF_MAX_SECONDS'],
+                   config['CIRCUIT_FAILURE_THRESHOLD'],
+                   config['CIRCUIT_RESET_SECONDS'],
+                   config['TASK_TIME_LIMIT'])
+
+    def request(self, send, url, *args, **kwargs):
+        """Call send(url, *args, **kwargs), for example http_client.get_text, within the limits of this scheduler.
+        Raises SkippedRequest if the request was not sent, or the last error if it kept failing."""
+        host = urlparse(url).netloc
+        for attempt in range(self.retries + 1):
+            if self.deadline and monotonic() > self.deadline:
+                raise TimeLimitExceeded('Task time limit exceeded')
+            circuit_breaker.check(host, self.reset_seconds)
+            self.rate_limiter.acquire(url)
+            try:
+                result = send(url, *args, **kwargs)
+            except requests.RequestException as e:
+                if not is_transient(e):
+                    # The host is fine, the request is not
+                    circuit_breaker.success(host)
+                    raise
+                circuit_breaker.failure(host, self.failure_threshold)
+                if attempt == self.retries:
+                    raise
+                sleep(self.backoff(attempt, e))
+            else:
+                circuit_breaker.success(host)
+                return result
+
+    def backoff(self, attempt, error):
+        """Seconds to wait before retry attempt + 1: full jitter exponential backoff, or the Retry-After of a 429"""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.backoff_max_seconds)
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt))
+
+
+def is_transient(error):
+    """Whether a request that failed with error may succeed when retried"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+
+def requeue(task_name, keys):
+    """Have the next run of task_name handle the work items with keys first"""
+    with _requeued_lock:
+        _requeued[task_name] = list(keys)
+
+
+def requeued_first(task_name, items, key):
+    """Order items so the ones re-queued by the previous run of task_name come first
+    Args:
+        task_name (str): Name of the task
+        items (list): Work items
+        key (callable): Gets the key of a work item
+    """
+    with _requeued_lock:
+        keys = set(_requeued.pop(task_name, ()))
+    return sorted(items, key=lambda item: key(item) not in keys)
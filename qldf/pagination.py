@@ -0,0 +1,180 @@
+"""Keyset (seek) pagination for listing queries.
+
+Instead of OFFSET/LIMIT every page after the first few is fetched by seeking past the (sort value, id) of the
+last row of the previous page, which is passed along in an opaque cursor. Total row counts are cached per listing
+and refreshed in a background thread once they are older than COUNT_CACHE_TIMEOUT seconds, the COUNT_CACHE_SIZE
+listings counted longest ago are dropped."""
+import base64
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import time
+
+from flask import abort, current_app, request
+from sqlalchemy import asc, tuple_
+
+from qldf import db
+
+# {count_key: (count, time counted)} in the order they were counted
+_count_cache = OrderedDict()
+_count_cache_lock = threading.Lock()
+_count_refreshing = set()
+
+
+def paginate(query, sortby, sortdir, page, count_key, sortable=None):
+    """Paginate query by the column labelled sortby, with the column labelled id as tie breaker.
+    Page numbers without a cursor in the request arguments are only served up to MAX_OFFSET_PAGE,
+    deeper pages have to be reached through the next/previous cursors.
+    Args:
+        query: Query to paginate, must have columns labelled sortby and id
+        sortby (str): Label of the column to sort by
+        sortdir: sqlalchemy.asc or sqlalchemy.desc
+        page (int): Page number, used for display and for OFFSET when no cursor is given
+        count_key (tuple): Key identifying this listing in the total count cache
+        sortable (tuple): Labels of the columns that may be sorted by, any column when None. Listings of the whole
+            table should only allow columns with a (column, id) index, so a page never sorts the table.
+    """
+    if sortable is not None and sortby not in sortable:
+        abort(404)
+    sq = query.subquery()
+    try:
+        sort_column = sq.c[sortby]
+    except KeyError:
+        abort(404)
+    return KeysetPagination(sq, sort_column, sq.c.id, sortdir, page,
+                            current_app.config['ROWS_PER_PAGE'], query, count_key)
+
+
+class KeysetPagination:
+    """Page of query results, with the same attributes as the flask_sqlalchemy Pagination the templates use."""
+    def __init__(self, sq, sort_column, id_column, sortdir, page, per_page, count_query, count_key):
+        self.page = page
+        self.per_page = per_page
+        self._count_query = count_query
+        self._count_key = count_key
+        self._sortby = sort_column.name
+        after = request.args.get('after')
+        before = request.args.get('before')
+        ascending = sortdir is asc
+        q = db.session.query(sq)
+        if after or before:
+            try:
+                key = decode_cursor(after or before)
+            except ValueError:
+                abort(404)
+            if len(key) != 2:
+                abort(404)
+            # Seeking backwards means walking the index in the opposite direction and reversing the rows afterwards
+            forward = bool(after)
+            if forward == ascending:
+                q = q.filter(tuple_(sort_column, id_column) > tuple_(*key))
+            else:
+                q = q.filter(tuple_(sort_column, id_column) < tuple_(*key))
+        else:
+            if page < 1 or page > current_app.config['MAX_OFFSET_PAGE']:
+                abort(404)
+            forward = True
+        if forward == ascending:
+            q = q.order_by(sort_column.asc(), id_column.asc())
+        else:
+            q = q.order_by(sort_column.desc(), id_column.desc())
+        if not (after or before):
+            q = q.offset((page - 1) * per_page)
+        rows = q.limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if forward:
+            self.items = rows
+            self.has_next = has_more
+            self.has_prev = page > 1
+        else:
+            self.items = rows[::-1]
+            self.has_next = True
+            self.has_prev = has_more
+            if not has_more:
+                self.page = 1
+        if page != 1 and not self.items:
+            abort(404)
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        """Cursor to pass as 'before' to get the previous page"""
+        return self._cursor(self.items[0]) if self.items else None
+
+    @property
+    def next_cursor(self):
+        """Cursor to pass as 'after' to get the next page"""
+        return self._cursor(self.items[-1]) if self.items else None
+
+    @property
+    def total(self):
+        """Total number of rows, possibly up to COUNT_CACHE_TIMEOUT seconds out of date"""
+        return cached_count(self._count_key, self._count_query)
+
+    @property
+    def pages(self):
+        return max(1, -(-self.total // self.per_page))
+
+    def _cursor(self, row):
+        return encode_cursor((getattr(row, self._sortby), row.id))
+
+
+def encode_cursor(key):
+    """Encode a tuple of sort values as an url safe string"""
+    values = [{'d': value.isoformat()} if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor created by encode_cursor, raises ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return tuple(datetime.fromisoformat(value['d']) if isinstance(value, dict) else value for value in values)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        raise ValueError(f'Malformed cursor {cursor}') from e
+
+
+def cached_count(key, query):
+    """Get the row count of query from the cache. A missing count is calculated right away,
+    an expired one is returned as is and refreshed in a background thread."""
+    cached = _count_cache.get(key)
+    if cached is None:
+        count = query.order_by(None).count()
+        _store_count(key, count)
+        return count
+    count, counted_at = cached
+    if time() - counted_at > current_app.config['COUNT_CACHE_TIMEOUT']:
+        with _count_cache_lock:
+            refresh = key not in _count_refreshing
+            _count_refreshing.add(key)
+        if refresh:
+            app = current_app._get_current_object()
+            threading.Thread(target=_refresh_count, args=(app, key, query), daemon=True).start()
+    return count
+
+
+def _refresh_count(app, key, query):
+    with app.app_context():
+        try:
+            _store_count(key, query.with_session(db.session()).order_by(None).count())
+        finally:
+            db.session.remove()
+            with _count_cache_lock:
+                _count_refreshing.discard(key)
+
+
+def _store_count(key, count):
+    with _count_cache_lock:
+        _count_cache[key] = (count, time())
+        _count_cache.move_to_end(key)
+        while len(_count_cache) > current_app.config['COUNT_CACHE_SIZE']:
+            _count_cache.popitem(last=False)
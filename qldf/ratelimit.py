@@ -0,0 +1,36 @@
+"""Rate limiting of outbound requests per host, shared by the threads of every task in a process."""
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+
+class RateLimiter:
+    """Token bucket per host: on average rate requests per second to each host, with bursts of up to burst requests."""
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate (float): Requests per second per host, None or 0 for no limit
+            burst (int): Number of requests that can be made at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        # {host: (tokens, time of last update)}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        """Block until a request to the host of url is allowed"""
+        if not self.rate:
+            return
+        host = urlparse(url).netloc
+        while True:
+            with self._lock:
+                now = monotonic()
+                tokens, updated = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            sleep(wait)
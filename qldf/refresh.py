@@ -0,0 +1,97 @@
+"""Refresh scheduling of the rows tasks keep up to date from steam: players and workshop items.
+
+Every such row has a next_refresh_at, the time it is due to be fetched again, and a refresh_interval in seconds. A task
+run only takes a bounded batch of the rows that are due, the ones that are most overdue first and rows that were never
+fetched before anything else. After a row was fetched its interval is halved when the data changed and doubled when it
+did not, between REFRESH_MIN_INTERVAL and REFRESH_MAX_INTERVAL, and capped at REFRESH_ACTIVE_INTERVAL while the row is
+active. Activity elsewhere, a player setting a record or playing on a server, pulls the row forward so it does not wait
+out a long interval. Outbound traffic so follows activity instead of the size of the tables.
+Schedules are written without touching date_modified, which stays the last time the data of the row changed.
+
+None of these functions commit."""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, func, or_
+
+from qldf import db
+from qldf.models import utcnow
+
+# Fraction by which next refresh times are spread, so rows loaded together don't stay due together
+JITTER = 0.1
+
+
+def due_rows(query, model, limit):
+    """Limit query to at most limit rows of model that are due, most overdue first
+    Args:
+        query: Query selecting rows of model
+        model: Player or WorkshopItem
+        limit (int): Maximum number of rows
+    """
+    return query.\
+        filter(or_(model.next_refresh_at.is_(None), model.next_refresh_at <= datetime.utcnow())).\
+        order_by(model.next_refresh_at.asc().nullsfirst(), model.id).\
+        limit(limit)
+
+
+def next_refresh(interval, changed, active, config, now=None):
+    """Get the schedule of a row that was just fetched
+    Args:
+        interval (int): Current refresh_interval in seconds or None if the row was never scheduled
+        changed (bool): Whether the fetched data differed from the stored data
+        active (bool): Whether the row saw recent activity
+        config: App config with the REFRESH_* intervals
+    Returns:
+        dict: {'next_refresh_at': datetime, 'refresh_interval': int} to update the row with
+    """
+    if interval is None:
+        interval = config['REFRESH_MIN_INTERVAL']
+    elif changed:
+        interval //= 2
+    else:
+        interval *= 2
+    interval = max(config['REFRESH_MIN_INTERVAL'], min(interval, config['REFRESH_MAX_INTERVAL']))
+    if active:
+        interval = min(interval, config['REFRESH_ACTIVE_INTERVAL'])
+    now = now or datetime.utcnow()
+    delay = interval * random.uniform(1 - JITTER, 1 + JITTER)
+    return {'next_refresh_at': now + timedelta(seconds=delay), 'refresh_interval': interval}
+
+
+def retry_later(interval, config, now=None):
+    """Get the schedule of a row whose fetch failed: try again after its current interval, so rows that keep failing
+    don't hold on to the front of the queue"""
+    interval = interval or config['REFRESH_MIN_INTERVAL']
+    return {'next_refresh_at': (now or datetime.utcnow()) + timedelta(seconds=interval), 'refresh_interval': interval}
+
+
+def write_schedules(model, schedules):
+    """Store schedules from next_refresh or retry_later, each with the id of its row added, in rows of model"""
+    if not schedules:
+        return
+    table = model.__table__
+    statement = table.update().\
+        where(table.c.id == bindparam('row_id')).\
+        values(next_refresh_at=bindparam('row_next_refresh_at'),
+               refresh_interval=bindparam('row_refresh_interval'),
+               date_modified=table.c.date_modified)
+    db.session.execute(statement, [{'row_id': schedule['id'],
+                                    'row_next_refresh_at': schedule['next_refresh_at'],
+                                    'row_refresh_interval': schedule['refresh_interval']} for schedule in schedules])
+
+
+def pull_forward(model, condition, config):
+    """Make the rows of model matching condition due within REFRESH_ACTIVE_INTERVAL, rows due sooner are left alone
+    Returns:
+        int: Number of rows whose schedule changed
+    """
+    seconds = config['REFRESH_ACTIVE_INTERVAL']
+    due = utcnow() + timedelta(seconds=seconds)
+    return db.session.query(model).\
+        filter(condition,
+               model.next_refresh_at.isnot(None),
+               model.next_refresh_at > due).\
+        update({'next_refresh_at': due,
+                'refresh_interval': func.least(model.refresh_interval, seconds),
+                'date_modified': model.date_modified},
+               synchronize_session=False)
@@ -1,7 +1,10 @@
 """Custom jinja filters"""
+import re
+
 from flask import url_for, current_app, request
 from jinja2.filters import do_mark_safe
-import re
+
+from qldf.cache import RenderCache
 
 
 def setup_custom_jinja_filters(app):
@@ -20,46 +23,61 @@ def setup_custom_jinja_filters(app):
     app.jinja_env.filters['format_server_wrs'] = format_server_wrs
 
 
-def format_server_wrs(world_records, server_id):
+# Html fragments rendered by the filters, keyed by the data they were rendered from. Server tables mostly stay the same
+# between snapshots, so their fragments are reused across requests, pages and snapshot versions.
+fragment_cache = RenderCache()
+
+
+def cached_fragment(key, render, *args):
+    """Get the fragment stored under key, or store and return render(*args)"""
+    fragment = fragment_cache.get(key, None)
+    if fragment is None:
+        fragment = do_mark_safe(render(*args))
+        fragment_cache.set(key, None, fragment, current_app.config['FRAGMENT_CACHE_SIZE'])
+    return fragment
+
+
+def format_server_wrs(world_records):
     """Format the world records on the server browser to a table
-    world_records format: {server_id: [list of records]}
+    world_records format: [list of records]
             where every record is a tuple like {map_name, mode, date, time, player_name, steam_id, rank} accessible like sqlalchemy result"""
-    if world_records[server_id]:
-        html_output = '<table><tr><th>Player</th><th>Mode</th><th>Time</th><th>Date</th></tr>'
-        for wr in world_records[server_id]:
-            # format time
-            time = format_record_time(wr.time)
-            # format date
-            date = format_record_date(wr.date)
-            # format player name
-            player_name = format_player_name(wr.player_name, wr.steam_id)
-            # format mode
-            mode = format_record_mode(wr.mode)
-            # create table row
-            html_output += f"<tr><td>{player_name}</td><td>{mode}</td><td>{time}</td><td>{date}</td></tr>"
-        html_output += '</table>'
-    else:
-        html_output = ''
-    return do_mark_safe(html_output)
+    if not world_records:
+        return do_mark_safe('')
+    key = ('server_wrs',) + tuple((wr.player_name, wr.steam_id, wr.mode, wr.time, wr.date) for wr in world_records)
+    return cached_fragment(key, render_server_wrs, world_records)
+
+
+def render_server_wrs(world_records):
+    """Uncached html of format_server_wrs"""
+    rows = ['<table><tr><th>Player</th><th>Mode</th><th>Time</th><th>Date</th></tr>']
+    for wr in world_records:
+        rows.append(f"<tr><td>{format_player_name(wr.player_name, wr.steam_id)}</td>"
+                    f"<td>{format_record_mode(wr.mode)}</td>"
+                    f"<td>{format_record_time(wr.time)}</td>"
+                    f"<td>{format_record_date(wr.date)}</td></tr>")
+    rows.append('</table>')
+    return ''.join(rows)
 
 
 def format_players(players):
     """Format list of players dicts as html
     input format:
     [{name: <string>, score: <int>, totalconnected: <string>}], 1 dict per player"""
-    if players:
-        html_output = '<table><tr><th>Name</th><th>Time</th><th>Connected for</th></tr>'
-        for player in players:
-            # format time
-            if player['score'] == 2147483647:
-                player['score'] = '-'
-            else:
-                player['score'] = format_record_time(player['score'])
-            html_output += f"<tr><td>{strip_colors(player['name'])}</td><td>{player['score']}</td><td>{player['totalConnected']}</td></tr>"
-        html_output += '</table>'
-    else:
-        html_output = ''
-    return do_mark_safe(html_output)
+    if not players:
+        return do_mark_safe('')
+    key = ('players',) + tuple((player['name'], player['score'], player['totalConnected']) for player in players)
+    return cached_fragment(key, render_players, players)
+
+
+def render_players(players):
+    """Uncached html of format_players"""
+    rows = ['<table><tr><th>Name</th><th>Time</th><th>Connected for</th></tr>']
+    for player in players:
+        # the players are shared between requests so don't modify them
+        score = '-' if player['score'] == 2147483647 else format_record_time(player['score'])
+        rows.append(f"<tr><td>{strip_colors(player['name'])}</td><td>{score}</td><td>{player['totalConnected']}</td></tr>")
+    rows.append('</table>')
+    return ''.join(rows)
 
 
 def format_record_mode(mode):
@@ -1,16 +1,26 @@
-import json
+import threading
+from datetime import datetime
 from functools import wraps
-from time import time
+from types import SimpleNamespace
 
-from flask import Blueprint, render_template, session, url_for, g, request, current_app, redirect
-from sqlalchemy import func, desc, asc, literal
+from flask import Blueprint, render_template, session, url_for, g, request, current_app, redirect, abort
+from sqlalchemy import func, desc, asc, literal, case
 
 from qldf import db
-from qldf.models import Player, Record, Map, WorkshopItem, Server
+from qldf.models import Player, Record, Map, WorkshopItem, WorldRecord
+from qldf.pagination import paginate
+from qldf.cache import cached, table_state, response_cache
+from qldf.snapshots import read_snapshot
+from qldf.stats import publish_stats_due
+from qldf.tasks import write_servers_snapshot, SERVERS_SNAPSHOT, SERVERS_VERSIONS_SNAPSHOT, SERVERS_TABLES
+from qldf.timing import current_timing
+from .filters import fragment_cache
 from .forms import SearchForm
 
 root = Blueprint('root', __name__, url_prefix='/', template_folder='templates', static_folder='static', static_url_path='root/static')
 
+_servers_snapshot_lock = threading.Lock()
+
 
 def search_form(wrapped_function, *args, **kwargs):
     """To be used on every routing function that extends base.j2 to handle the search form in the page header.
@@ -28,6 +38,7 @@ def search_form(wrapped_function, *args, **kwargs):
 
 @root.route('/', methods=['GET', 'POST'])
 @search_form
+@cached('record', 'player', 'map')
 def index():
     # Get rows of recent records
     recent_records = db.session.query(Record.mode,
@@ -36,30 +47,23 @@ def index():
                                       Player.steam_id,
                                       Record.time,
                                       Record.date,
-                                      func.rank().over(
-                                          order_by=Record.time,
-                                          partition_by=(Record.map_id, Record.mode)
-                                      ).label('rank')).\
+                                      Record.rank.label('rank')).\
         join(Player, Map).\
         order_by(desc(Record.date)).\
         limit(current_app.config['NUM_RECENT_RECORDS'])
 
     # Get rows of recent world records
-    sq = db.session.query(Record.id,
-                          func.rank().over(
-                              order_by=Record.time,
-                              partition_by=(Record.map_id, Record.mode)
-                          ).label('rank')).subquery()
     recent_world_records = db.session.query(Record.mode,
                                             Map.name.label('map_name'),
                                             Player.name.label('player_name'),
                                             Player.steam_id,
                                             Record.time,
                                             Record.date,
-                                            sq.c.rank.label('rank')).\
-        join(Player, Map).\
-        join(sq, sq.c.id == Record.id).\
-        filter(sq.c.rank == 1).\
+                                            Record.rank.label('rank')).\
+        select_from(WorldRecord).\
+        join(Map).\
+        join(Record, WorldRecord.record_id == Record.id).\
+        join(Player).\
         order_by(desc(Record.date)).\
         limit(current_app.config['NUM_RECENT_WORLD_RECORDS'])
     # Get rows of recent maps
@@ -75,58 +79,32 @@ def index():
 
 @root.route('servers/', methods=['GET', 'POST'])
 @search_form
+@cached('server', 'record', 'player')
 def servers():
-    """Show server list"""
-    _servers = db.session.query(Server).all()
-    # Parse players json
-    players = {}
-    for server in _servers:
-        db_players = json.loads(server.players)
-        players[server.server_id] = []
-        for _player in db_players:
-            players[server.server_id].append({'name': _player['name'],
-                                              'score': _player['score'],
-                                              'totalConnected': _player['totalConnected']})
-            # Sort players by fastest time
-            players[server.server_id] = sorted(players[server.server_id], key=lambda k: k['score'])
-    # Sort servers by playercount
-    _servers = sorted(_servers, key=lambda k: len(players[k.server_id]), reverse=True)
-    # Subquery to get all record ranks per map
-    map_names = list(set([x.map for x in _servers]))
-    sq = db.session.query(Map.name.label('map_name'),
-                          Record.mode,
-                          Record.date,
-                          Record.time,
-                          Player.name.label('player_name'),
-                          Player.steam_id,
-                          func.rank().over(
-                              order_by=Record.time,
-                              partition_by=(Record.map_id, Record.mode)
-                          ).label('rank')).\
-        join(Record, Player).\
-        filter(Map.name.in_(map_names)).\
-        subquery()
-    # Keep only the #1 ranks
-    world_records_unlinked = db.session.query(sq.c.map_name.label('map_name'),
-                                     sq.c.mode.label('mode'),
-                                     sq.c.date.label('date'),
-                                     sq.c.time.label('time'),
-                                     sq.c.player_name.label('player_name'),
-                                     sq.c.steam_id.label('steam_id'),
-                                     sq.c.rank.label('rank')).\
-        filter(sq.c.rank==1).all()
-    # Link world records to server_id by unique map names
-    world_records = {}
-    for _server in _servers:
-        world_records[_server.server_id] = []
-        for wr in world_records_unlinked:
-            if wr.map_name == _server.map:
-                world_records[_server.server_id].append(wr)
-
+    """Show the server list snapshot published by the update_servers task. The snapshot is rebuilt from the server
+    table first if it is older than the tables, for example in a process the task does not run in."""
+    versions, _ = table_state(SERVERS_TABLES)
+    if read_snapshot(SERVERS_VERSIONS_SNAPSHOT) != list(versions):
+        with _servers_snapshot_lock:
+            if read_snapshot(SERVERS_VERSIONS_SNAPSHOT) != list(versions):
+                write_servers_snapshot()
+    _servers = read_snapshot(SERVERS_SNAPSHOT, load_servers_snapshot) or []
     return render_template('servers.j2',
-                           servers=_servers,
-                           players=players,
-                           world_records=world_records)
+                           servers=_servers)
+
+
+def load_servers_snapshot(data):
+    """Make the dates in the servers snapshot datetimes and its world records accessible like query results"""
+    _servers = []
+    for server in data:
+        server['date_modified'] = datetime.fromisoformat(server['date_modified'])
+        world_records = []
+        for wr in server['world_records']:
+            wr['date'] = datetime.fromisoformat(wr['date'])
+            world_records.append(SimpleNamespace(map_name=server['map'], **wr))
+        server['world_records'] = world_records
+        _servers.append(SimpleNamespace(**server))
+    return _servers
 
 
 @root.route('player/<string:steam_id>/', defaults={'page': 1, 'sortby': 'date', 'sortdir': 'desc'}, methods=['GET', 'POST'])
@@ -134,38 +112,29 @@ def servers():
 @root.route('player/<string:steam_id>/<int:page>/<string:sortby>/', defaults={'sortdir': 'asc'}, methods=['GET', 'POST'])
 @root.route('player/<string:steam_id>/<int:page>/', defaults={'sortby': 'date', 'sortdir': 'desc'}, methods=['GET', 'POST'])
 @search_form
+@cached('record', 'player', 'map')
 def player(page, steam_id, sortby, sortdir):
     """Show records and stats for a single player"""
     if sortdir == 'asc':
         sortdir = asc
     else:
         sortdir = desc
-    # Get 'rank' in subquery before filtering on player name and ordering
-    sq = db.session.query(Record.mode.label('mode'),
-                          Record.time.label('time'),
-                          Record.date.label('date'),
-                          Record.player_id.label('player_id'),
-                          Map.name.label('map_name'),
-                          func.rank().over(
-                              order_by=Record.time,
-                              partition_by=(Record.map_id, Record.mode)
-                          ).label('rank')).\
+    query = db.session.query(Record.id.label('id'),
+                             Player.steam_id,
+                             Player.name.label('player_name'),
+                             Player.date_modified,
+                             Player.avatar_url,
+                             Record.mode.label('mode'),
+                             Record.time.label('time'),
+                             Record.date.label('date'),
+                             Map.name.label('map_name'),
+                             Record.rank.label('rank')).\
+        join(Player.records).\
         join(Map).\
-        subquery()
-    pagination = db.session.query(Player.id,
-                                  Player.steam_id,
-                                  Player.name.label('player_name'),
-                                  Player.date_modified,
-                                  Player.avatar_url,
-                                  sq.c.mode.label('mode'),
-                                  sq.c.time.label('time'),
-                                  sq.c.date.label('date'),
-                                  sq.c.map_name.label('map_name'),
-                                  sq.c.rank.label('rank')).\
-        join(sq, sq.c.player_id == Player.id).\
-        filter(Player.steam_id == steam_id).\
-        order_by(sortdir(sortby)).\
-        paginate(page, current_app.config['ROWS_PER_PAGE'], True)
+        filter(Player.steam_id == steam_id)
+    pagination = paginate(query, sortby, sortdir, page, ('player', steam_id))
+    if not pagination.items:
+        abort(404)
     name = pagination.items[0].player_name
     avatar_url = pagination.items[0].avatar_url
     date_modified = pagination.items[0].date_modified
@@ -185,43 +154,23 @@ def player(page, steam_id, sortby, sortdir):
 @root.route('players/<int:page>/<string:sortby>/<string:sortdir>/', methods=['GET', 'POST'])
 @root.route('players/<int:page>/<string:sortby>/', defaults={'sortdir': 'asc'}, methods=['GET', 'POST'])
 @search_form
+@cached('record', 'player')
 def players(page, sortby, sortdir):
     """Show a list of all players and their number of records and world records."""
     if sortdir == 'asc':
         sortdir = asc
     else:
         sortdir = desc
-    # subquery to get all record ranks per player
-    sq = db.session.query(Player.id.label('id'),
-                          func.rank().over(
-                              order_by=Record.time,
-                              partition_by=(Record.map_id, Record.mode)
-                          ).label('rank')).\
-        join(Player.records).\
-        subquery()
-    # subquery to get wr count per player
-    sq2 = db.session.query(Player.id.label('id'),
-                           func.count(sq.c.id).label('wr_count')).\
-        join(sq, sq.c.id == Player.id).\
-        filter(sq.c.rank == 1).\
-        group_by(Player.id).\
-        subquery()
-    # subquery to get record count per player
-    sq3 = db.session.query(Player.id.label('id'),
-                           func.count(Player.id).label('record_count')).\
-        join(Player.records).\
-        group_by(Player.id).\
-        subquery()
-    # final query joining record count and wr count
-    pagination = db.session.query(Player.id,
-                                  Player.name,
-                                  Player.steam_id,
-                                  func.coalesce(sq2.c.wr_count, '0').label('wr_count'),
-                                  sq3.c.record_count.label('record_count')).\
-        outerjoin(sq2, sq2.c.id == Player.id).\
-        join(sq3, sq3.c.id == Player.id).\
-        order_by(sortdir(sortby)).\
-        paginate(page, current_app.config['ROWS_PER_PAGE'], True)
+    query = db.session.query(Player.id,
+                             Player.name,
+                             Player.steam_id,
+                             Player.wr_count,
+                             Player.record_count,
+                             Player.best_rank,
+                             Player.last_record_date).\
+        filter(Player.record_count > 0)
+    pagination = paginate(query, sortby, sortdir, page, ('players',),
+                          sortable=('name', 'wr_count', 'record_count', 'best_rank', 'last_record_date'))
     return render_template('players.j2',
                            title='Players',
                            pagination=pagination,
@@ -234,24 +183,23 @@ def players(page, sortby, sortdir):
 @root.route('records/<int:page>/<string:sortby>/<string:sortdir>/', methods=['GET', 'POST'])
 @root.route('records/<int:page>/<string:sortby>/', defaults={'sortdir': 'asc'}, methods=['GET', 'POST'])
 @search_form
+@cached('record', 'player', 'map')
 def records(page, sortby, sortdir):
     if sortdir == 'asc':
         sortdir = asc
     else:
         sortdir = desc
-    pagination = db.session.query(Record.mode,
-                                  Record.time,
-                                  Record.date,
-                                  Player.name.label('player_name'),
-                                  Player.steam_id,
-                                  Map.name.label('map_name'),
-                                  func.rank().over(
-                                      order_by=Record.time,
-                                      partition_by=(Record.map_id, Record.mode)
-                                  ).label('rank')).\
-        join(Player, Map).\
-        order_by(sortdir(sortby)).\
-        paginate(page, current_app.config['ROWS_PER_PAGE'], True)
+    query = db.session.query(Record.id.label('id'),
+                             Record.mode,
+                             Record.time,
+                             Record.date,
+                             Player.name.label('player_name'),
+                             Player.steam_id,
+                             Map.name.label('map_name'),
+                             Record.rank.label('rank')).\
+        join(Player, Map)
+    # Map and player names are on other tables, sorting all records by them can't seek an index
+    pagination = paginate(query, sortby, sortdir, page, ('records',), sortable=('mode', 'rank', 'time', 'date'))
     return render_template('records.j2',
                            title='Records',
                            pagination=pagination,
@@ -264,6 +212,7 @@ def records(page, sortby, sortdir):
 @root.route('map/<string:name>/<int:page>/<string:sortby>/<string:sortdir>/', methods=['GET', 'POST'])
 @root.route('map/<string:name>/<int:page>/<string:sortby>/', defaults={'sortdir': 'asc'}, methods=['GET', 'POST'])
 @search_form
+@cached('record', 'player', 'map', 'workshop_item')
 def _map(page, name, sortby, sortdir):
     """Show records and data for a single map."""
     if sortdir == 'asc':
@@ -287,20 +236,19 @@ def _map(page, name, sortby, sortdir):
         outerjoin(WorkshopItem).\
         filter(Map.name == name).\
         first()
+    if map_data is None:
+        abort(404)
     # Get records for map
-    pagination = db.session.query(Record.mode,
-                                  Record.time,
-                                  Record.date,
-                                  Player.name.label('player_name'),
-                                  Player.steam_id,
-                                  func.rank().over(
-                                      order_by=Record.time,
-                                      partition_by=(Record.map_id, Record.mode)
-                                  ).label('rank')).\
+    query = db.session.query(Record.id.label('id'),
+                             Record.mode,
+                             Record.time,
+                             Record.date,
+                             Player.name.label('player_name'),
+                             Player.steam_id,
+                             Record.rank.label('rank')).\
         join(Map, Player).\
-        filter(Map.name == name).\
-        order_by(sortdir(sortby)).\
-        paginate(page, current_app.config['ROWS_PER_PAGE'], True)
+        filter(Map.name == name)
+    pagination = paginate(query, sortby, sortdir, page, ('map', name))
     return render_template('map.j2',
                            title=name,
                            name=name,
@@ -315,21 +263,20 @@ def _map(page, name, sortby, sortdir):
 @root.route('maps/<int:page>/<string:sortby>/<string:sortdir>/', methods=['GET', 'POST'])
 @root.route('maps/<int:page>/<string:sortby>/', defaults={'sortdir': 'asc'}, methods=['GET', 'POST'])
 @search_form
+@cached('record', 'map', 'workshop_item')
 def maps(page, sortby, sortdir):
     """Show a list of maps and the number of records on it as well as a workshop url."""
     if sortdir == 'asc':
         sortdir = asc
     else:
         sortdir = desc
-    pagination = db.session.query(Map.id,
-                                  Map.name.label('map_name'),
-                                  func.count(Map.id).label('record_count'),
-                                  WorkshopItem.item_id).\
-        join(Map.records).\
+    query = db.session.query(Map.id,
+                             Map.name.label('map_name'),
+                             Map.record_count,
+                             WorkshopItem.item_id).\
         outerjoin(WorkshopItem).\
-        group_by(Map.id, WorkshopItem.item_id).\
-        order_by(sortdir(sortby)).\
-        paginate(page, current_app.config['ROWS_PER_PAGE'], True)
+        filter(Map.record_count > 0)
+    pagination = paginate(query, sortby, sortdir, page, ('maps',), sortable=('map_name', 'record_count'))
     return render_template('maps.j2',
                            title='Maps',
                            pagination=pagination,
@@ -341,21 +288,35 @@ def maps(page, sortby, sortdir):
 @root.route('search/<string:search_string>/<int:page>', methods=['GET', 'POST'])
 @root.route('search/<string:search_string>/', defaults={'page': 1}, methods=['GET', 'POST'])
 @search_form
+@cached('player', 'map', 'workshop_item')
 def search(page, search_string):
+    """Search player and map names for search_string, best matches first.
+    Player names are searched without their color codes. Both searches are answered by trigram indexes."""
+    term = Player.make_search_name(search_string)
+    pattern = '%' + escape_like(term) + '%'
     # subquery with player names
     sq = db.session.query(Player.id.label('id'),
                           Player.steam_id.label('steam_id'),
                           Player.name.label('name'),
-                          literal('player').label('type')).\
-        filter(Player.name.ilike(f'%{search_string}%'))
+                          literal('player').label('type'),
+                          match_quality(Player.search_name, term).label('match_quality'),
+                          func.similarity(Player.search_name, term).label('similarity')).\
+        filter(Player.search_name.like(pattern, escape='\\'))
     # subquery with map names
     sq2 = db.session.query(Map.id.label('id'),
                            WorkshopItem.item_id.label('steam_id'),
                            Map.name.label('name'),
-                           literal('map').label('type')).\
+                           literal('map').label('type'),
+                           match_quality(func.lower(Map.name), term).label('match_quality'),
+                           func.similarity(func.lower(Map.name), term).label('similarity')).\
         outerjoin(WorkshopItem).\
-        filter(Map.name.ilike(f'%{search_string}%'))
-    pagination = sq.union(sq2).\
+        filter(Map.name.ilike(pattern, escape='\\'))
+    results = sq.union(sq2).subquery()
+    pagination = db.session.query(results).\
+        order_by(results.c.match_quality,
+                 desc(results.c.similarity),
+                 results.c.name,
+                 results.c.id).\
         paginate(page, current_app.config['SEARCH_RESULTS_PER_PAGE'], True)
     return render_template('search.j2',
                            title='Search',
@@ -363,28 +324,49 @@ def search(page, search_string):
                            search_string=search_string)
 
 
-@root.before_app_request
-def before_request():
-    # Save current time. Used to time request duration.
-    g.start_time = time()
+def match_quality(column, term):
+    """Order of how well column matches term: 0 for an exact match, 1 for a prefix match, 2 otherwise"""
+    return case([(column == term, 0),
+                 (column.like(escape_like(term) + '%', escape='\\'), 1)],
+                else_=2)
+
+
+def escape_like(string):
+    """Escape the LIKE wildcards in string, to be used with escape='\\'"""
+    return string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
 @root.after_app_request
 def after_request(response):
-    """ Replace the string __EXECUTION_TIME__ in the response with the execution time."""
+    """ Replace the string __EXECUTION_TIME__ in rendered pages with the execution time.
+    Also publishes the cache statistics of this process every STATS_PUBLISH_SECONDS, see qldf.stats."""
     session['previous_page'] = request.url
-    execution_time = round((time() - g.start_time) * 1000)
+    try:
+        publish_stats_due('cache', cache_stats)
+    except Exception as e:
+        # Statistics are not worth failing a page for, they are published with the next request
+        current_app.logger.warning(f'Failed to publish cache statistics: {e!r}')
+    timing = current_timing()
+    if timing is None or response.mimetype != 'text/html' or response.is_streamed or response.direct_passthrough:
+        return response
+    execution_time = round(timing.total_ms())
     execution_time_string = '1 millisecond' if execution_time == 1 else f'{execution_time} milliseconds'
-    if response.response:
-        try:
-            response.response[0] = response.response[0].replace('__EXECUTION_TIME__'.encode('utf-8'), execution_time_string.encode('utf-8'))
-            response.headers['content-length'] = len(response.response[0])
-        except TypeError:
-            # Response does not contain the string __EXECUTION_TIME__
-            pass
+    page = response.get_data()
+    if b'__EXECUTION_TIME__' in page:
+        response.set_data(page.replace(b'__EXECUTION_TIME__', execution_time_string.encode('utf-8')))
     return response
 
 
+def cache_stats():
+    """Response and fragment cache statistics of this process, to help sizing RESPONSE_CACHE_SIZE and
+    FRAGMENT_CACHE_SIZE"""
+    stats = response_cache.stats()
+    stats['max_size'] = current_app.config['RESPONSE_CACHE_SIZE']
+    stats['fragments'] = fragment_cache.stats()
+    stats['fragments']['max_size'] = current_app.config['FRAGMENT_CACHE_SIZE']
+    return stats
+
+
 def setup_error_routing(app):
     @app.errorhandler(404)
     def not_found_error(error):
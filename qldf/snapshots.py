@@ -0,0 +1,134 @@
+"""Snapshots of precomputed data that tasks publish as files for the web processes to serve.
+
+A snapshot is written to a temporary file and renamed over the previous one, so readers never see a partial
+snapshot. Readers memory map the file and keep the parsed result until the file is replaced, so every process
+parses each snapshot once instead of querying the database per request.
+Snapshots served as is can be precompressed, they are then also written gzip and, if the brotli package is
+installed, brotli compressed."""
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+from flask import current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# {snapshot name: (file identity, parsed data)}
+_loaded = {}
+_loaded_lock = threading.Lock()
+# {path: (file identity, sha1 hex digest)}
+_digests = {}
+
+
+def snapshot_path(name):
+    return os.path.join(current_app.config['SNAPSHOT_FOLDER'], name)
+
+
+def write_snapshot(name, data, precompress=False):
+    """Atomically replace snapshot name with data serialized as json.
+    Args:
+        name (str): Snapshot file name
+        data: Json serializable data
+        precompress (bool): Also write the compressed copies name.gz and name.br served by precompressed_snapshot
+    """
+    path = snapshot_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content = json.dumps(data, separators=(',', ':')).encode()
+    _write_file(path, content)
+    if precompress:
+        _write_file(f'{path}.gz', gzip.compress(content, 9, mtime=0))
+        if brotli:
+            _write_file(f'{path}.br', brotli.compress(content))
+
+
+def _write_file(path, content):
+    """Atomically replace the file at path with content. An unchanged file is left alone,
+    so its readers keep their parsed copy and clients their validators."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    # Unique per process and thread, as two threads of one process may write the same snapshot at once
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+
+def read_snapshot(name, loader=None):
+    """Get the contents of snapshot name, or None if it was not written yet.
+    Args:
+        name (str): Snapshot file name
+        loader (callable): Applied to the decoded json once per version of the snapshot, the result is cached
+    """
+    try:
+        f = open(snapshot_path(name), 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        stat = os.fstat(f.fileno())
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = _loaded.get(name)
+        if cached and cached[0] == identity:
+            return cached[1]
+        with _loaded_lock:
+            cached = _loaded.get(name)
+            if cached and cached[0] == identity:
+                return cached[1]
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                data = json.loads(m[:])
+            if loader:
+                data = loader(data)
+            _loaded[name] = (identity, data)
+            return data
+
+
+def precompressed_snapshot(name, accept_encodings):
+    """Pick the copy of a snapshot written with precompress to send to a client.
+    Args:
+        name (str): Snapshot file name
+        accept_encodings: The Accept-Encoding header of the request, as werkzeug MIMEAccept
+    Returns:
+        tuple: (path, content encoding or None, strong ETag of the copy), or None if the snapshot was not written yet
+    """
+    path = snapshot_path(name)
+    candidates = [(accept_encodings['br'], 'br'), (accept_encodings['gzip'], 'gzip')]
+    for quality, encoding in sorted(candidates, reverse=True):
+        if quality > 0 and (encoding != 'br' or brotli):
+            encoded_path = f"{path}.{'br' if encoding == 'br' else 'gz'}"
+            etag = _file_digest(encoded_path)
+            if etag:
+                return encoded_path, encoding, etag
+    etag = _file_digest(path)
+    return (path, None, etag) if etag else None
+
+
+def _file_digest(path):
+    """sha1 of the file at path, cached until the file is replaced, or None if it does not exist"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        stat = os.fstat(f.fileno())
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = _digests.get(path)
+        if cached and cached[0] == identity:
+            return cached[1]
+        digest = hashlib.sha1(f.read()).hexdigest()
+    _digests[path] = (identity, digest)
+    return digest
@@ -0,0 +1,72 @@
+"""Statistics of the processes in the deployment, published through the database.
+
+The tasks run in the worker, so only it has outbound request statistics, while the page caches are filled by the web
+processes. Each process writes its statistics to its own process_stats rows, the request statistics after every task
+run and the cache statistics at most every STATS_PUBLISH_SECONDS while serving requests. The api reports the rows of
+every process, whichever process answers. Rows not written for STATS_MAX_AGE_SECONDS, such as those of processes that
+were restarted, are dropped."""
+import json
+import os
+import socket
+import threading
+from datetime import timedelta
+from time import time
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.http import http_date
+
+from qldf import db
+from qldf.models import ProcessStats, utcnow
+
+# {kind: time this process last published it}
+_last_published = {}
+_last_published_lock = threading.Lock()
+
+
+def process_name():
+    """Name of this process in the process_stats rows, the dyno name on heroku or else the host name, and the pid"""
+    return f"{os.environ.get('DYNO') or socket.gethostname()}:{os.getpid()}"
+
+
+def publish_stats(kind, stats):
+    """Write the statistics of kind of this process and drop the rows that are too old. Written on its own connection
+    and committed at once, apart from the transaction of the task or request."""
+    statement = insert(ProcessStats).values(process=process_name(), kind=kind, stats=json.dumps(stats))
+    statement = statement.on_conflict_do_update(index_elements=[ProcessStats.process, ProcessStats.kind],
+                                                set_={'stats': statement.excluded.stats,
+                                                      'date_modified': utcnow()})
+    with db.engine.begin() as connection:
+        connection.execute(statement)
+        connection.execute(ProcessStats.__table__.delete().
+                           where(ProcessStats.date_modified < _oldest_date()))
+
+
+def publish_stats_due(kind, get_stats):
+    """Publish the statistics get_stats() of kind, unless this process did so in the last STATS_PUBLISH_SECONDS"""
+    now = time()
+    with _last_published_lock:
+        if now - _last_published.get(kind, 0) < current_app.config['STATS_PUBLISH_SECONDS']:
+            return
+        _last_published[kind] = now
+    publish_stats(kind, get_stats())
+
+
+def published_stats(kind):
+    """Get the statistics of kind published by every process
+    Returns:
+        dict: {process: {'date_modified': http date, 'stats': statistics}}
+    """
+    rows = db.session.query(ProcessStats.process,
+                            ProcessStats.stats,
+                            ProcessStats.date_modified).\
+        filter(ProcessStats.kind == kind,
+               ProcessStats.date_modified >= _oldest_date()).\
+        order_by(ProcessStats.process)
+    return {row.process: {'date_modified': http_date(row.date_modified),
+                          'stats': json.loads(row.stats)}
+            for row in rows}
+
+
+def _oldest_date():
+    return utcnow() - timedelta(seconds=current_app.config['STATS_MAX_AGE_SECONDS'])
@@ -0,0 +1,240 @@
+"""Extraction of the fields the tasks and scripts need from steam workshop and community pages.
+
+The html pages are run through a streaming tokenizer (the standard library html.parser) that picks the fields out of the
+tags and texts as they pass, instead of building a full BeautifulSoup tree. The page is fed in CHUNK_SIZE pieces and
+parsing stops as soon as every field was found. Texts are extracted the way BeautifulSoup does: whitespace only strings
+collapse to a single newline or space and scripts, styles and comments are left out.
+Profile xml is small and parsed with ElementTree."""
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urlparse, parse_qs
+from xml.etree.ElementTree import fromstring
+
+# Characters of a page parsed between checks whether every field was found
+CHUNK_SIZE = 8192
+# Elements without an end tag
+VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'meta',
+                           'param', 'source', 'track', 'wbr'))
+# Elements whose contents are not text
+RAW_TEXT_ELEMENTS = frozenset(('script', 'style'))
+# Whitespace as far as collapsing whitespace only strings goes
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+class FieldParser(HTMLParser):
+    """Collects fields from a page in a single pass without building a tree. Subclasses look at every start tag in
+    start() and set fields from its attributes or capture the text of the element, FIELDS are the names of the fields
+    after which parsing can stop."""
+    FIELDS = ()
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.fields = {}
+        self.open_tags = []
+        # [field name, number of open tags outside the element, separator, text parts]
+        self.captures = []
+        # Field set from the src of the next img, if any
+        self.next_img_field = None
+        self._in_data = False
+
+    def extract(self, html):
+        """Parse html until every field was found
+        Returns:
+            dict: {field name: value} of the fields found
+        """
+        for i in range(0, len(html), CHUNK_SIZE):
+            self.feed(html[i:i + CHUNK_SIZE])
+            if not self.captures and all(field in self.fields for field in self.FIELDS):
+                return self.fields
+        self.close()
+        return self.fields
+
+    def start(self, tag, attrs, classes):
+        """Called with every start tag, attrs as a dict and classes as a list. Collects nothing by default."""
+
+    def capture_text(self, field, separator=''):
+        """Set field to the text of the element that starts at the current start tag, if it is not set yet"""
+        if field not in self.fields and all(capture[0] != field for capture in self.captures):
+            self.captures.append([field, len(self.open_tags), separator, []])
+
+    def handle_starttag(self, tag, attrs):
+        self._in_data = False
+        attrs = dict(attrs)
+        if tag == 'img' and self.next_img_field:
+            self.fields.setdefault(self.next_img_field, attrs.get('src'))
+            self.next_img_field = None
+        self.start(tag, attrs, (attrs.get('class') or '').split())
+        if tag not in VOID_ELEMENTS:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        self._in_data = False
+        if tag in VOID_ELEMENTS or tag not in self.open_tags:
+            return
+        while self.open_tags.pop() != tag:
+            pass
+        self._end_captures()
+
+    def handle_data(self, data):
+        if not self.captures or (self.open_tags and self.open_tags[-1] in RAW_TEXT_ELEMENTS):
+            return
+        for capture in self.captures:
+            if self._in_data:
+                capture[3][-1] += data
+            else:
+                capture[3].append(data)
+        self._in_data = True
+
+    def handle_comment(self, data):
+        self._in_data = False
+
+    def close(self):
+        super().close()
+        # Elements that were never closed end with the page
+        self.open_tags = []
+        self._end_captures()
+
+    def _end_captures(self):
+        for capture in [capture for capture in self.captures if capture[1] >= len(self.open_tags)]:
+            field, _, separator, parts = capture
+            parts = [part if part.strip(ASCII_SPACES) else '\n' if '\n' in part else ' ' for part in parts]
+            self.fields[field] = separator.join(parts)
+            self.captures.remove(capture)
+
+
+class WorkshopPageParser(FieldParser):
+    FIELDS = ('name', 'author_url', 'description', 'size', 'date', 'num_comments', 'num_ratings', 'score_image_url',
+              'preview_url')
+
+    def __init__(self):
+        super().__init__()
+        # Number of open tags outside the first details stats container, while it is open
+        self.stats_depth = None
+        self.stats_seen = False
+        self.stats = 0
+        self.tab_counts = 0
+        self.rating_details_seen = False
+
+    def start(self, tag, attrs, classes):
+        if self.stats_depth is not None and len(self.open_tags) <= self.stats_depth:
+            self.stats_depth = None
+        if tag == 'div':
+            if 'workshopItemTitle' in classes:
+                self.capture_text('name')
+            elif 'workshopItemDescription' in classes:
+                self.capture_text('description', '\n')
+            elif 'detailsStatsContainerRight' in classes and not self.stats_seen:
+                self.stats_seen = True
+                self.stats_depth = len(self.open_tags)
+            elif 'detailsStatRight' in classes and self.stats_depth is not None:
+                # The first is the size, the second the date
+                self.stats += 1
+                if self.stats <= 2:
+                    self.capture_text(('size', 'date')[self.stats - 1])
+            elif 'numRatings' in classes:
+                self.capture_text('num_ratings')
+            elif 'fileRatingDetails' in classes and not self.rating_details_seen:
+                self.rating_details_seen = True
+                self.next_img_field = 'score_image_url'
+        elif tag == 'a' and 'friendBlockLinkOverlay' in classes:
+            self.fields.setdefault('author_url', attrs.get('href'))
+        elif tag == 'span' and 'tabCount' in classes:
+            # The second tab count is the number of comments
+            self.tab_counts += 1
+            if self.tab_counts == 2:
+                self.capture_text('num_comments')
+        elif tag == 'img' and 'workshopItemPreviewImageEnlargeable' in classes:
+            self.fields.setdefault('preview_url', attrs.get('src'))
+
+
+class WorkshopSearchParser(FieldParser):
+    FIELDS = ('url',)
+
+    def __init__(self):
+        super().__init__()
+        self.last_link = None
+
+    def start(self, tag, attrs, classes):
+        if tag == 'a':
+            self.last_link = attrs.get('href')
+        elif tag == 'div' and attrs.get('class') == 'workshopItemTitle ellipsis' and 'url' not in self.fields:
+            # The title of the first result follows its link
+            self.fields['url'] = self.last_link
+
+
+class ProfilePageParser(FieldParser):
+    FIELDS = ('name', 'avatar_url')
+
+    def start(self, tag, attrs, classes):
+        if tag == 'span' and 'actual_persona_name' in classes:
+            self.capture_text('name')
+        elif tag == 'div' and 'playerAvatarAutoSizeInner' in classes and 'avatar_url' not in self.fields:
+            self.next_img_field = 'avatar_url'
+
+
+def parse_workshop_page(html):
+    """Get the fields of a workshop item from its page
+    Returns:
+        dict: name, author_url, description, size (str), date (UTC datetime), num_comments (str), num_ratings (str),
+            score (int 0-4) and preview_url. Fields that can't be found are None, num_ratings and score are 0.
+    """
+    fields = WorkshopPageParser().extract(html)
+    score = 0
+    if fields.get('score_image_url'):
+        score_image_filename = urlparse(fields['score_image_url']).path.split('/')[-1]
+        for i in range(5):
+            if str(i) in score_image_filename:
+                score = i
+    return {'name': fields.get('name'),
+            'author_url': fields.get('author_url'),
+            'description': fields.get('description'),
+            'size': fields['size'].split(' ')[0] if 'size' in fields else None,
+            'date': parse_workshop_date(fields['date']) if 'date' in fields else None,
+            'num_comments': fields.get('num_comments'),
+            'num_ratings': fields['num_ratings'].split(' ')[0] if 'num_ratings' in fields else 0,
+            'score': score,
+            'preview_url': fields.get('preview_url')}
+
+
+def parse_workshop_date(date_text):
+    """Parse the date of a workshop page, formatted 'dd nov @ 12:00am' or 'dd nov, yyyy @ 12:00am' where nov is a three
+    letter month, or with the month first when steam answers in american english. Returns a UTC datetime."""
+    try:
+        if ',' in date_text:
+            date = datetime.strptime(date_text, '%d %b, %Y @ %I:%M%p')
+        else:
+            date = datetime.strptime(date_text, '%d %b @ %I:%M%p')
+            date = date.replace(year=datetime.now().year)
+    except ValueError:
+        # When deploying on heroku date format is american ie Oct 20th instead of 20th oct
+        if ',' in date_text:
+            date = datetime.strptime(date_text, '%b %d, %Y @ %I:%M%p')
+        else:
+            date = datetime.strptime(date_text, '%b %d @ %I:%M%p')
+            date = date.replace(year=datetime.now().year)
+    # Default steam time seems to be UTC-8 ->  add 8 hours to get UTC time
+    return date + timedelta(hours=8)
+
+
+def parse_workshop_search(html):
+    """Get the workshop id of the first result on a workshop search page, or None if there are no results"""
+    url = WorkshopSearchParser().extract(html).get('url')
+    if not url:
+        return None
+    # https://steamcommunity.com/sharedfiles/filedetails/?id=808465963&searchtext=daanstrafe01
+    return int(parse_qs(urlparse(url).query)['id'][0])
+
+
+def parse_profile_page(html):
+    """Get the (name, avatar url) of the html version of a steam profile, either may be None"""
+    fields = ProfilePageParser().extract(html)
+    return fields.get('name'), fields.get('avatar_url')
+
+
+def parse_profile_xml(xml):
+    """Get the (steam64 id, name, avatar url) of the xml version of a steam profile, any may be None"""
+    values = {}
+    for child in fromstring(xml):
+        if child.tag in ('steamID64', 'steamID', 'avatarFull'):
+            values.setdefault(child.tag, child.text)
+    return values.get('steamID64'), values.get('steamID'), values.get('avatarFull')
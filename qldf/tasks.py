@@ -1,280 +1,638 @@
 """Background tasks to be run periodically or when invoked"""
+import hashlib
 import json
-from urllib.request import Request, urlopen
-from urllib.parse import parse_qs, urlparse
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from flask import current_app
+from werkzeug.http import http_date
 from qldf import db
-from qldf.models import Server, Player, Map, WorkshopItem
-from datetime import datetime, timedelta
-from xml.etree.ElementTree import fromstring, ElementTree
-from bs4 import BeautifulSoup
+from qldf.models import Server, Player, Map, WorkshopItem, DataVersion, WorldRecord, Record, RecordWatermark, utcnow
+from qldf.aggregates import update_partitions
+from qldf.snapshots import write_snapshot
+from qldf.exports import write_record_exports
+from qldf.outbound import OutboundScheduler, SkippedRequest, requeue, requeued_first
+from qldf.refresh import due_rows, next_refresh, retry_later, write_schedules, pull_forward
+from qldf.leases import task_lease
+from qldf.stats import publish_stats
+from qldf.http_client import http_client
+from qldf.steam_pages import parse_workshop_page, parse_workshop_search, parse_profile_page, parse_profile_xml
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import parse as parse_date
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+
+# Snapshot of the map catalogue, the versions of the tables it was built from and those tables
+MAPS_SNAPSHOT = 'maps.json'
+MAPS_VERSIONS_SNAPSHOT = 'maps_versions.json'
+MAPS_TABLES = (Map.__tablename__, WorkshopItem.__tablename__)
+# Snapshot of the server browser, the versions of the tables it was built from and those tables
+SERVERS_SNAPSHOT = 'servers.json'
+SERVERS_VERSIONS_SNAPSHOT = 'servers_versions.json'
+SERVERS_TABLES = (Server.__tablename__, Record.__tablename__, Player.__tablename__)
+# Query arguments of the qlrace.com map api per record mode
+QLRACE_MODES = {0: {'weapons': 'true', 'physics': 'turbo'},
+                1: {'weapons': 'false', 'physics': 'turbo'},
+                2: {'weapons': 'true', 'physics': 'classic'},
+                3: {'weapons': 'false', 'physics': 'classic'}}
+# Rows inserted per statement by ingest_records
+INGEST_BATCH_SIZE = 1000
+# Parts of a workshop page that change on every request, the scripts hold session ids and tokens
+VOLATILE_PAGE_PARTS = re.compile(r'<script\b.*?</script>', re.IGNORECASE | re.DOTALL)
 
 
 def qldf_task(wrapped_task):
-    """Log start and end of task and any errors and supply app context"""
+    """Log start and end of task and any errors and supply app context. The task only runs if its lease can be taken,
+    so a single process in the deployment runs it at a time, see qldf.leases. After every run the outbound request
+    statistics of the process are published for the api, see qldf.stats."""
     def wrapper():
-        with db.app.app_context():
+        with db.app.app_context(), \
+                task_lease(wrapped_task.__name__, current_app.config['TASK_LEASE_SECONDS']) as acquired:
+            if not acquired:
+                current_app.logger.info(f'Task {wrapped_task.__name__} skipped, it is running elsewhere.')
+                return None
             current_app.logger.info(f'Task {wrapped_task.__name__} starting.')
             try:
                 return_value = wrapped_task()
             except Exception as e:
                 import traceback
                 current_app.logger.error(f'Task {wrapped_task.__name__} failure: {traceback.format_exc()}')
-                return None
-            current_app.logger.info(f'Task {wrapped_task.__name__} complete.')
+                return_value = None
+            else:
+                current_app.logger.info(f'Task {wrapped_task.__name__} complete.')
+            publish_stats('http', http_client.stats())
             return return_value
     return wrapper
 
 
-def get_data_from_url(url, _json=False, params=None):
-    # Don't pass params via urlencode and data,
-    # Manually edit the url
-    # The api only responds to GET requests
-    if params:
-        url += '?'
-        for key, value in params.items():
-            url += str(key) + '=' + str(value) + '&'
-        if url[-1] in '&?':
-            url = url[:-1]
-    req = Request(url)
-    req.add_header('User-Agent', 'qldf.com worker')
-    req.add_header('Accept', 'application/json')
-    if _json:
-        return json.loads(urlopen(req).read().decode())
-    else:
-        return urlopen(req).read().decode()
-
-
 @qldf_task
 def update_servers():
     # Retrieve a dict of all servers
     server_api_url = current_app.config['SYNCORE_SERVERS_URL']
     params = {'serverKeywords': 'qlrace.com',
               'hasPassword': 'false'}
-    data = get_data_from_url(server_api_url, True, params)
-    server_ids = []
-    for server in data['servers']:
-        server_id = server['serverID']
-        server_ids.append(server_id)
-        address = server['address']
-        country = server['location']['countryName']
-        map = server['info']['map']
-        max_players = server['info']['maxPlayers']
-        name = server['info']['serverName']
-        keywords = server['info']['extra']['keywords']
-        players = server['players']
-        for d in players:
-            del d['secsConnected']
-        players = json.dumps(players)
-        # Check if server with server id exists if yes update, else insert
-        server_row = db.session.query(Server).\
-            filter(Server.server_id == server_id).\
-            first()
-        if server_row:
-            # Update server rows
-            db.session.query(Server).\
-                filter(Server.server_id == server_id).\
-                update({'server_id': server_id,
-                        'address': address,
-                        'country': country,
-                        'map': map,
-                        'max_players': max_players,
-                        'players': players,
-                        'name': name,
-                        'keywords': keywords})
-            db.session.commit()
-        else:
-            new_server = Server(server_id=server_id,
-                                address=address,
-                                country=country,
-                                map=map,
-                                max_players=max_players,
-                                players=players,
-                                name=name,
-                                keywords=keywords)
-            db.session.add(new_server)
+    scheduler = OutboundScheduler.from_config(current_app.config)
+    data = scheduler.request(http_client.get_json, server_api_url, params)
+    changed, deleted = sync_servers(data['servers'])
+    current_app.logger.info(f'Task update_servers: {len(data["servers"])} servers, {changed} inserted or updated, '
+                            f'{deleted} deleted')
+    # Players on the servers and the workshop items of the maps being played are worth refreshing soon
+    names = {Player.make_search_name(player['name']) for server in data['servers'] for player in server['players']}
+    pull_forward(Player, Player.search_name.in_(names), current_app.config)
+    map_names = {server['info']['map'] for server in data['servers']}
+    pull_forward(WorkshopItem,
+                 WorkshopItem.id.in_(db.session.query(Map.workshop_item_id).filter(Map.name.in_(map_names))),
+                 current_app.config)
+    # An unchanged server list leaves the cached pages and the snapshot alone
+    if changed or deleted:
+        DataVersion.bump(Server.__tablename__)
+    db.session.commit()
+    if changed or deleted:
+        # Publish the server browser snapshot served by the servers view
+        write_servers_snapshot()
+
+
+def sync_servers(servers):
+    """Make the server table match the syncore server data in a single transaction: servers are upserted
+    SERVER_UPSERT_BATCH_SIZE at a time, leaving rows that did not change alone so their date_modified stays put,
+    and servers syncore no longer lists are deleted in one statement. Does not commit.
+    Returns:
+        tuple: (number of servers inserted or updated, number of servers deleted)
+    """
+    rows = {}
+    for server in servers:
+        # Later duplicates win, a single statement can't update the same row twice
+        rows[server['serverID']] = {'server_id': server['serverID'],
+                                    'address': server['address'],
+                                    'country': server['location']['countryName'],
+                                    'map': server['info']['map'],
+                                    'max_players': server['info']['maxPlayers'],
+                                    'name': server['info']['serverName'],
+                                    'keywords': server['info']['extra']['keywords'],
+                                    'players': json.dumps([{key: value for key, value in player.items()
+                                                            if key != 'secsConnected'}
+                                                           for player in server['players']])}
+    rows = list(rows.values())
+    changed = 0
+    columns = ('address', 'country', 'map', 'max_players', 'name', 'keywords', 'players')
+    batch_size = current_app.config['SERVER_UPSERT_BATCH_SIZE']
+    for i in range(0, len(rows), batch_size):
+        statement = insert(Server).values(rows[i:i + batch_size])
+        statement = statement.on_conflict_do_update(
+            index_elements=[Server.server_id],
+            set_=dict({column: statement.excluded[column] for column in columns}, date_modified=utcnow()),
+            where=or_(*[getattr(Server, column).is_distinct_from(statement.excluded[column]) for column in columns]))
+        changed += db.session.execute(statement).rowcount
+    query = db.session.query(Server)
+    if rows:
+        query = query.filter(Server.server_id.notin_([row['server_id'] for row in rows]))
+    deleted = query.delete(synchronize_session=False)
+    return changed, deleted
+
+
+def write_servers_snapshot():
+    """Write the server browser snapshot served by the servers view, together with the versions of the tables it was
+    built from so the view can tell when it is out of date."""
+    versions = DataVersion.current()
+    write_snapshot(SERVERS_SNAPSHOT, build_servers_snapshot())
+    write_snapshot(SERVERS_VERSIONS_SNAPSHOT, [versions.get(table_name, (0, None))[0] for table_name in SERVERS_TABLES])
+
+
+def build_servers_snapshot():
+    """Prepare the server browser data from the server table: players sorted by fastest time, servers sorted by
+    playercount and the world records of the map being played on each server."""
+    servers = db.session.query(Server).order_by(Server.server_id).all()
+    map_names = list(set(server.map for server in servers))
+    world_records = {}
+    rows = db.session.query(Map.name.label('map_name'),
+                            Record.mode,
+                            Record.date,
+                            Record.time,
+                            Player.name.label('player_name'),
+                            Player.steam_id,
+                            Record.rank).\
+        select_from(WorldRecord).\
+        join(Map).\
+        join(Record, WorldRecord.record_id == Record.id).\
+        join(Player).\
+        filter(Map.name.in_(map_names)).\
+        order_by(Record.mode)
+    for row in rows:
+        world_records.setdefault(row.map_name, []).append({'mode': row.mode,
+                                                           'date': row.date.isoformat(),
+                                                           'time': row.time,
+                                                           'player_name': row.player_name,
+                                                           'steam_id': row.steam_id,
+                                                           'rank': row.rank})
+    snapshot = []
+    for server in servers:
+        players = [{'name': player['name'],
+                    'score': player['score'],
+                    'totalConnected': player['totalConnected']} for player in json.loads(server.players or '[]')]
+        snapshot.append({'server_id': server.server_id,
+                         'address': server.address,
+                         'country': server.country,
+                         'map': server.map,
+                         'max_players': server.max_players,
+                         'name': server.name,
+                         'keywords': server.keywords,
+                         'players': sorted(players, key=lambda k: k['score']),
+                         'world_records': world_records.get(server.map, []),
+                         'date_modified': server.date_modified.isoformat()})
+    return sorted(snapshot, key=lambda k: len(k['players']), reverse=True)
+
+
+@qldf_task
+def export_records():
+    """Write the bulk record dumps and daily deltas served by the exports api"""
+    write_record_exports()
+
+
+@qldf_task
+def ingest_records():
+    """Add the records set on qlrace.com since the last run. The qlrace.com api has no way to ask for new records
+    only, so every map and mode is fetched with a conditional GET and only the records at or after the watermark of
+    that map and mode are inserted. Records already stored are skipped by their (match_guid, player_id), new maps and
+    players are inserted along the way and the ranks, world records and player statistics of each changed map and mode
+    are updated incrementally. Each map and mode is committed on its own, failed and skipped ones are fetched first
+    next run. Records removed from qlrace.com are not removed here, that still takes a full db_populate."""
+    scheduler = OutboundScheduler.from_config(current_app.config)
+    map_names = scheduler.request(http_client.get_json, current_app.config['QLRACE_MAPS_URL'])['maps']
+    statement = insert(Map).\
+        values([{'name': map_name} for map_name in map_names]).\
+        on_conflict_do_nothing(index_elements=[Map.name])
+    new_maps = db.session.execute(statement).rowcount if map_names else 0
+    if new_maps:
+        DataVersion.bump(Map.__tablename__)
+    db.session.commit()
+    map_ids = dict(db.session.query(Map.name, Map.id))
+    watermarks = {(row.map_id, row.mode): row.date for row in db.session.query(RecordWatermark)}
+    partitions = [(map_name, mode) for map_name in map_names for mode in QLRACE_MODES]
+    partitions = requeued_first('ingest_records', partitions, lambda partition: partition)
+    pages = fetch_qlrace_records(partitions,
+                                 current_app.config['QLRACE_MAP_URL'],
+                                 current_app.config['INGEST_RECORDS_CONCURRENCY'],
+                                 scheduler)
+    changed = 0
+    unchanged = 0
+    failures = 0
+    new_records = 0
+    new_players = 0
+    not_done = []
+    for (map_name, mode), records in pages:
+        if records is None:
+            unchanged += 1
+            continue
+        try:
+            if isinstance(records, Exception):
+                raise records
+            map_id = map_ids[map_name]
+            for record in records:
+                record['date'] = parse_qlrace_date(record['date'])
+            watermark = watermarks.get((map_id, mode))
+            records = [record for record in records if watermark is None or record['date'] >= watermark]
+            if not records:
+                unchanged += 1
+                continue
+            players, inserted = ingest_partition(map_id, mode, records)
+            set_watermark(map_id, mode, max(record['date'] for record in records))
+            if players:
+                DataVersion.bump(Player.__tablename__)
             db.session.commit()
-    # Remove any server ids in the database that no longer exist according to syncore
-    # Get all server ids
-    current_ids = db.session.query(Server.id,
-                                   Server.server_id).all()
+        except Exception as e:
+            db.session.rollback()
+            # Fetch in full next time
+            http_client.forget(current_app.config['QLRACE_MAP_URL'] + map_name, QLRACE_MODES[mode])
+            not_done.append((map_name, mode))
+            if not isinstance(e, SkippedRequest):
+                failures += 1
+                current_app.logger.info(f'Task ingest_records: failed to ingest {map_name} mode {mode}: {e!r}')
+            continue
+        changed += bool(inserted)
+        unchanged += not inserted
+        new_records += inserted
+        new_players += players
+    requeue('ingest_records', not_done)
+    current_app.logger.info(f'Task ingest_records: {len(partitions)} map modes, {changed} changed, {unchanged} unchanged, '
+                            f'{failures} failed, {len(not_done) - failures} skipped; added {new_records} records, '
+                            f'{new_players} players and {new_maps} maps')
+
+
+def fetch_qlrace_records(partitions, map_url, concurrency, scheduler):
+    """Fetch the qlrace.com records of maps and modes concurrently
+    Args:
+        partitions (list): (map name, mode) tuples
+        map_url (str): qlrace.com map api base url, the map name is appended
+        concurrency (int): Number of pages fetched at the same time
+        scheduler (OutboundScheduler): Sends the requests
+    Yields:
+        tuple: ((map name, mode), records) in the order of partitions, records is None if they did not change since
+            the last fetch or an exception if fetching failed, a SkippedRequest if it was not attempted
+    """
+    def fetch(partition):
+        map_name, mode = partition
+        try:
+            page = scheduler.request(http_client.get_json, map_url + map_name, QLRACE_MODES[mode], conditional=True)
+            return partition, None if page is None else page['records']
+        except Exception as e:
+            return partition, e
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(fetch, partitions)
+
+
+def fetch_map_records(map_url, map_name):
+    """Get every qlrace.com record of a map the way db_populate caches them: modes 3 to 0, each record with the map name
+    added. Raises requests.RequestException if fetching fails."""
+    records = []
+    for mode in sorted(QLRACE_MODES, reverse=True):
+        for record in http_client.get_json(map_url + map_name, QLRACE_MODES[mode])['records']:
+            record['map'] = map_name
+            records.append(record)
+    return records
+
+
+def ingest_partition(map_id, mode, records):
+    """Insert the qlrace.com records of a map and mode and the players that set them, skipping the ones already stored,
+    and update the derived data of the map and mode. Does not commit.
+    Returns:
+        tuple: (number of players inserted, number of records inserted)
+    """
+    players = {str(record['player_id']): record['name'] for record in records}
+    new_players = 0
+    for rows in batches([{'steam_id': steam_id, 'name': name, 'search_name': Player.make_search_name(name)}
+                         for steam_id, name in players.items()]):
+        statement = insert(Player).\
+            values(rows).\
+            on_conflict_do_nothing(index_elements=[Player.steam_id])
+        new_players += db.session.execute(statement).rowcount
+    player_ids = dict(db.session.query(Player.steam_id, Player.id).filter(Player.steam_id.in_(players)))
+    inserted = 0
+    for rows in batches([{'map_id': map_id,
+                          'mode': mode,
+                          'player_id': player_ids[str(record['player_id'])],
+                          'time': record['time'],
+                          'match_guid': record['match_guid'],
+                          'date': record['date']} for record in records]):
+        statement = insert(Record).\
+            values(rows).\
+            on_conflict_do_nothing(index_elements=[Record.match_guid, Record.player_id])
+        inserted += db.session.execute(statement).rowcount
+    if inserted:
+        # qlrace.com only keeps the best record of each player, drop the ones that were improved on
+        sq = db.session.query(Record.id.label('id'),
+                              func.row_number().over(partition_by=Record.player_id,
+                                                     order_by=(Record.time, Record.date, Record.id)).label('n')).\
+            filter(Record.map_id == map_id,
+                   Record.mode == mode,
+                   Record.player_id.in_(player_ids.values())).\
+            subquery()
+        db.session.query(Record).\
+            filter(Record.id.in_(db.session.query(sq.c.id).filter(sq.c.n > 1))).\
+            delete(synchronize_session=False)
+        update_partitions([(map_id, mode)])
+        # Players setting records and the workshop item of a map being played are worth refreshing soon
+        pull_forward(Player, Player.steam_id.in_(players), current_app.config)
+        pull_forward(WorkshopItem,
+                     WorkshopItem.id.in_(db.session.query(Map.workshop_item_id).filter(Map.id == map_id)),
+                     current_app.config)
+    return new_players, inserted
+
+
+def set_watermark(map_id, mode, date):
+    """Store date as the newest record ingested for a map and mode, does not commit"""
+    statement = insert(RecordWatermark).values(map_id=map_id, mode=mode, date=date)
+    statement = statement.on_conflict_do_update(index_elements=[RecordWatermark.map_id, RecordWatermark.mode],
+                                                set_={'date': func.greatest(RecordWatermark.date,
+                                                                            statement.excluded.date),
+                                                      'date_modified': utcnow()})
+    db.session.execute(statement)
+
 
-    ids_to_remove = []
-    for ids in current_ids:
-        if ids.server_id not in server_ids:
-            ids_to_remove.append(ids.id)
-    for id in ids_to_remove:
-        Server.query.filter(Server.id==id).delete()
-        db.session.commit()
+def parse_qlrace_date(text):
+    """Parse a qlrace.com record date as a naive UTC datetime like the ones stored"""
+    try:
+        # Much faster than dateutil, which matters when loading every record
+        date = datetime.fromisoformat(text[:-1] + '+00:00' if text.endswith('Z') else text)
+    except ValueError:
+        date = parse_date(text)
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def batches(rows, size=INGEST_BATCH_SIZE):
+    """Split rows into lists of at most size rows"""
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
 
 
 @qldf_task
 def update_players():
-    """Update the name of every player in the database by querying steam by their steam64ID"""
-    # Get steam ids
-    players = db.session.query(Player.steam_id, Player.name, Player.avatar_url).all()
-    for player in players:
-        xml = get_data_from_url(current_app.config['STEAMPLAYER_PROFILE_URL']+player.steam_id, params={'xml': 1})
-        root = ElementTree(fromstring(xml)).getroot()
-        name = None
-        avatar_url = None
-        for child in root:
-            if child.tag == 'steamID':
-                name = child.text
-            elif child.tag == 'avatarFull':
-                avatar_url = child.text
-        if name is None:
-            # Player appears to not exist anymore?
-            # Looks like this happens if steam community profile isnt set up
-            # Try looking for name and avatar in the html version, if still can't find any then keep the old ones
-            html = get_data_from_url(current_app.config['STEAMPLAYER_PROFILE_URL']+player.steam_id)
-            soup = BeautifulSoup(html, 'html.parser')
-            name = soup.find('span', {'class': 'actual_persona_name'})
-            if name:
-                name = name.text
-            else:
-                name = player.name
+    """Update the name and avatar of the players that are due by querying steam by their steam64ID, at most
+    UPDATE_PLAYERS_LIMIT of them and the most overdue first, see qldf.refresh. Players that set a record in the last
+    REFRESH_ACTIVE_DAYS count as active. Profiles are fetched by UPDATE_PLAYERS_CONCURRENCY threads through an
+    OutboundScheduler and written UPDATE_PLAYERS_BATCH_SIZE players at a time. Players whose profile digest did not
+    change only get their next refresh scheduled, which leaves their date_modified alone. Players that were skipped stay due and are handled first next run."""
+    config = current_app.config
+    players = due_rows(db.session.query(Player.id, Player.steam_id, Player.name, Player.avatar_url,
+                                        Player.profile_digest, Player.refresh_interval, Player.last_record_date),
+                       Player, config['UPDATE_PLAYERS_LIMIT']).all()
+    profiles = fetch_player_profiles(players,
+                                     config['STEAMPLAYER_PROFILE_URL'],
+                                     config['UPDATE_PLAYERS_CONCURRENCY'],
+                                     OutboundScheduler.from_config(config))
+    active_since = datetime.utcnow() - timedelta(days=config['REFRESH_ACTIVE_DAYS'])
+    batch = []
+    schedules = []
+    updated = 0
+    failures = 0
+    unchanged = 0
+    skipped = 0
+    for player, profile in profiles:
+        if isinstance(profile, SkippedRequest):
+            skipped += 1
+            continue
+        if isinstance(profile, Exception):
+            failures += 1
+            current_app.logger.info(f'Task update_players: failed to fetch player {player.steam_id}: {profile}')
+            schedules.append(dict(retry_later(player.refresh_interval, config), id=player.id))
+            continue
+        digest = player.profile_digest if profile is None else profile_digest(profile)
+        changed = digest != player.profile_digest
+        active = player.last_record_date is not None and player.last_record_date >= active_since
+        schedules.append(dict(next_refresh(player.refresh_interval, changed, active, config), id=player.id))
+        if changed:
+            name, avatar_url = profile
+            if name is None:
                 current_app.logger.info(f'Task update_players: can\'t find name for player {player.steam_id}')
-            avatar_div = soup.find('div', {'class': 'playerAvatarAutoSizeInner'})
-            if avatar_div:
-                avatar_url = avatar_div.find_next('img')['src']
-            else:
-                avatar_url = player.avatar_url
-        # Update player name and avatar url
-        db.session.query(Player).\
-            filter(Player.steam_id == player.steam_id).\
-            update({'name': name,
-                    'avatar_url': avatar_url})
-        db.session.commit()
+                name = player.name
+            batch.append({'id': player.id,
+                          'name': name,
+                          'search_name': Player.make_search_name(name),
+                          'avatar_url': avatar_url or player.avatar_url,
+                          'profile_digest': digest})
+            updated += 1
+        else:
+            unchanged += 1
+        if len(schedules) >= config['UPDATE_PLAYERS_BATCH_SIZE']:
+            db.session.bulk_update_mappings(Player, batch)
+            write_schedules(Player, schedules)
+            db.session.commit()
+            batch = []
+            schedules = []
+    db.session.bulk_update_mappings(Player, batch)
+    write_schedules(Player, schedules)
+    if updated:
+        DataVersion.bump(Player.__tablename__)
+    db.session.commit()
+    current_app.logger.info(f'Task update_players: {len(players)} players due, {updated} updated, '
+                            f'{unchanged} unchanged, {failures} failed, {skipped} skipped')
+
+
+def profile_digest(profile):
+    """Digest of the (name, avatar url) of a steam profile. Not of the profile xml itself, that also holds the
+    online state and play time of the player and so changes far more often than anything stored."""
+    return hashlib.sha1(json.dumps(profile).encode()).hexdigest()
+
+
+def page_digest(html):
+    """Digest of a workshop page without the parts that change on every request"""
+    return hashlib.sha1(VOLATILE_PAGE_PARTS.sub('', html).encode()).hexdigest()
+
+
+def fetch_player_profiles(players, profile_url, concurrency, scheduler):
+    """Fetch the steam profiles of players concurrently
+    Args:
+        players: Rows with a steam_id
+        profile_url (str): Steam profile base url, the steam id is appended
+        concurrency (int): Number of profiles fetched at the same time
+        scheduler (OutboundScheduler): Sends the requests
+    Yields:
+        tuple: (player, (name, avatar url)) in the order of players, either of which may be None if not found,
+            (player, None) if the profile did not change since the last fetch or (player, exception) if fetching failed,
+            a SkippedRequest if it was not attempted
+    """
+    def fetch(player):
+        url = profile_url + player.steam_id
+        try:
+            return player, fetch_player_profile(url, scheduler)
+        except Exception as e:
+            # Fetch in full next time
+            http_client.forget(url, {'xml': 1})
+            return player, e
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(fetch, players)
+
+
+def fetch_player_profile(url, scheduler):
+    """Get the name and avatar url of the steam profile at url
+    Returns:
+        tuple: (name, avatar url), either may be None if it can't be found, or None if the profile did not change
+    """
+    xml = scheduler.request(http_client.get_text, url, params={'xml': 1}, conditional=True)
+    if xml is None:
+        return None
+    _, name, avatar_url = parse_profile_xml(xml)
+    if name is None:
+        # Player appears to not exist anymore?
+        # Looks like this happens if steam community profile isnt set up
+        # Try looking for name and avatar in the html version, if still can't find any then keep the old ones
+        html = scheduler.request(http_client.get_text, url)
+        name, html_avatar_url = parse_profile_page(html)
+        avatar_url = html_avatar_url or avatar_url
+    return name, avatar_url
 
 
 @qldf_task
 def update_workshop_items():
-    """Update the workshop data for every workshopitem"""
+    """Update the workshop data of the workshop items that are due, at most UPDATE_WORKSHOPITEMS_LIMIT of them and the
+    most overdue first, see qldf.refresh. Items with a map that got a record in the last REFRESH_ACTIVE_DAYS count as
+    active. Pages whose digest did not change since the item was last updated are neither parsed nor written, the item
+    only gets its next refresh scheduled, which leaves its date_modified alone. Items that were skipped stay due and are handled first next run."""
+    config = current_app.config
+    scheduler = OutboundScheduler.from_config(config)
     # Get all maps without a workshopitem and try finding one
     maps_without_workshopitem = db.session.query(Map).\
-        filter(Map.workshop_item_id is None).\
+        filter(Map.workshop_item_id.is_(None)).\
         all()
+    linked = 0
+    created = 0
     for _map in maps_without_workshopitem:
-        html = get_data_from_url(current_app.config['STEAMWORKSHOP_SEARCH_URL']+_map.name)
-        soup = BeautifulSoup(html, 'html.parser')
+        try:
+            html = scheduler.request(http_client.get_text, current_app.config['STEAMWORKSHOP_SEARCH_URL']+_map.name)
+        except Exception as e:
+            # Searched again next run
+            current_app.logger.info(f'Task update_workshop_items: failed to search for map {_map.name}: {e!r}')
+            continue
         # Find the map name in the search results
-        name_div = soup.find('div', {'class': 'workshopItemTitle ellipsis'})
-        if name_div:
-            # Extract the workshopitem url from the html
-            workshop_item_url = name_div.find_previous('a')['href']
-            # Extract the workshop item id from the url
-            workshop_id = int(parse_qs(urlparse(workshop_item_url).query)['id'][0])
-            # Create a new empty workshopitem and link it to the map
-            new_workshop_item = WorkshopItem(item_id=workshop_id)
-            db.session.add(new_workshop_item)
-            db.session.commit()
+        workshop_id = parse_workshop_search(html)
+        if workshop_id:
+            # Link the map to the workshop item, a new empty one unless another map of the same item has one already
+            workshop_item = db.session.query(WorkshopItem).filter(WorkshopItem.item_id == str(workshop_id)).first()
+            if workshop_item is None:
+                workshop_item = WorkshopItem(item_id=str(workshop_id))
+                db.session.add(workshop_item)
+                db.session.flush()
+                created += 1
             db.session.query(Map).\
                 filter(Map.id == _map.id).\
-                update({'workshop_item_id': workshop_id})
+                update({'workshop_item_id': workshop_item.id})
             db.session.commit()
-    # Update all workshop items. If no new data can be found keep the old data
+            linked += 1
+    # Update the due workshop items. If no new data can be found keep the old data
     # Atm score and num ratings will be set to 0 while other data is kept the same in thes second case
-    workshop_items = db.session.query(WorkshopItem).all()
+    workshop_items = due_rows(db.session.query(WorkshopItem), WorkshopItem, config['UPDATE_WORKSHOPITEMS_LIMIT']).all()
+    active_since = datetime.utcnow() - timedelta(days=config['REFRESH_ACTIVE_DAYS'])
+    active_ids = {row.workshop_item_id for row in db.session.query(Map.workshop_item_id).
+                  join(RecordWatermark, RecordWatermark.map_id == Map.id).
+                  filter(Map.workshop_item_id.in_([item.id for item in workshop_items]),
+                         RecordWatermark.date >= active_since).
+                  distinct()}
+    schedules = []
+    updated = 0
+    unchanged = 0
+    failures = 0
+    skipped = 0
     for item in workshop_items:
-        html = get_data_from_url(current_app.config['STEAMWORKSHOP_ITEM_URL'] + item.item_id)
-        soup = BeautifulSoup(html, 'html.parser')
-        # find item name
-        name = soup.find('div', {'class': 'workshopItemTitle'})
-        if name:
-            name = name.text
-        else:
-            name = item.name
-            current_app.logger.info(f'Task update_workshop_items: can\'t find name for item {item.item_id}')
-        # find item author steam64ID
-        author_url = soup.find('a', {'class': 'friendBlockLinkOverlay'})
-        author_id = None
-        if author_url:
-            author_url = author_url['href']
-            # Check if url is steam64 id or custom url
-            path = urlparse(author_url).path.split('/')
-            if path[1] == 'profiles':
-                author_id = path[2]
+        item_id, interval = item.id, item.refresh_interval
+        url = config['STEAMWORKSHOP_ITEM_URL'] + item.item_id
+        try:
+            html = scheduler.request(http_client.get_text, url, conditional=True)
+            digest = item.page_digest if html is None else page_digest(html)
+            changed = digest != item.page_digest
+            if changed:
+                update_workshop_item(item, html, scheduler, digest)
+                updated += 1
             else:
-                # fetch the steam64 id belonging to the author url
-                xml = get_data_from_url(author_url + '/?xml=1')
-                root = ElementTree(fromstring(xml)).getroot()
-                author_id = None
-                for child in root:
-                    if child.tag == 'steamID64':
-                        author_id = child.text
-                        break
-        if not author_id:
-            author_id = item.author_steam_id
-        # find item description
-        description = soup.find('div', {'class': 'workshopItemDescription'})
-        if description:
-            description = description.get_text(separator='\n')
-        else:
-            description = item.description
-        # find item date and size
-        div = soup.find('div', {'class': 'detailsStatsContainerRight'})
-        date = None
-        size = None
-        if div:
-            subdivs = div.find_all('div', {'class': 'detailsStatRight'})
-            if subdivs:
-                size = subdivs[0].text.split(' ')[0]
-                date_text = subdivs[1].text
-                # Parse date text, assumed format 'dd nov @ 12:00am' or 'dd nov, yyyy @ 12:00am', where nov is a three day month
-                try:
-                    if ',' in date_text:
-                        date = datetime.strptime(date_text, '%d %b, %Y @ %I:%M%p')
-                    else:
-                        date = datetime.strptime(date_text, '%d %b @ %I:%M%p')
-                        date = date.replace(year=datetime.now().year)
-                except ValueError:
-                    # When deploying on heroku date format is american ie Oct 20th instead of 20th oct
-                    if ',' in date_text:
-                        date = datetime.strptime(date_text, '%b %d, %Y @ %I:%M%p')
-                    else:
-                        date = datetime.strptime(date_text, '%b %d @ %I:%M%p')
-                        date = date.replace(year=datetime.now().year)
-                # Default steam time seems to be UTC-8 ->  add 8 hours to get UTC time to store
-        if date:
-            date += timedelta(hours=8)
-            date = date.isoformat()
-        else:
-            date = item.date
-        if not size:
-            size = item.size
-        # find item num comments
-        num_comments = soup.find_all('span', {'class': 'tabCount'})[1]
-        if num_comments:
-            num_comments = num_comments.text
-        else:
-            num_comments = item.num_comments
-        # find item score and number of scores
-        num_ratings = soup.find('div', {'class': 'numRatings'})
-        if num_ratings:
-            num_ratings = num_ratings.text.split(' ')[0]
+                unchanged += 1
+            schedules.append(dict(next_refresh(interval, changed, item_id in active_ids, config), id=item_id))
+        except Exception as e:
+            db.session.rollback()
+            # Fetch in full next time
+            http_client.forget(url)
+            if isinstance(e, SkippedRequest):
+                skipped += 1
+            else:
+                failures += 1
+                current_app.logger.info(f'Task update_workshop_items: failed to update item {item.item_id}: {e!r}')
+                schedules.append(dict(retry_later(interval, config), id=item_id))
+    write_schedules(WorkshopItem, schedules)
+    current_app.logger.info(f'Task update_workshop_items: {linked} of {len(maps_without_workshopitem)} maps linked, '
+                            f'{len(workshop_items)} items due, {updated} updated, {unchanged} unchanged, '
+                            f'{failures} failed, {skipped} skipped')
+    # Bump only the tables that changed, pages showing maps but no workshop items stay cached when only items changed
+    changed_tables = []
+    if updated or created:
+        changed_tables.append(WorkshopItem.__tablename__)
+    if linked:
+        changed_tables.append(Map.__tablename__)
+    if changed_tables:
+        DataVersion.bump(*changed_tables)
+    db.session.commit()
+    if changed_tables:
+        # Publish the map catalogue served by the maps api
+        write_maps_snapshot()
+
+
+def update_workshop_item(item, html, scheduler, digest=None):
+    """Update a workshop item from its workshop page html, digest is stored as its page_digest.
+    Fields that can't be found on the page keep their current value, except the score and number of scores."""
+    fields = parse_workshop_page(html)
+    name = fields['name']
+    if name is None:
+        name = item.name
+        current_app.logger.info(f'Task update_workshop_items: can\'t find name for item {item.item_id}')
+    # find item author steam64ID
+    author_id = None
+    author_url = fields['author_url']
+    if author_url:
+        # Check if url is steam64 id or custom url
+        path = urlparse(author_url).path.split('/')
+        if path[1] == 'profiles':
+            author_id = path[2]
         else:
-            num_ratings = 0
-        div = soup.find('div', {'class': 'fileRatingDetails'})
-        score_image_url = div.find_next('img')['src']
-        score_image_filename = urlparse(score_image_url).path.split('/')[-1]
-        score = 0
-        for i in range(5):
-            if str(i) in score_image_filename:
-                score = i
-        # find preview image url
-        preview_url = soup.find('img', {'class': 'workshopItemPreviewImageEnlargeable'})['src']
-        if not preview_url:
-            preview_url = item.preview_url
-        db.session.query(WorkshopItem).\
-            filter(WorkshopItem.id == item.id).\
-            update({'name': name,
-                    'author_steam_id': author_id,
-                    'description': description,
-                    'date': date,
-                    'size': size,
-                    'num_comments': num_comments,
-                    'score': score,
-                    'num_scores': num_ratings,
-                    'preview_url': preview_url})
-        db.session.commit()
+            # fetch the steam64 id belonging to the author url
+            xml = scheduler.request(http_client.get_text, author_url + '/?xml=1')
+            author_id, _, _ = parse_profile_xml(xml)
+    if not author_id:
+        author_id = item.author_steam_id
+    description = fields['description'] if fields['description'] is not None else item.description
+    date = fields['date'] or item.date
+    size = fields['size'] or item.size
+    num_comments = fields['num_comments'] or item.num_comments
+    num_ratings = fields['num_ratings']
+    score = fields['score']
+    preview_url = fields['preview_url'] or item.preview_url
+    db.session.query(WorkshopItem).\
+        filter(WorkshopItem.id == item.id).\
+        update({'name': name,
+                'author_steam_id': author_id,
+                'description': description,
+                'date': date,
+                'size': size,
+                'num_comments': num_comments,
+                'score': score,
+                'num_scores': num_ratings,
+                'preview_url': preview_url,
+                'page_digest': digest})
+    db.session.commit()
+
+
+def write_maps_snapshot():
+    """Write the map catalogue snapshot served by the maps api, together with the versions of the tables it was
+    built from so the api can tell when it is out of date."""
+    versions = DataVersion.current()
+    write_snapshot(MAPS_SNAPSHOT, build_maps_snapshot(), precompress=True)
+    write_snapshot(MAPS_VERSIONS_SNAPSHOT, [versions.get(table_name, (0, None))[0] for table_name in MAPS_TABLES])
+
+
+def build_maps_snapshot():
+    """The map catalogue as {map id: [map, workshop item or None]}, with dates formatted like jsonify does"""
+    def as_dict(row):
+        return {key: http_date(value) if isinstance(value, datetime) else value for key, value in row._asdict().items()}
+    columns = [column for column in WorkshopItem.__table__.columns
+               if column.name not in ('page_digest', 'next_refresh_at', 'refresh_interval')]
+    workshop_items = {row.id: as_dict(row) for row in db.session.query(*columns)}
+    # The record count changes with the records, which don't bump the map version the snapshot is kept up to date by
+    map_columns = [column for column in Map.__table__.columns if column.name != 'record_count']
+    return {row.id: [as_dict(row), workshop_items.get(row.workshop_item_id)]
+            for row in db.session.query(*map_columns)}
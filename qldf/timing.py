@@ -0,0 +1,122 @@
+"""Per-request performance measurements.
+
+Every request measures the number and total duration of its SQL statements, the time spent rendering templates and
+the total time. These are sent as a Server-Timing header and written as a json line to the request log. Requests
+slower than SLOW_REQUEST_THRESHOLD_MS are also logged as a warning together with the statements they ran.
+The phases of starting a process are timed with PhaseTimings, so cold start regressions show up in the log."""
+import json
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import g, request, has_app_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestTiming:
+    def __init__(self):
+        self.start = perf_counter()
+        self.db_ms = 0.0
+        # [(statement, milliseconds)]
+        self.statements = []
+        self.render_ms = 0.0
+        self._render_start = None
+
+    def total_ms(self):
+        return (perf_counter() - self.start) * 1000
+
+    def server_timing(self, total_ms):
+        return f'db;dur={self.db_ms:.1f};desc="{len(self.statements)} queries", ' \
+               f'render;dur={self.render_ms:.1f}, ' \
+               f'total;dur={total_ms:.1f}'
+
+
+class PhaseTimings:
+    """Durations of the consecutive phases of starting up"""
+    def __init__(self):
+        # {phase name: milliseconds} in the order the phases ran
+        self.ms = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[name] = (perf_counter() - start) * 1000
+
+    def total_ms(self):
+        return sum(self.ms.values())
+
+    def summary(self):
+        return ', '.join(f'{name} {ms:.0f} ms' for name, ms in self.ms.items())
+
+
+def current_timing():
+    """Timing of the current request, or None outside of requests"""
+    return g.get('request_timing') if has_app_context() else None
+
+
+def setup_request_timing(app):
+    """Register the hooks that measure every request. Register before the blueprints,
+    so the after_request hook runs after theirs and the measurement includes them."""
+    request_logger = logging.getLogger('qldf.requests')
+    slow_request_threshold = app.config['SLOW_REQUEST_THRESHOLD_MS']
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    @app.before_request
+    def start_request_timing():
+        g.request_timing = RequestTiming()
+
+    @app.after_request
+    def finish_request_timing(response):
+        timing = current_timing()
+        if timing is None:
+            return response
+        total_ms = timing.total_ms()
+        response.headers['Server-Timing'] = timing.server_timing(total_ms)
+        request_logger.info(json.dumps({'method': request.method,
+                                        'path': request.full_path if request.query_string else request.path,
+                                        'endpoint': request.endpoint,
+                                        'status': response.status_code,
+                                        'total_ms': round(total_ms, 1),
+                                        'db_ms': round(timing.db_ms, 1),
+                                        'queries': len(timing.statements),
+                                        'render_ms': round(timing.render_ms, 1)}))
+        if total_ms > slow_request_threshold:
+            statements = '\n'.join(f'{ms:.1f} ms: {statement}' for statement, ms in timing.statements)
+            app.logger.warning(f'Slow request {request.method} {request.path} took {total_ms:.0f} ms, '
+                               f'{timing.db_ms:.0f} ms in {len(timing.statements)} queries:\n{statements}')
+        return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timing() is not None:
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = current_timing()
+    if timing is not None and conn.info.get('query_start'):
+        ms = (perf_counter() - conn.info['query_start'].pop()) * 1000
+        timing.db_ms += ms
+        timing.statements.append((statement, ms))
+
+
+def _before_render_template(sender, template, context, **extra):
+    timing = current_timing()
+    if timing is not None:
+        timing._render_start = perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    timing = current_timing()
+    if timing is not None and timing._render_start is not None:
+        timing.render_ms += (perf_counter() - timing._render_start) * 1000
+        timing._render_start = None
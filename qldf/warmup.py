@@ -0,0 +1,96 @@
+"""Warm-up of a newly started process, run in a background thread so create_app returns at once and requests are served
+while it runs.
+
+The phases run one after the other: the startup runs of the tasks when RUN_TASKS_ON_STARTUP is set in a process that
+runs the scheduler, compiling every template, and requesting WARMUP_PAGES, which loads the snapshots and primes the
+response, fragment and count caches. A failing phase is logged and the next one runs. Their progress is served by the
+readiness endpoint /api/ready/ and the duration of each phase is logged once they are done."""
+import threading
+import traceback
+from importlib import import_module
+
+from qldf.timing import PhaseTimings
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Warmup:
+    """Warm-up phases of an app and their progress, safe to read from other threads"""
+    def __init__(self, app):
+        self.app = app
+        # [(phase name, function)]
+        self.phases = []
+        self.states = {}
+        self.timings = PhaseTimings()
+        self._lock = threading.Lock()
+
+    def add(self, name, function):
+        self.phases.append((name, function))
+        self.states[name] = PENDING
+
+    def start(self):
+        threading.Thread(target=self.run, name='warmup', daemon=True).start()
+
+    def run(self):
+        for name, function in self.phases:
+            self._set_state(name, RUNNING)
+            with self.timings.phase(name):
+                try:
+                    function(self.app)
+                    state = DONE
+                except Exception:
+                    self.app.logger.error(f'Warm-up phase {name} failure: {traceback.format_exc()}')
+                    state = FAILED
+            self._set_state(name, state)
+        if self.phases:
+            self.app.logger.info(f'Warm-up took {self.timings.total_ms():.0f} ms: {self.timings.summary()}')
+
+    def status(self):
+        """Progress of the phases, ready once every phase ran, failed ones included"""
+        with self._lock:
+            return {'ready': all(state in (DONE, FAILED) for state in self.states.values()),
+                    'phases': [{'name': name,
+                                'state': self.states[name],
+                                'ms': round(self.timings.ms[name], 1) if name in self.timings.ms else None}
+                               for name, _ in self.phases]}
+
+    def _set_state(self, name, state):
+        with self._lock:
+            self.states[name] = state
+
+
+def setup_warmup(app):
+    """Add the warm-up phases that apply to app and start running them"""
+    warmup = Warmup(app)
+    if app.config['SCHEDULER_ENABLED'] and app.config['RUN_TASKS_ON_STARTUP']:
+        warmup.add('tasks', run_startup_tasks)
+    if app.config['WARMUP_ENABLED']:
+        warmup.add('templates', compile_templates)
+        warmup.add('pages', request_pages)
+    app.warmup = warmup
+    warmup.start()
+
+
+def run_startup_tasks(app):
+    """Run every job in JOBS once, in order"""
+    for task in app.config['JOBS']:
+        task_import_name, task_func_name = task['func'].split(':')
+        getattr(import_module(task_import_name), task_func_name)()
+
+
+def compile_templates(app):
+    """Load every template, so they are compiled and cached before the first request needs them"""
+    for name in app.jinja_env.list_templates(extensions=['j2']):
+        app.jinja_env.get_template(name)
+
+
+def request_pages(app):
+    """Request every page in WARMUP_PAGES"""
+    client = app.test_client()
+    for url in app.config['WARMUP_PAGES']:
+        status = client.get(url).status_code
+        if status != 200:
+            app.logger.info(f'Warm-up of {url} got status {status}')
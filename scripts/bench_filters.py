@@ -0,0 +1,65 @@
+"""Benchmark the server browser filters: rendering the world record and player tables on every request against
+serving them from the fragment cache. Uses synthetic servers, the database is not touched.
+Arguments:
+num_servers -- number of synthetic servers, defaults to 200
+"""
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import create_app
+from qldf.root.filters import format_players, format_server_wrs, render_players, render_server_wrs, fragment_cache
+
+NUM_REQUESTS = 20
+
+num_servers = int(sys.argv[1]) if len(sys.argv) >= 2 else 200
+
+
+def make_servers():
+    random.seed(0)
+    servers = []
+    for i in range(num_servers):
+        world_records = [SimpleNamespace(player_name=f'player{random.randrange(1000)}',
+                                         steam_id=str(76561198000000000 + random.randrange(1000)),
+                                         mode=mode,
+                                         time=random.randrange(5000, 300000),
+                                         date=datetime(2018, 1, 1) + timedelta(minutes=random.randrange(500000)))
+                         for mode in random.sample(range(4), random.randint(1, 4))]
+        players = [{'name': f'^{random.randrange(10)}player^7{random.randrange(1000)}',
+                    'score': random.choice([2147483647, random.randrange(5000, 300000)]),
+                    'totalConnected': f'{random.randrange(60)}m'}
+                   for _ in range(random.randint(0, 16))]
+        servers.append((world_records, players))
+    return servers
+
+
+def time_requests(format_wrs, format_players_):
+    """Mean milliseconds per request of formatting the tables of all servers"""
+    start = perf_counter()
+    for _ in range(NUM_REQUESTS):
+        for world_records, players in servers:
+            format_wrs(world_records)
+            format_players_(players)
+    return (perf_counter() - start) * 1000 / NUM_REQUESTS
+
+
+app = create_app('config.scripts_config')
+app.config['FRAGMENT_CACHE_SIZE'] = 2 * num_servers
+servers = make_servers()
+with app.test_request_context('/servers/'):
+    uncached_ms = time_requests(render_server_wrs, render_players)
+    fragment_cache.clear()
+    start = perf_counter()
+    for world_records, players in servers:
+        format_server_wrs(world_records)
+        format_players(players)
+    fill_ms = (perf_counter() - start) * 1000
+    cached_ms = time_requests(format_server_wrs, format_players)
+    print(f'{NUM_REQUESTS} requests of {num_servers} servers')
+    print(f'Rendered every request:    {uncached_ms:8.2f} ms per request')
+    print(f'Filling fragment cache:    {fill_ms:8.2f} ms')
+    print(f'Served from fragment cache: {cached_ms:7.2f} ms per request')
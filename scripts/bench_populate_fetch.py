@@ -0,0 +1,91 @@
+"""Benchmark and check the record fetch phase of db_populate against a local fake qlrace.com api: fetching one map at a
+time like before against fetching them concurrently with checkpoints. The concurrent run is interrupted by failures on
+a tenth of the maps and then resumed, after which its results must be identical to the serial ones.
+The database is not touched.
+Arguments:
+num_maps -- number of maps to fetch, defaults to 200
+latency -- seconds the fake api takes to answer, defaults to 0.02
+concurrency -- number of maps fetched at the same time, defaults to 8
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter, sleep
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf.checkpoints import fetch_with_checkpoints, read_checkpoint
+from qldf.tasks import fetch_map_records
+
+num_maps = int(sys.argv[1]) if len(sys.argv) >= 2 else 200
+latency = float(sys.argv[2]) if len(sys.argv) >= 3 else 0.02
+concurrency = int(sys.argv[3]) if len(sys.argv) >= 4 else 8
+
+
+class FakeQlraceHandler(BaseHTTPRequestHandler):
+    """Answers /api/map/<map>?weapons=..&physics=.. with records that only depend on the request"""
+    def do_GET(self):
+        sleep(latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        mode = {('true', 'turbo'): 0, ('false', 'turbo'): 1,
+                ('true', 'classic'): 2, ('false', 'classic'): 3}[query['weapons'][0], query['physics'][0]]
+        rng = random.Random(f'{url.path}{mode}')
+        records = [{'player_id': 76561198000000000 + rng.randrange(10000),
+                    'name': f'player{rng.randrange(10000)}',
+                    'time': rng.randrange(1000, 100000),
+                    'date': f'2018-01-{rng.randrange(1, 29):02d}T12:00:00Z',
+                    'match_guid': f'{rng.getrandbits(64):x}',
+                    'mode': mode} for _ in range(rng.randrange(50))]
+        body = json.dumps({'records': records}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def timed_fetch(maps, fetch, folder, concurrency):
+    """Maps fetched per second and the failed maps"""
+    start = perf_counter()
+    failed = fetch_with_checkpoints(maps, fetch, folder, concurrency, 'records')
+    return len(maps) / (perf_counter() - start), failed
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeQlraceHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+map_url = f'http://127.0.0.1:{server.server_port}/api/map/'
+maps = [f'map{i}' for i in range(num_maps)]
+interrupted = set(random.Random(0).sample(maps, num_maps // 10))
+first_run = True
+
+
+def fetch(_map):
+    if first_run and _map in interrupted:
+        raise RuntimeError('interrupted')
+    return fetch_map_records(map_url, _map)
+
+
+with tempfile.TemporaryDirectory() as serial_folder, tempfile.TemporaryDirectory() as concurrent_folder:
+    print(f'Fetching {num_maps} maps with {latency * 1000:.0f} ms api latency')
+    sequential, _ = timed_fetch(maps, lambda _map: fetch_map_records(map_url, _map), serial_folder, 1)
+    concurrent, failed = timed_fetch(maps, fetch, concurrent_folder, concurrency)
+    print(f'Interrupted {len(failed)} maps, resuming')
+    first_run = False
+    _, failed = timed_fetch(maps, fetch, concurrent_folder, concurrency)
+    identical = not failed and all(read_checkpoint(serial_folder, _map) == read_checkpoint(concurrent_folder, _map)
+                                   for _map in maps)
+    print(f'1 at a time:  {sequential:8.1f} maps/s')
+    print(f'{concurrency} at a time: {concurrent:8.1f} maps/s ({concurrent / sequential:.1f}x)')
+    print(f'Resumed results identical to serial: {identical}')
+server.shutdown()
+if not identical:
+    sys.exit(1)
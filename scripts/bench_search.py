@@ -0,0 +1,69 @@
+"""Benchmark player search: the previous unindexed ILIKE on the raw name against the trigram indexed search name.
+Works on a temporary table of synthetic players, the real tables are not touched. Requires the pg_trgm extension.
+Arguments:
+num_players -- number of synthetic players, defaults to 200000
+"""
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+
+NUM_SEARCHES = 50
+RESULTS_PER_PAGE = 20
+
+num_players = int(sys.argv[1]) if len(sys.argv) >= 2 else 200000
+
+OLD_COUNT = 'SELECT count(*) FROM bench_player WHERE name ILIKE :pattern'
+OLD_PAGE = 'SELECT id, name FROM bench_player WHERE name ILIKE :pattern LIMIT :limit'
+NEW_COUNT = 'SELECT count(*) FROM bench_player WHERE search_name LIKE :pattern'
+NEW_PAGE = 'SELECT id, name FROM bench_player WHERE search_name LIKE :pattern ' \
+           'ORDER BY search_name = :term DESC, search_name LIKE :prefix DESC, similarity(search_name, :term) DESC ' \
+           'LIMIT :limit'
+
+
+def time_queries(queries, terms):
+    """Mean milliseconds per search of running all queries for every term"""
+    start = perf_counter()
+    for term in terms:
+        params = {'term': term,
+                  'pattern': f'%{term}%',
+                  'prefix': f'{term}%',
+                  'limit': RESULTS_PER_PAGE}
+        for query in queries:
+            db.session.execute(query, params).fetchall()
+    return (perf_counter() - start) * 1000 / len(terms)
+
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    print(f'Creating {num_players} synthetic players')
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.session.execute('CREATE TEMPORARY TABLE bench_player (id serial PRIMARY KEY, name text, search_name text)')
+    # Names with quake color codes like ^1a1b2^7c3d4e5
+    db.session.execute("INSERT INTO bench_player (name) "
+                       "SELECT '^' || (i % 10) || substr(md5(i::text), 1, 5) || '^7' || substr(md5((i * 7)::text), 1, 5) "
+                       "FROM generate_series(1, :num_players) AS i", {'num_players': num_players})
+    db.session.execute(r"UPDATE bench_player SET search_name = lower(regexp_replace(name, '\^[0-9]', '', 'g'))")
+    db.session.execute('ANALYZE bench_player')
+    names = [row.search_name for row in db.session.execute('SELECT search_name FROM bench_player ORDER BY random() LIMIT :n',
+                                                           {'n': NUM_SEARCHES})]
+    random.seed(0)
+    terms = []
+    for name in names:
+        start = random.randrange(len(name) - 4)
+        terms.append(name[start:start + 4])
+
+    old_ms = time_queries([OLD_COUNT, OLD_PAGE], terms)
+    print('Creating trigram index')
+    start = perf_counter()
+    db.session.execute('CREATE INDEX ON bench_player USING gin (search_name gin_trgm_ops)')
+    db.session.execute('ANALYZE bench_player')
+    print(f'Index created in {perf_counter() - start:.1f} s')
+    new_ms = time_queries([NEW_COUNT, NEW_PAGE], terms)
+    print(f'{NUM_SEARCHES} searches on {num_players} players')
+    print(f'name ILIKE without index:     {old_ms:8.2f} ms per search')
+    print(f'search_name with trigram GIN: {new_ms:8.2f} ms per search')
+    db.session.rollback()
@@ -0,0 +1,109 @@
+"""Benchmark and check qldf.steam_pages against the BeautifulSoup extraction it replaced: both extract the fields of
+every page, their results must be identical and the CPU time per page of each is printed.
+Without arguments a synthetic workshop page shaped like a real one, with large scripts, a long description and
+comments, is used. Saved workshop pages, such as scripts/steam_pages/workshop_item*.html, can be checked instead. The
+expected fields of those are checked by check_steam_pages.py.
+Arguments:
+pages -- paths of saved workshop item pages (curl 'https://steamcommunity.com/sharedfiles/filedetails/?id=...')
+"""
+import os
+import sys
+from time import process_time
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf.steam_pages import parse_workshop_page, parse_workshop_date
+
+ROUNDS = 20
+
+
+def soup_workshop_page(html):
+    """The BeautifulSoup extraction of update_workshop_item, returning what parse_workshop_page does"""
+    soup = BeautifulSoup(html, 'html.parser')
+    name = soup.find('div', {'class': 'workshopItemTitle'})
+    author_url = soup.find('a', {'class': 'friendBlockLinkOverlay'})
+    description = soup.find('div', {'class': 'workshopItemDescription'})
+    div = soup.find('div', {'class': 'detailsStatsContainerRight'})
+    subdivs = div.find_all('div', {'class': 'detailsStatRight'}) if div else []
+    tab_counts = soup.find_all('span', {'class': 'tabCount'})
+    num_ratings = soup.find('div', {'class': 'numRatings'})
+    div = soup.find('div', {'class': 'fileRatingDetails'})
+    score = 0
+    if div:
+        score_image_filename = urlparse(div.find_next('img')['src']).path.split('/')[-1]
+        for i in range(5):
+            if str(i) in score_image_filename:
+                score = i
+    preview = soup.find('img', {'class': 'workshopItemPreviewImageEnlargeable'})
+    return {'name': name.text if name else None,
+            'author_url': author_url['href'] if author_url else None,
+            'description': description.get_text(separator='\n') if description else None,
+            'size': subdivs[0].text.split(' ')[0] if subdivs else None,
+            'date': parse_workshop_date(subdivs[1].text) if len(subdivs) > 1 else None,
+            'num_comments': tab_counts[1].text if len(tab_counts) > 1 else None,
+            'num_ratings': num_ratings.text.split(' ')[0] if num_ratings else 0,
+            'score': score,
+            'preview_url': preview['src'] if preview else None}
+
+
+def synthetic_page():
+    script = '<script type="text/javascript">' + 'var g_rgData = {"key": "value", "n": [1, 2, 3]};\n' * 400 + '</script>'
+    comments = ''.join(f'<div class="commentthread_comment"><div class="commentthread_comment_author">'
+                       f'<a class="hoverunderline" href="https://steamcommunity.com/id/user{i}">user{i}</a></div>'
+                       f'<div class="commentthread_comment_text">Nice map &amp; fast route number {i} <br> gg</div>'
+                       f'</div>\n' for i in range(40))
+    description = '<br>\n'.join(f'Line {i} of the description with <b>bold</b> &quot;quoted&quot; text'
+                                for i in range(30))
+    return f'''<!DOCTYPE html>
+<html><head><title>Steam Workshop::Race map</title>{script}<style>.a {{ color: red; }}</style></head>
+<body class="flat_page">{script}
+<div class="responsive_page_frame"><div class="workshopItemDetailsHeader">
+<div class="workshopItemTitle">Race map  &amp; friends</div></div>
+<div class="highlight_strip"><img id="previewImageMain" class="workshopItemPreviewImageEnlargeable"
+ src="https://steamuserimages-a.akamaihd.net/ugc/123/ABC/"></div>
+<div class="fileRatingDetails"><img src="https://steamcommunity-a.akamaihd.net/public/images/sharedfiles/4-star_large.png"></div>
+<div class="numRatings">1,234 ratings</div>
+<div class="creatorsBlock"><div class="friendBlock"><a class="friendBlockLinkOverlay"
+ href="https://steamcommunity.com/id/mapper"></a><div class="friendBlockContent">mapper<br>
+<span class="friendSmallText">Offline</span></div></div></div>
+<div class="detailsStatsContainerLeft"><div class="detailsStatLeft">File Size </div><div class="detailsStatLeft">Posted </div></div>
+<div class="detailsStatsContainerRight"><div class="detailsStatRight">1.234 MB</div>
+<div class="detailsStatRight">20 Oct, 2016 @ 10:36pm</div><div class="detailsStatRight">21 Oct, 2016 @ 9:00am</div></div>
+<div class="workshopItemDescriptionTitle">Description</div>
+<div class="workshopItemDescription" id="highlightContent">{description}</div>
+<div class="tabs"><span class="tabCount">3</span> Change Notes <span class="tabCount">42</span> Comments</div>
+{comments}{script}
+</div></body></html>'''
+
+
+def cpu_ms(extract, html):
+    """Mean CPU milliseconds of extracting the fields of html"""
+    start = process_time()
+    for _ in range(ROUNDS):
+        extract(html)
+    return (process_time() - start) * 1000 / ROUNDS
+
+
+if len(sys.argv) >= 2:
+    pages = []
+    for path in sys.argv[1:]:
+        with open(path, encoding='utf-8') as f:
+            pages.append((os.path.basename(path), f.read()))
+else:
+    pages = [('synthetic', synthetic_page())]
+mismatches = 0
+for name, html in pages:
+    expected = soup_workshop_page(html)
+    fields = parse_workshop_page(html)
+    for field in expected:
+        if fields[field] != expected[field]:
+            mismatches += 1
+            print(f'{name}: {field} differs, soup {expected[field]!r}, steam_pages {fields[field]!r}')
+    soup = cpu_ms(soup_workshop_page, html)
+    fast = cpu_ms(parse_workshop_page, html)
+    print(f'{name} ({len(html) / 1024:.0f} KiB): soup {soup:7.2f} ms, steam_pages {fast:6.2f} ms ({soup / fast:.1f}x)')
+if mismatches:
+    sys.exit(1)
+print('All fields identical')
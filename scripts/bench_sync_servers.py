@@ -0,0 +1,113 @@
+"""Benchmark applying a syncore server list to the server table: the previous select, update or insert and commit per
+server followed by a delete and commit per stale server, against the single transaction upsert of sync_servers.
+Each is timed syncing an empty table, syncing the same servers again and syncing a list where a tenth of the
+servers changed their map and a tenth were replaced by new ones.
+Works on a temporary server table that hides the real one for the connection of the benchmark, the real tables are
+not touched.
+Arguments:
+num_servers -- number of synthetic servers, defaults to 3000
+"""
+import json
+import os
+import random
+import sys
+from copy import deepcopy
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+from qldf.models import Server
+from qldf.tasks import sync_servers
+
+num_servers = int(sys.argv[1]) if len(sys.argv) >= 2 else 3000
+
+
+def synthetic_server(server_id):
+    return {'serverID': server_id,
+            'address': f'10.{server_id // 65536 % 256}.{server_id // 256 % 256}.{server_id % 256}:27960',
+            'location': {'countryName': random.choice(['Germany', 'Netherlands', 'United States', 'Russia'])},
+            'info': {'map': f'map{random.randrange(500)}',
+                     'maxPlayers': 16,
+                     'serverName': f'qlrace.com server {server_id}',
+                     'extra': {'keywords': 'qlrace.com,race,vql'}},
+            'players': [{'name': f'player{random.randrange(10000)}',
+                         'score': random.randrange(10000, 100000),
+                         'totalConnected': f'{random.randrange(60)}m',
+                         'secsConnected': random.randrange(3600)} for _ in range(random.randrange(4))]}
+
+
+def per_row_sync(servers):
+    """update_servers before sync_servers"""
+    server_ids = []
+    for server in servers:
+        server_id = server['serverID']
+        server_ids.append(server_id)
+        values = {'server_id': server_id,
+                  'address': server['address'],
+                  'country': server['location']['countryName'],
+                  'map': server['info']['map'],
+                  'max_players': server['info']['maxPlayers'],
+                  'players': json.dumps([{key: value for key, value in player.items() if key != 'secsConnected'}
+                                         for player in server['players']]),
+                  'name': server['info']['serverName'],
+                  'keywords': server['info']['extra']['keywords']}
+        if db.session.query(Server).filter(Server.server_id == server_id).first():
+            db.session.query(Server).filter(Server.server_id == server_id).update(values)
+        else:
+            db.session.add(Server(**values))
+        db.session.commit()
+    for row in db.session.query(Server.id, Server.server_id).all():
+        if row.server_id not in server_ids:
+            Server.query.filter(Server.id == row.id).delete()
+            db.session.commit()
+
+
+def set_based_sync(servers):
+    sync_servers(servers)
+    db.session.commit()
+
+
+def time_syncs(sync, syncs):
+    """Milliseconds taken by each of syncs"""
+    db.session.query(Server).delete()
+    db.session.commit()
+    times = []
+    for servers in syncs:
+        start = perf_counter()
+        sync(servers)
+        times.append((perf_counter() - start) * 1000)
+    return times
+
+
+def use_temporary_server_table():
+    """Make db.session a session on a single connection and create a temporary server table on it. Temporary tables
+    come first in the search path, so every statement of the session, commits included, goes to it instead of the real
+    table."""
+    connection = db.engine.connect()
+    # Without binds per table, the default session would send the ORM statements to the engine
+    db.session = db.create_scoped_session(options={'bind': connection, 'binds': {}})
+    connection.execute('CREATE TEMPORARY TABLE server (LIKE server INCLUDING INDEXES)')
+    connection.execute('CREATE TEMPORARY SEQUENCE server_id_seq OWNED BY pg_temp.server.id')
+    connection.execute("ALTER TABLE pg_temp.server ALTER COLUMN id SET DEFAULT nextval('pg_temp.server_id_seq')")
+    if db.session.get_bind(Server.__mapper__) is not connection or \
+            not db.session.execute("SELECT 'server'::regclass = 'pg_temp.server'::regclass").scalar():
+        sys.exit('The temporary server table does not hide the real one, not running the benchmark')
+
+
+random.seed(0)
+first = [synthetic_server(server_id) for server_id in range(1, num_servers + 1)]
+changed = deepcopy(first)
+for server in random.sample(changed, num_servers // 10):
+    server['info']['map'] = f'map{random.randrange(500)}'
+for i, server_id in enumerate(random.sample(range(len(changed)), num_servers // 10)):
+    changed[server_id] = synthetic_server(num_servers + 1 + i)
+syncs = [first, first, changed]
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    use_temporary_server_table()
+    print(f'Syncing {num_servers} synthetic servers')
+    old = time_syncs(per_row_sync, syncs)
+    new = time_syncs(set_based_sync, syncs)
+    for name, old_ms, new_ms in zip(('empty table', 'unchanged', '10% changed, 10% replaced'), old, new):
+        print(f'{name:26} per row: {old_ms:9.1f} ms  set based: {new_ms:8.1f} ms ({old_ms / new_ms:.0f}x)')
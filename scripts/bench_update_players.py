@@ -0,0 +1,66 @@
+"""Benchmark the profile fetch phase of update_players against a local fake steam profile server,
+fetching one profile at a time like before against fetching them concurrently. The database is not touched.
+Arguments:
+num_players -- number of profiles to fetch, defaults to 200
+latency -- seconds the fake server takes to answer, defaults to 0.05
+concurrency -- number of profiles fetched at the same time, defaults to 8
+"""
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf.outbound import OutboundScheduler
+from qldf.ratelimit import RateLimiter
+from qldf.tasks import fetch_player_profiles
+
+num_players = int(sys.argv[1]) if len(sys.argv) >= 2 else 200
+latency = float(sys.argv[2]) if len(sys.argv) >= 3 else 0.05
+concurrency = int(sys.argv[3]) if len(sys.argv) >= 4 else 8
+
+
+class FakeProfileHandler(BaseHTTPRequestHandler):
+    """Answers /profiles/<steam id>?xml=1 like steam does"""
+    def do_GET(self):
+        sleep(latency)
+        steam_id = self.path.split('/')[2].split('?')[0]
+        body = f'<?xml version="1.0" encoding="UTF-8"?><profile><steamID64>{steam_id}</steamID64>' \
+               f'<steamID><![CDATA[player{steam_id[-4:]}]]></steamID>' \
+               f'<avatarFull><![CDATA[https://example.com/{steam_id}.jpg]]></avatarFull></profile>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def time_fetch(players, concurrency):
+    """Profiles fetched per second"""
+    start = perf_counter()
+    scheduler = OutboundScheduler(rate_limiter=RateLimiter(None), retries=0, backoff_seconds=0, backoff_max_seconds=0,
+                                  failure_threshold=5, reset_seconds=0, time_limit=None)
+    profiles = list(fetch_player_profiles(players, profile_url, concurrency, scheduler))
+    elapsed = perf_counter() - start
+    failures = [profile for _, profile in profiles if isinstance(profile, Exception)]
+    if failures:
+        print(f'{len(failures)} fetches failed, first error: {failures[0]}')
+    return len(players) / elapsed
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeProfileHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+profile_url = f'http://127.0.0.1:{server.server_port}/profiles/'
+players = [SimpleNamespace(steam_id=str(76561198000000000 + i)) for i in range(num_players)]
+print(f'Fetching {num_players} profiles with {latency * 1000:.0f} ms server latency')
+sequential = time_fetch(players, 1)
+print(f'1 at a time:  {sequential:8.1f} profiles/s')
+concurrent = time_fetch(players, concurrency)
+print(f'{concurrency} at a time: {concurrent:8.1f} profiles/s ({concurrent / sequential:.1f}x)')
+server.shutdown()
@@ -0,0 +1,55 @@
+"""Check qldf.steam_pages against the saved steam pages in scripts/steam_pages: every page is parsed by the parser its
+name starts with and the fields must equal the expected ones in <page>.json, dates as ISO strings. Prints the fields
+that differ and exits with 1 if any do. When steam changes its markup, save the changed page over the old one and
+update its expected fields by hand.
+Arguments:
+pages -- paths of the pages to check, all saved pages when none are given
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf.steam_pages import parse_workshop_page, parse_workshop_search, parse_profile_page, parse_profile_xml
+
+PAGES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'steam_pages')
+
+
+def parse(filename, text):
+    """Get the fields of the page filename as the tasks would
+    Returns:
+        dict: {field name: value}
+    """
+    if filename.startswith('workshop_search'):
+        return {'workshop_id': parse_workshop_search(text)}
+    if filename.startswith('workshop_item'):
+        return parse_workshop_page(text)
+    if filename.startswith('profile') and filename.endswith('.xml'):
+        return dict(zip(('steam_id', 'name', 'avatar_url'), parse_profile_xml(text)))
+    if filename.startswith('profile'):
+        return dict(zip(('name', 'avatar_url'), parse_profile_page(text)))
+    raise ValueError(f'No parser for page {filename}')
+
+
+if len(sys.argv) >= 2:
+    paths = sys.argv[1:]
+else:
+    paths = [os.path.join(PAGES_FOLDER, filename) for filename in sorted(os.listdir(PAGES_FOLDER))
+             if not filename.endswith('.json')]
+mismatches = 0
+for path in paths:
+    filename = os.path.basename(path)
+    with open(path, encoding='utf-8') as f:
+        fields = parse(filename, f.read())
+    with open(f'{path}.json', encoding='utf-8') as f:
+        expected = json.load(f)
+    fields = {field: value.isoformat() if isinstance(value, datetime) else value for field, value in fields.items()}
+    for field in sorted(set(expected) | set(fields)):
+        if fields.get(field) != expected.get(field):
+            mismatches += 1
+            print(f'{filename}: {field} differs, expected {expected.get(field)!r}, got {fields.get(field)!r}')
+    print(f'{filename}: {len(expected)} fields checked')
+if mismatches:
+    sys.exit(1)
+print('All fields as expected')
@@ -0,0 +1,21 @@
+"""Check the stored record statistics of every player against their records.
+Arguments:
+repair -- recalculate the statistics of players that are out of date"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+from qldf.aggregates import check_player_stats, update_player_stats
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    print('DB: checking player statistics')
+    player_ids = check_player_stats()
+    print(f'{len(player_ids)} players have out of date statistics')
+    if player_ids:
+        print(f'player ids: {player_ids}')
+        if len(sys.argv) >= 2 and sys.argv[1] == 'repair':
+            update_player_stats(player_ids)
+            db.session.commit()
+            print('DB: player statistics repaired')
@@ -6,5 +6,8 @@ from qldf import db, create_app
 
 app = create_app('config.scripts_config')
 with app.app_context():
+    # Trigram indexes used by search
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.session.commit()
     db.create_all()
     db.session.commit()
@@ -11,10 +11,12 @@ while response.lower() not in ('y', 'n'):
 if response.lower() == 'y':
     app = create_app('config.scripts_config')
     with app.app_context():
-        from qldf.models import Map, Player, Record, WorkshopItem
+        from qldf.models import Map, Player, Record, WorkshopItem, WorldRecord, DataVersion
 
+        WorldRecord.query.delete()
         Record.query.delete()
         Player.query.delete()
         Map.query.delete()
         WorkshopItem.query.delete()
+        DataVersion.bump(Record.__tablename__, Player.__tablename__, Map.__tablename__, WorkshopItem.__tablename__)
         db.session.commit()
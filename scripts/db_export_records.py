@@ -0,0 +1,13 @@
+"""Write the bulk record exports and daily deltas now instead of waiting for the scheduled export_records task."""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import create_app
+from qldf.exports import write_record_exports
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    print(f"Exporting records to {app.config['EXPORT_FOLDER']} and publishing them in the database")
+    write_record_exports()
+print('Records exported')
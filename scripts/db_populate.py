@@ -1,14 +1,24 @@
 """Populate the database with records, players and maps from qlrace.com via the qlrace.com api
+The records of several maps are fetched at the same time and saved per map to checkpoint files, a rerun after a crash
+or interrupt resumes from the maps that are missing. Once all maps are in they are combined, in the order of the map
+list, into a cache of one json object per line that is streamed into the database, so the whole set is never held in
+memory. Rows are bulk loaded with COPY, the record and player indexes are created after the load.
 Arguments:
 noupdate -- skips updating workshop items at end
 """
 import os
 import sys
-from urllib.request import Request, urlopen
+from datetime import datetime
+from time import perf_counter
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from qldf.models import Record, Player, Map, WorkshopItem
+from qldf.models import Record, Player, Map, WorkshopItem, DataVersion
 from qldf import create_app, db
+from qldf.aggregates import rebuild_all
+from qldf.bulkload import load_rows, deferred_indexes, next_id, reset_sequence, peak_rss_mb
+from qldf.checkpoints import fetch_with_checkpoints, read_checkpoint, remove_checkpoints, CONCURRENCY
+from qldf.http_client import http_client
+from qldf.tasks import parse_qlrace_date, fetch_map_records
 import json
 import os
 import subprocess
@@ -18,7 +28,8 @@ from config import heroku_config
 scripts_dir = os.path.dirname(__file__)
 
 maps_cache_filepath = os.path.join(scripts_dir, 'tmp/maps.json')
-records_cache_filepath = os.path.join(scripts_dir, 'tmp/records.json')
+records_cache_filepath = os.path.join(scripts_dir, 'tmp/records.ndjson')
+records_checkpoint_folder = os.path.join(scripts_dir, 'tmp/records')
 players_cache_filepath = os.path.join(scripts_dir, 'tmp/players.json')
 mapids_cache_filepath = os.path.join(scripts_dir, 'tmp/map_ids.json')
 
@@ -30,13 +41,6 @@ else:
     map_limit = None
 
 
-def get_data_from_url(url):
-    req = Request(url)
-    print(f'GET from url:{url}')
-    req.add_header('User-Agent', 'qldf api script')
-    return json.loads(urlopen(req).read().decode())
-
-
 def get_data_from_cache(path):
     try:
         with open(path, 'r') as _f:
@@ -46,6 +50,21 @@ def get_data_from_cache(path):
         return None
 
 
+def cached_records():
+    """Stream the records from the cache"""
+    with open(records_cache_filepath, 'r') as _f:
+        for line in _f:
+            yield json.loads(line)
+
+
+def timed_load(name, table, columns, rows):
+    """Load rows into table and print the rate"""
+    start = perf_counter()
+    count = load_rows(table, columns, rows)
+    elapsed = perf_counter() - start
+    print(f'DB: loaded {count} {name} in {elapsed:.1f} s, {count / max(elapsed, 1e-9):.0f} rows/s')
+
+
 if not os.path.exists(os.path.dirname(maps_cache_filepath)):
     os.mkdir(os.path.dirname(maps_cache_filepath))
 
@@ -53,7 +72,7 @@ if not os.path.exists(os.path.dirname(maps_cache_filepath)):
 print('Getting map names')
 maps = get_data_from_cache(maps_cache_filepath)
 if not maps:
-    maps = get_data_from_url('https://qlrace.com/api/maps')['maps']
+    maps = http_client.get_json(heroku_config.QLRACE_MAPS_URL)['maps']
     # limit maps
     if map_limit:
         print(f'Maps limited to {map_limit}')
@@ -62,37 +81,38 @@ if not maps:
         json.dump(maps, f)
 
 
-# For each map get the records, from cached file or the qlrace.com api
+# For each map get the records from the qlrace.com api, unless they are cached already
 print('Getting records')
-records = get_data_from_cache(records_cache_filepath)
-if not records:
-    records = []
-    for _map in maps:
-        new_records = []
-        # vql, no weapons = mode 3
-        new_records += get_data_from_url(f'https://qlrace.com/api/map/{_map}?weapons=false&physics=classic')['records']
-        # vql, weapons = mode 2
-        new_records += get_data_from_url(f'https://qlrace.com/api/map/{_map}?weapons=true&physics=classic')['records']
-        # pql, no weapons = mode 1
-        new_records += get_data_from_url(f'https://qlrace.com/api/map/{_map}?weapons=false&physics=turbo')['records']
-        # pql, weapons = mode 0
-        new_records += get_data_from_url(f'https://qlrace.com/api/map/{_map}?weapons=true&physics=turbo')['records']
-        # add the map name to every record
-        for i in range(len(new_records)):
-            new_records[i]['map'] = _map
-        records += new_records
-    with open(os.path.abspath(records_cache_filepath), 'w+') as f:
-        json.dump(records, f)
+players = get_data_from_cache(players_cache_filepath)
+if os.path.exists(records_cache_filepath):
+    print(f'GET from cache:{records_cache_filepath}')
+else:
+    failed = fetch_with_checkpoints(maps,
+                                    lambda _map: fetch_map_records(heroku_config.QLRACE_MAP_URL, _map),
+                                    records_checkpoint_folder,
+                                    CONCURRENCY,
+                                    'records')
+    if failed:
+        print(f'Failed to get the records of {len(failed)} maps, run again to retry them')
+        sys.exit(1)
+    players = {}
+    with open(records_cache_filepath + '.tmp', 'w') as f:
+        for _map in maps:
+            for record in read_checkpoint(records_checkpoint_folder, _map):
+                f.write(json.dumps(record))
+                f.write('\n')
+                players[str(record['player_id'])] = record['name']
+    os.replace(records_cache_filepath + '.tmp', records_cache_filepath)
+    remove_checkpoints(records_checkpoint_folder)
 
 # Get every unique player id and their name
 print('Getting players')
-players = get_data_from_cache(players_cache_filepath)
 if not players:
     players = {}
-    for record in records:
-        players[record['player_id']] = record['name']
-    with open(os.path.abspath(players_cache_filepath), 'w+') as f:
-        json.dump(players, f)
+    for record in cached_records():
+        players[str(record['player_id'])] = record['name']
+with open(os.path.abspath(players_cache_filepath), 'w+') as f:
+    json.dump(players, f)
 print('Getting workshop item ids for maps')
 
 # Get workshop item ids for maps from cache or by searching the steam workshop for map names
@@ -101,61 +121,63 @@ if not maps_with_workshop_ids:
     subprocess.call(['python', f'{scripts_dir}/get_map_workshop_ids.py', 'fromcache'])
     maps_with_workshop_ids = get_data_from_cache(mapids_cache_filepath)
 
+if http_client.stats():
+    print(http_client.summary())
+
 # Insert data into database
 app = create_app('config.scripts_config')
 with app.app_context():
-    # Insert the workshop items into the database
+    now = datetime.utcnow()
+    # Ids are assigned here, so nothing has to be read back from the database
     print('DB: inserting workshop items')
-    unique_workshop_ids = set(maps_with_workshop_ids.values())
-    workshop_items_new_ids = {}
-    for _id in unique_workshop_ids:
+    workshop_item_ids = {}
+    first_id = next_id(WorkshopItem.__table__)
+    for _id in set(maps_with_workshop_ids.values()):
         if _id:
-            new_workshop_item = WorkshopItem(item_id=_id)
-            db.session.add(new_workshop_item)
-            db.session.commit()
-            workshop_items_new_ids[_id] = new_workshop_item.id
+            workshop_item_ids[str(_id)] = first_id + len(workshop_item_ids)
+    timed_load('workshop items', WorkshopItem.__table__, ('id', 'item_id', 'date_created', 'date_modified'),
+               ((_id, item_id, now, now) for item_id, _id in workshop_item_ids.items()))
 
-    # Insert the maps into the database
     print('DB: inserting maps')
-    maps_with_new_ids = {}
+    map_ids = {}
+    first_id = next_id(Map.__table__)
     for _map in maps:
-        try:
-            new_map = Map(name=_map,
-                          workshop_item_id=workshop_items_new_ids[maps_with_workshop_ids[_map]])
-        except KeyError:
-            new_map = Map(name=_map,
-                          workshop_item_id=None)
-        db.session.add(new_map)
-        db.session.commit()
-        maps_with_new_ids[_map] = new_map.id
-
-    # Insert the players into the database
-    print('DB: inserting players')
-    players_with_new_ids = {}
-    for player_id, player_name in players.items():
-        new_player = Player(name=player_name,
-                            steam_id=player_id)
-        db.session.add(new_player)
-        db.session.commit()
-        players_with_new_ids[player_id] = new_player.id
-
-    # Insert the records into the database
-    print('DB: inserting records')
-    for record in records:
-        # player_with_new_ids keys can be an int or a str
-        # seems to depend on if they were loaded from cache or from the api
-        try:
-            player_id = players_with_new_ids[str(record['player_id'])]
-        except KeyError:
-            player_id = players_with_new_ids[int(record['player_id'])]
-        new_record = Record(mode=record['mode'],
-                            map_id=maps_with_new_ids[record['map']],
-                            player_id=player_id,
-                            time=record['time'],
-                            match_guid=record['match_guid'],
-                            date=record['date'])
-        db.session.add(new_record)
+        map_ids[_map] = first_id + len(map_ids)
+    timed_load('maps', Map.__table__, ('id', 'name', 'workshop_item_id', 'date_created', 'date_modified'),
+               ((_id, _map, workshop_item_ids.get(str(maps_with_workshop_ids.get(_map))), now, now)
+                for _map, _id in map_ids.items()))
+
+    with deferred_indexes(Player.__table__, Record.__table__):
+        print('DB: inserting players')
+        player_ids = {}
+        first_id = next_id(Player.__table__)
+        for steam_id in players:
+            player_ids[steam_id] = first_id + len(player_ids)
+        timed_load('players', Player.__table__,
+                   ('id', 'name', 'search_name', 'steam_id', 'date_created', 'date_modified'),
+                   ((player_ids[steam_id], name, Player.make_search_name(name), steam_id, now, now)
+                    for steam_id, name in players.items()))
+
+        print('DB: inserting records')
+        first_id = next_id(Record.__table__)
+        timed_load('records', Record.__table__,
+                   ('id', 'mode', 'map_id', 'player_id', 'time', 'match_guid', 'date', 'date_created', 'date_modified'),
+                   ((first_id + i, record['mode'], map_ids[record['map']], player_ids[str(record['player_id'])],
+                     record['time'], record['match_guid'], parse_qlrace_date(record['date']), now, now)
+                    for i, record in enumerate(cached_records())))
+        # Calculate the record ranks, world records and player statistics, before the indexes on them exist
+        print('DB: calculating record ranks, world records and player statistics')
+        start = perf_counter()
+        rebuild_all()
+        print(f'DB: calculated in {perf_counter() - start:.1f} s')
+        print('DB: creating player and record indexes')
+        start = perf_counter()
+    print(f'DB: indexes created in {perf_counter() - start:.1f} s')
+    for table in (WorkshopItem.__table__, Map.__table__, Player.__table__, Record.__table__):
+        reset_sequence(table)
+    DataVersion.bump(WorkshopItem.__tablename__, Map.__tablename__, Player.__tablename__)
     db.session.commit()
+    print(f'Peak RSS: {peak_rss_mb():.0f} MiB')
     # Create workshop items
 # Update workshop items by calling db_update_workshopitems.
 if not(len(sys.argv) >= 2 and sys.argv[1] == 'noupdate'):
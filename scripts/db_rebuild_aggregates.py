@@ -0,0 +1,15 @@
+"""Recalculate the stored record ranks, world records, player statistics and map record counts from scratch.
+They are normally kept up to date incrementally, use this after loading records in bulk or to repair them."""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+from qldf.aggregates import rebuild_all
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    print('DB: rebuilding record ranks, world records, player statistics and map record counts')
+    rebuild_all()
+    db.session.commit()
+print('DB: record ranks, world records, player statistics and map record counts rebuilt')
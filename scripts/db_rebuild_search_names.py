@@ -0,0 +1,18 @@
+"""Recalculate the search name of every player, for players created before search names were stored."""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+from qldf.models import Player, DataVersion
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    print('DB: rebuilding player search names')
+    players = db.session.query(Player.id, Player.name).all()
+    db.session.bulk_update_mappings(Player, [{'id': player.id,
+                                              'search_name': Player.make_search_name(player.name)}
+                                             for player in players])
+    DataVersion.bump(Player.__tablename__)
+    db.session.commit()
+print('DB: player search names rebuilt')
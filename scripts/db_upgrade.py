@@ -0,0 +1,39 @@
+"""Bring the schema of an existing database up to date with the models: create missing tables, add missing columns and
+create missing indexes. Safe to run more than once, what already exists is left alone. Columns are added without data,
+run db_rebuild_search_names.py and db_rebuild_aggregates.py afterwards to fill in the search names, record ranks,
+player statistics and map record counts of the existing rows."""
+import os
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from qldf import db, create_app
+
+app = create_app('config.scripts_config')
+with app.app_context():
+    # Trigram indexes used by search
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.session.commit()
+    existing_tables = set(inspect(db.engine).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        inspector = inspect(db.engine)
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                print(f'DB: adding column {table.name}.{column.name}')
+                column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                db.session.execute(f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column_ddl}')
+        indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                print(f'DB: creating index {index.name}')
+                db.session.execute(CreateIndex(index))
+        db.session.commit()
+    # Tables that did not exist yet, with their indexes
+    db.create_all()
+    db.session.commit()
+print('DB: schema up to date')
@@ -1,5 +1,7 @@
 """
 Get steam workshop ids by map name for maps in the database
+The searches run on a pool of threads and every result is saved to a checkpoint file, a rerun after a crash or
+interrupt only searches the maps that are missing.
 Arguments:
 fromcache -- load maps from cache instead of the steam workshop
 """
@@ -8,21 +10,23 @@ import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from qldf import db, create_app
-from bs4 import BeautifulSoup
+from qldf.checkpoints import fetch_with_checkpoints, read_checkpoint, remove_checkpoints, CONCURRENCY
+from qldf.http_client import http_client
+from qldf.steam_pages import parse_workshop_search
 import json
-from urllib.request import Request, urlopen
-from urllib.parse import urlparse, parse_qs
 
 maps_cache_filepath = os.path.join(os.path.dirname(__file__), 'tmp/maps.json')
+mapids_cache_filepath = os.path.join(os.path.dirname(__file__), 'tmp/map_ids.json')
+mapids_checkpoint_folder = os.path.join(os.path.dirname(__file__), 'tmp/map_ids')
 
 # Append the text to search for
 WORKSHOP_SEARCH_URL = "https://steamcommunity.com/workshop/browse/?appid=282440&searchtext="
 
 
-def get_html_from_url(url):
-    req = Request(url)
-    req.add_header('User-Agent', 'qldf workshop scraping script')
-    return urlopen(req).read().decode()
+def search_workshop_id(_map):
+    """Search the steam workshop for a map name, returns the workshop id of the first result or None"""
+    html = http_client.get_text(WORKSHOP_SEARCH_URL + _map)
+    return parse_workshop_search(html)
 
 
 # If script was started with arg 'fromcache', load maps from cache
@@ -37,27 +41,21 @@ else:
         from qldf.models import Map
         map_rows = db.session.query(Map).all()
         maps = {row.name: int(row.workshop_item_id) for row in map_rows}
+missing = [_map for _map, workshop_id in maps.items() if not workshop_id]
+failed = fetch_with_checkpoints(missing, search_workshop_id, mapids_checkpoint_folder, CONCURRENCY, 'workshop searches')
+if failed:
+    print(f'Failed to search for {len(failed)} maps, run again to retry them')
+    sys.exit(1)
+for _map in missing:
+    maps[_map] = read_checkpoint(mapids_checkpoint_folder, _map)
 for _map, workshop_id in maps.items():
-    if not workshop_id:
-        # Search for map name
-        html = get_html_from_url(WORKSHOP_SEARCH_URL + _map)
-        soup = BeautifulSoup(html, 'html.parser')
-        # Find the map name in the search results
-        name_div = soup.find('div', {'class': 'workshopItemTitle ellipsis'})
-        if name_div:
-            # Extract the url from the html
-            workshop_item_url = name_div.find_previous('a')['href']
-            # Extract the workshop item id from the url
-            # https://steamcommunity.com/sharedfiles/filedetails/?id=808465963&searchtext=daanstrafe01
-            workshop_id = int(parse_qs(urlparse(workshop_item_url).query)['id'][0])
-            maps[_map] = workshop_id
-        else:
-            # No search results
-            maps[_map] = None
     print(f'{_map}:{workshop_id}')
 
 # Save to cache
-if not os.path.exists(os.path.dirname(maps_cache_filepath)):
-    os.mkdir(os.path.dirname(maps_cache_filepath))
-with open(os.path.abspath(maps_cache_filepath), 'w+') as f:
+if not os.path.exists(os.path.dirname(mapids_cache_filepath)):
+    os.mkdir(os.path.dirname(mapids_cache_filepath))
+with open(os.path.abspath(mapids_cache_filepath), 'w+') as f:
     json.dump(maps, f)
+remove_checkpoints(mapids_checkpoint_folder)
+if http_client.stats():
+    print(http_client.summary())
@@ -0,0 +1,22 @@
+"""Run the scheduled tasks, apart from the web processes.
+
+Every task holds a lease in the database while it runs, so with several workers each task still runs in one of them at
+a time."""
+
+from qldf import create_app
+import os
+import signal
+import threading
+config = os.environ.get('QLDF_CONFIG', 'config.heroku_config')
+# The worker serves no pages, so only the startup runs of the tasks are warm-up
+app = create_app(config, SCHEDULER_ENABLED=True, WARMUP_ENABLED=False)
+
+if __name__ == '__main__':
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    app.logger.info('running qldf worker...')
+    stop.wait()
+    app.logger.info('stopping qldf worker...')
+    # Let running tasks finish, their leases are released when they do
+    app.apscheduler.shutdown()